@@ -2,67 +2,798 @@
 
 
 import cgi
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
+from functools import partial
+import mimetypes
+import os
+import re
 import sys
+import threading
 from urlparse import urljoin, urlparse
+import zlib
 
 import ipaddress
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
-from twisted.internet.error import ConnectError, DNSLookupError
+from twisted.internet.defer import (CancelledError, Deferred, fail,
+                                    inlineCallbacks, maybeDeferred,
+                                    returnValue, succeed)
+from twisted.internet.endpoints import SSL4ClientEndpoint, TCP4ClientEndpoint
+from twisted.internet.error import ConnectError, DNSLookupError, TimeoutError
+from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.internet.protocol import Protocol, connectionDone
-from twisted.plugin import IPlugin, getPlugins
+from twisted.plugin import IPlugin
+from twisted.python import log
 from twisted.python.failure import Failure
+from twisted.python.components import proxyForInterface
+from twisted.python.modules import getModule
+from twisted.python.reflect import namedAny
 from twisted.python.url import URL
-from twisted.web.client import (IAgent, Agent, ContentDecoderAgent,
-                                RedirectAgent, GzipDecoder, Response,
-                                ResponseFailed)
-from twisted.web.error import InfiniteRedirection
-from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.web.client import (IAgent, Agent, BrowserLikePolicyForHTTPS,
+                                ContentDecoderAgent, RedirectAgent,
+                                HTTPConnectionPool, ResponseFailed)
+from twisted.web.error import InfiniteRedirection, SchemeNotSupported
+from twisted.web.http import stringToDatetime
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory, IResponse, UNKNOWN_LENGTH
 from zope.interface import implements, Attribute
 
 from . import plugins
+from .cache import CachedTitle, RedirectCache
 from .humanize import filesize
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 #
 # HTTP response body truncation
 #
 
+class BodyBuffer(object):
+    """Collects at most *max_bytes* bytes of a response body, or all of
+    it if *max_bytes* is `None`.  Data is copied straight into a single
+    `bytearray`, allocated once and sized from the body's expected
+    *length* if known, or else from *max_bytes*.  The server may lie
+    about the length, so without *max_bytes*, no more than
+    `max_preallocated` bytes are allocated before data arrives."""
+
+    #: The most bytes allocated up front for a body of unlimited size.
+    max_preallocated = 65536
+
+    def __init__(self, max_bytes=None, length=UNKNOWN_LENGTH):
+        #: The number of bytes collected so far.
+        self.size = 0
+        #: The number of bytes that can still be collected.
+        self.remaining = sys.maxsize if max_bytes is None else max_bytes
+        if length is not UNKNOWN_LENGTH:
+            self.capacity = min(length, self.max_preallocated
+                                if max_bytes is None else max_bytes)
+        else:
+            self.capacity = max_bytes or 0
+        # A body that arrives in a single chunk is kept as it is, since
+        # there is nothing to gain from copying it anywhere else.
+        self._first = None
+        self._buffer = None
+
+    def write(self, data):
+        """Collect as much of *data* as fits, and return `True` if any
+        of it had to be thrown away."""
+        kept = min(len(data), self.remaining)
+        truncated = kept < len(data)
+        if not kept:
+            return truncated
+        if self.size == 0 and not truncated:
+            self._first = data
+        else:
+            if self._buffer is None:
+                self._buffer = bytearray(max(self.capacity, self.size + kept))
+                if self._first is not None:
+                    self._buffer[:self.size] = self._first
+                    self._first = None
+            if truncated:
+                data = memoryview(data)[:kept]
+            # This grows the buffer if the body turns out to be longer
+            # than expected, and copies into it in place otherwise.
+            self._buffer[self.size:self.size + kept] = data
+        self.size += kept
+        self.remaining -= kept
+        return truncated
+
+    def getvalue(self):
+        """Return the data collected as a byte string."""
+        if self._buffer is None:
+            return self._first or ''
+        return str(self.getbuffer())
+
+    def getbuffer(self):
+        """Return the data collected as a `bytearray`, which is the
+        buffer itself and not a copy, unless the data arrived in one
+        piece."""
+        if self._buffer is None:
+            self._buffer = bytearray(self._first or '')
+            self._first = None
+        del self._buffer[self.size:]
+        return self._buffer
+
+
+def stop_body(transport):
+    """Stop the rest of a response body from arriving, given the
+    *transport* passed to its protocol.  Before Twisted 17.1, that
+    transport can only stop producing, which drops the connection."""
+    lose_connection = getattr(transport, 'loseConnection', None)
+    if lose_connection is None:
+        transport.stopProducing()
+    else:
+        lose_connection()
+
+
 class TruncatingReadBodyProtocol(Protocol):
     """A protocol that collects data sent to it up to a maximum of
-    *max_bytes*, then discards the rest."""
+    *max_bytes* in a `BodyBuffer`, then discards the rest.  *length* is
+    the expected length of the body, if known.  *finished* is fired
+    with the data as a byte string, or as a `bytearray` if *as_buffer*
+    is true."""
 
-    def __init__(self, status, message, finished, max_bytes=None):
+    def __init__(self, status, message, finished, max_bytes=None,
+                 length=UNKNOWN_LENGTH, as_buffer=False):
         self.status = status
         self.message = message
         self.finished = finished
-        self.data_buffer = []
-        self.remaining = max_bytes or sys.maxsize
+        self.body = BodyBuffer(max_bytes, length)
+        self.as_buffer = as_buffer
+
+    @property
+    def remaining(self):
+        return self.body.remaining
+
+    def connectionMade(self):
+        limit_encoded_body(self.transport, self.body.remaining)
 
     def dataReceived(self, data):
-        if self.remaining > 0:
-            to_buffer = data[:self.remaining]
-            self.data_buffer.append(to_buffer)
-            self.remaining -= len(to_buffer)
-        if self.remaining <= 0:
-            self.transport.loseConnection()
+        # Only drop the connection once there is actually something to
+        # discard, so that a body that exactly fits, such as the answer
+        # to a range request, leaves it fit for reuse.
+        if self.body.write(data):
+            stop_body(self.transport)
+
+    def value(self):
+        """Return the data collected so far, in the form *finished* is
+        fired with."""
+        if self.as_buffer:
+            return self.body.getbuffer()
+        return self.body.getvalue()
 
     def connectionLost(self, reason=connectionDone):
         if not self.finished.called:
-            self.finished.callback(''.join(self.data_buffer))
+            self.finished.callback(self.value())
+
+
+class ParsingReadBodyProtocol(TruncatingReadBodyProtocol):
+    """A `TruncatingReadBodyProtocol` that also feeds data to *parser*,
+    which has a ``feed`` method and a ``done`` attribute, and stops
+    reading as soon as the parser is done."""
 
+    def __init__(self, status, message, finished, max_bytes, parser,
+                 length=UNKNOWN_LENGTH, as_buffer=False):
+        TruncatingReadBodyProtocol.__init__(
+            self, status, message, finished, max_bytes, length, as_buffer)
+        self.parser = parser
 
-def read_body(response, max_bytes=None):
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.parser.feed(data if len(data) <= self.remaining
+                         else data[:self.remaining])
+        TruncatingReadBodyProtocol.dataReceived(self, data)
+        if self.parser.done:
+            if self.remaining > 0:
+                stop_body(self.transport)
+            self.finished.callback(self.value())
+
+
+def read_body(response, max_bytes=None, as_buffer=False):
     """Return a `Deferred` yielding at most *max_bytes* bytes from the
     body of a Twisted Web *response*, or the whole body if *max_bytes*
-    is `None`."""
+    is `None`.  The body is returned as a byte string, or as a
+    `bytearray` if *as_buffer* is true, which saves copying it."""
     finished = Deferred()
     response.deliverBody(TruncatingReadBodyProtocol(
-        response.code, response.phrase, finished, max_bytes))
+        response.code, response.phrase, finished, max_bytes,
+        response.length, as_buffer))
+    return finished
+
+
+class BodyFile(object):
+    """A read-only, seekable file-like object over a response body that
+    may still be arriving.  Reads and seeks relative to the end block
+    until enough of the body is available, so this must never be read
+    on the reactor thread."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.finished = False
+        self.condition = threading.Condition()
+
+    def feed(self, data):
+        """Append *data* to the body.  Called from the reactor thread."""
+        with self.condition:
+            self.buffer.extend(data)
+            self.condition.notify_all()
+
+    def finish(self):
+        """Mark the body as complete, or as truncated for good."""
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def read(self, size=-1):
+        with self.condition:
+            while not self.finished and (
+                    size < 0 or len(self.buffer) < self.position + size):
+                self.condition.wait()
+            end = len(self.buffer) if size < 0 else self.position + size
+            data = bytes(self.buffer[self.position:end])
+            self.position += len(data)
+            return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        with self.condition:
+            if whence == os.SEEK_CUR:
+                offset += self.position
+            elif whence == os.SEEK_END:
+                while not self.finished:
+                    self.condition.wait()
+                offset += len(self.buffer)
+            self.position = max(0, offset)
+            return self.position
+
+    def tell(self):
+        return self.position
+
+
+class BodyFileProtocol(Protocol):
+    """A protocol that feeds at most *max_bytes* bytes of a response
+    body into the `BodyFile` *body_file*."""
+
+    def __init__(self, body_file, max_bytes):
+        self.body_file = body_file
+        self.remaining = max_bytes
+
+    def connectionMade(self):
+        limit_encoded_body(self.transport, self.remaining)
+
+    def dataReceived(self, data):
+        if len(data) <= self.remaining:
+            self.body_file.feed(data)
+            self.remaining -= len(data)
+            return
+        if self.remaining > 0:
+            self.body_file.feed(data[:self.remaining])
+            self.remaining = 0
+        self.stop()
+
+    def connectionLost(self, reason=connectionDone):
+        self.remaining = 0
+        self.body_file.finish()
+
+    def stop(self):
+        """Stop reading the body, if it hasn't already ended."""
+        if not self.body_file.finished:
+            self.body_file.finish()
+            stop_body(self.transport)
+
+
+class DiscardingProtocol(Protocol):
+    """A protocol that ignores any data sent to it, and fires *finished*
+    with the number of bytes ignored once the connection is lost."""
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def connectionLost(self, reason=connectionDone):
+        self.finished.callback(self.received)
+
+
+def discard_body(response, max_bytes=0):
+    """Throw away the body of a Twisted Web *response*, and return a
+    `Deferred` that fires with the number of bytes read once it is gone.
+    A body known to be no longer than *max_bytes* is read to the end, so
+    that the connection it came on can be reused; anything else is cut
+    off immediately."""
+    if response.length is not UNKNOWN_LENGTH and response.length <= max_bytes:
+        finished = read_body(response)
+        finished.addCallback(len)
+        return finished
+    finished = Deferred()
+    protocol = DiscardingProtocol(finished)
+    response.deliverBody(protocol)
+    if not finished.called:
+        stop_body(protocol.transport)
     return finished
 
 
+class CountingBodyProtocol(Protocol):
+    """A protocol that passes a response body on to *protocol*, keeping
+    track of how much of it arrived and when, according to *clock*."""
+
+    def __init__(self, protocol, clock):
+        self.protocol = protocol
+        self.clock = clock
+        #: The number of bytes received so far.
+        self.received = 0
+        #: The time the last data was received, or `None` if none has.
+        self.last_received = None
+
+    def connectionMade(self):
+        self.protocol.makeConnection(self.transport)
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        self.last_received = self.clock.seconds()
+        self.protocol.dataReceived(data)
+
+    def connectionLost(self, reason=connectionDone):
+        self.protocol.connectionLost(reason)
+
+
+class CountingResponse(proxyForInterface(IResponse)):
+    """A wrapper for a Twisted Web response that counts the bytes of its
+    body passed on, using a `CountingBodyProtocol`."""
+
+    def __init__(self, original, clock):
+        self.original = original
+        self.clock = clock
+        #: The `CountingBodyProtocol` in use, once the body is delivered.
+        self.counter = None
+
+    def deliverBody(self, protocol):
+        self.counter = CountingBodyProtocol(protocol, self.clock)
+        self.original.deliverBody(self.counter)
+
+
+#
+# Content decoding
+#
+
+class ZlibStream(object):
+    """Incrementally decompresses a gzip or zlib stream, or a raw
+    deflate stream, using the zlib window bits *wbits*."""
+
+    def __init__(self, wbits):
+        self.wbits = wbits
+        self._decompressor = zlib.decompressobj(wbits)
+        self._tail = ''
+
+    def decompress(self, data, max_length):
+        """Feed in *data*, and return at most *max_length* bytes of
+        output.  Input left over is kept for the next call."""
+        output = self._decompressor.decompress(self._tail + data, max_length)
+        self._tail = self._decompressor.unconsumed_tail
+        return output
+
+    def pending(self):
+        """Return whether more output can be had without more input."""
+        return bool(self._tail)
+
+    def flush(self):
+        """Return whatever output is left once all input has been fed
+        in."""
+        return self._decompressor.flush()
+
+
+class GzipStream(ZlibStream):
+    """Incrementally decompresses a ``gzip`` content coding."""
+
+    def __init__(self):
+        ZlibStream.__init__(self, 16 + zlib.MAX_WBITS)
+
+
+class DeflateStream(ZlibStream):
+    """Incrementally decompresses a ``deflate`` content coding, which
+    should be a zlib stream, but is sent as raw deflate data by some
+    servers."""
+
+    def __init__(self):
+        ZlibStream.__init__(self, zlib.MAX_WBITS)
+        # The input seen until the stream's format is settled.
+        self._head = ''
+
+    def decompress(self, data, max_length):
+        if self._head is None:
+            return ZlibStream.decompress(self, data, max_length)
+        self._head += data
+        try:
+            output = ZlibStream.decompress(self, data, max_length)
+        except zlib.error:
+            # Not a zlib header, so start over assuming raw deflate.
+            ZlibStream.__init__(self, -zlib.MAX_WBITS)
+            output = ZlibStream.decompress(self, self._head, max_length)
+            self._head = None
+        else:
+            if len(self._head) >= 2:
+                self._head = None
+        return output
+
+
+class BrotliStream(object):
+    """Incrementally decompresses a Brotli stream."""
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+        self._tail = ''
+        self._full = False
+
+    def decompress(self, data, max_length):
+        # Once the output limit has been hit, the decompressor only
+        # takes empty input until it has caught up.
+        self._tail += data
+        data = ''
+        if self._decompressor.can_accept_more_data():
+            data, self._tail = self._tail, ''
+        output = self._decompressor.process(data,
+                                            output_buffer_limit=max_length)
+        # The limit is only approximate, since the output buffer grows
+        # in blocks, but output that reached it may have more to come.
+        self._full = len(output) >= max_length
+        return output
+
+    def pending(self):
+        return bool(self._tail) or (self._full and
+                                    not self._decompressor.is_finished())
+
+    def flush(self):
+        return ''
+
+
+#: The exceptions raised by streams given corrupt input.
+DECODING_ERRORS = (zlib.error,) if brotli is None else (zlib.error,
+                                                         brotli.error)
+
+
+class DecodingTransport(object):
+    """The transport given to the protocol reading a response body
+    through a `DecodingProtocol`, which passes calls on to *transport*
+    and lets *decoder* know when the body has been stopped."""
+
+    def __init__(self, transport, decoder):
+        self.transport = transport
+        self.decoder = decoder
+
+    def stopProducing(self):
+        self.decoder.stop()
+
+    loseConnection = stopProducing
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def limit_encoded_bytes(self, max_bytes):
+        """Cut the body off after *max_bytes* bytes of encoded data, or
+        sooner if already limited."""
+        limit = self.decoder.max_encoded_bytes
+        if limit is None or max_bytes < limit:
+            self.decoder.max_encoded_bytes = max_bytes
+
+
+def limit_encoded_body(transport, max_bytes):
+    """Cut off a response body after *max_bytes* bytes of data as sent
+    over the wire, given the *transport* passed to its protocol, if the
+    body is compressed.  That way, a small compressed body can't expand
+    into more than *max_bytes* bytes of useless output, and a large one
+    can't be downloaded in full while yielding nothing at all."""
+    limit = getattr(transport, 'limit_encoded_bytes', None)
+    if limit is not None and max_bytes is not None:
+        limit(max_bytes)
+
+
+class DecodingProtocol(Protocol):
+    """A protocol that decompresses the body of *response* with
+    *stream* and passes it on to *protocol*, at most *chunk_size* bytes
+    at a time, so that no more is ever decompressed than *protocol*
+    asks for.  At most *max_encoded_bytes* bytes of compressed data are
+    read, if given.  Corrupt data fails the body with `ResponseFailed`.
+    """
+
+    def __init__(self, protocol, stream, response, max_encoded_bytes=None,
+                 chunk_size=65536):
+        self.protocol = protocol
+        self.stream = stream
+        self.response = response
+        self.max_encoded_bytes = max_encoded_bytes
+        self.chunk_size = chunk_size
+        #: The number of bytes of encoded data received.
+        self.received = 0
+        self.stopped = False
+        self.done = False
+
+    def connectionMade(self):
+        self.protocol.makeConnection(DecodingTransport(self.transport, self))
+
+    def dataReceived(self, data):
+        if self.stopped:
+            return
+        over = False
+        if self.max_encoded_bytes is not None:
+            allowed = self.max_encoded_bytes - self.received
+            if len(data) > allowed:
+                data = data[:allowed]
+                over = True
+        self.received += len(data)
+        try:
+            output = self.stream.decompress(data, self.chunk_size)
+            while True:
+                if output:
+                    self.protocol.dataReceived(output)
+                if self.stopped or not self.stream.pending():
+                    break
+                output = self.stream.decompress('', self.chunk_size)
+        except DECODING_ERRORS:
+            self.fail(Failure())
+            return
+        if over:
+            self.stop()
+
+    def stop(self):
+        """Stop the rest of the body from arriving."""
+        if not self.stopped:
+            self.stopped = True
+            stop_body(self.transport)
+
+    def fail(self, failure):
+        self.stop()
+        self.connectionLost(Failure(ResponseFailed([failure], self.response)))
+
+    def connectionLost(self, reason=connectionDone):
+        if self.done:
+            return
+        if not self.stopped:
+            try:
+                output = self.stream.flush()
+            except DECODING_ERRORS:
+                reason = Failure(ResponseFailed([reason, Failure()],
+                                                self.response))
+            else:
+                if output:
+                    self.protocol.dataReceived(output)
+        self.done = True
+        self.protocol.connectionLost(reason)
+
+
+class DecodedResponse(proxyForInterface(IResponse)):
+    """A wrapper for a Twisted Web response whose body is decompressed
+    with a new instance of the subclass's ``stream_class``.  Use
+    subclasses as decoders with a `ContentDecoderAgent`."""
+
+    def __init__(self, original):
+        self.original = original
+        self.length = UNKNOWN_LENGTH
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(DecodingProtocol(
+            protocol, self.stream_class(), self.original))
+
+
+class GzipDecoder(DecodedResponse):
+    """Decodes the ``gzip`` content coding."""
+    stream_class = GzipStream
+
+
+class DeflateDecoder(DecodedResponse):
+    """Decodes the ``deflate`` content coding."""
+    stream_class = DeflateStream
+
+
+class BrotliDecoder(DecodedResponse):
+    """Decodes the ``br`` content coding, using the optional `brotli`
+    module."""
+    stream_class = BrotliStream
+
+
+def content_decoders():
+    """Return a list of pairs of content coding names and decoders for
+    a `ContentDecoderAgent`, with Brotli included only if a version of
+    the `brotli` module that can limit its output is installed."""
+    decoders = [('gzip', GzipDecoder), ('deflate', DeflateDecoder)]
+    if brotli is not None and hasattr(brotli.Decompressor(),
+                                      'can_accept_more_data'):
+        decoders.insert(0, ('br', BrotliDecoder))
+    return decoders
+
+
+#
+# Timeouts
+#
+
+class FetchTimeout(Exception):
+    """Raised when a phase of fetching a document, either waiting for
+    the response ``'headers'`` or reading the response ``'body'``, runs
+    out of time, or when a caller's own time limit on the whole fetch,
+    the ``'call'`` phase, runs out."""
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __str__(self):
+        if self.phase == 'call':
+            return 'timed out waiting for the fetch to finish'
+        return 'timed out waiting for response {}'.format(self.phase)
+
+
+class TimeoutBodyProtocol(Protocol):
+    """A protocol that passes a response body on to *protocol*, unless
+    *deadline* calls `cut_off` first.  In that case, the connection is
+    dropped, and *protocol* is told it was lost right away."""
+
+    def __init__(self, protocol, deadline):
+        self.protocol = protocol
+        self.deadline = deadline
+        self.done = False
+
+    def connectionMade(self):
+        self.protocol.makeConnection(self.transport)
+
+    def dataReceived(self, data):
+        if not self.done:
+            self.protocol.dataReceived(data)
+
+    def connectionLost(self, reason=connectionDone):
+        if not self.done:
+            self.done = True
+            self.deadline.finish(self)
+            self.protocol.connectionLost(reason)
+
+    def cut_off(self, reason):
+        if not self.done:
+            stop_body(self.transport)
+            self.connectionLost(reason)
+
+
+class DeadlineResponse(proxyForInterface(IResponse)):
+    """A wrapper for a Twisted Web response whose body is cut off if it
+    doesn't finish arriving before *deadline* runs out."""
+
+    def __init__(self, original, deadline, timeout):
+        self.original = original
+        self.deadline = deadline
+        self.timeout = timeout
+
+    def deliverBody(self, protocol):
+        wrapper = TimeoutBodyProtocol(protocol, self.deadline)
+        self.deadline.start(wrapper, 'body', self.timeout)
+        self.original.deliverBody(wrapper)
+
+
+class Deadline(object):
+    """Keeps track of the time left to fetch one document, which runs
+    out *timeout* seconds after creation, according to *clock*, or never
+    if *timeout* is `None`.
+
+    The fetch is made up of phases, each of which has its own time limit
+    and is cut off if it hasn't finished when either it or the overall
+    deadline runs out, or when `cancel` is called.  A phase is either a
+    `Deferred` passed to `limit`, or the body of a response wrapped with
+    `limit_body`.
+    """
+
+    def __init__(self, clock, timeout=None):
+        self.clock = clock
+        self.expires = None if timeout is None else clock.seconds() + timeout
+        #: The `FetchTimeout` for the phase that ran out of time, if any.
+        self.error = None
+        self._phases = {}
+
+    def time_left(self, timeout=None):
+        """Return the number of seconds left before a phase with its own
+        *timeout* must finish, or `None` if there is no limit."""
+        if self.expires is None:
+            return timeout
+        remaining = max(self.expires - self.clock.seconds(), 0)
+        return remaining if timeout is None else min(remaining, timeout)
+
+    def start(self, phase, name, timeout):
+        """Start the *phase* called *name*, which is either a `Deferred`
+        or a `TimeoutBodyProtocol`, and cut it off if it isn't finished
+        within *timeout* seconds."""
+        seconds = self.time_left(timeout)
+        call = None
+        if seconds is not None:
+            call = self.clock.callLater(seconds, self.time_out, phase, name)
+        self._phases[phase] = call
+
+    def finish(self, phase):
+        """Stop timing *phase*."""
+        call = self._phases.pop(phase, None)
+        if call is not None and call.active():
+            call.cancel()
+
+    def time_out(self, phase, name):
+        self._phases.pop(phase, None)
+        self.error = FetchTimeout(name)
+        self.stop(phase, Failure(self.error))
+
+    def stop(self, phase, reason):
+        if isinstance(phase, Deferred):
+            phase.cancel()
+        else:
+            phase.cut_off(reason)
+
+    def limit(self, deferred, timeout, name='headers'):
+        """Return *deferred*, which yields response headers unless the
+        phase is given another *name*, after arranging for it to be
+        cancelled, failing with `FetchTimeout`, if it hasn't fired
+        within *timeout* seconds."""
+        self.start(deferred, name, timeout)
+        def finish(result):
+            self.finish(deferred)
+            if isinstance(result, Failure) and self.error is not None:
+                return Failure(self.error)
+            return result
+        return deferred.addBoth(finish)
+
+    def limit_body(self, response, timeout):
+        """Return a wrapper for the Twisted Web *response* whose body is
+        cut off if it takes longer than *timeout* seconds to arrive."""
+        return DeadlineResponse(response, self, timeout)
+
+    def check(self):
+        """Raise the `FetchTimeout` for any phase that was cut off."""
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        """Cut off every phase in progress."""
+        reason = Failure(CancelledError())
+        for phase in self._phases.keys():
+            self.finish(phase)
+            self.stop(phase, reason)
+
+
+#
+# Connection pooling
+#
+
+class ConnectionPool(HTTPConnectionPool):
+    """An `~twisted.web.client.HTTPConnectionPool` that keeps at most
+    *max_per_host* idle persistent connections to any one host and
+    *max_total* idle connections overall, closing each one after it has
+    been idle for *idle_timeout* seconds.  If *max_total* is `None`,
+    the overall number of idle connections is not limited."""
+
+    def __init__(self, reactor, max_per_host=4, idle_timeout=60,
+                 max_total=64):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        #: The maximum number of idle connections kept across all hosts.
+        self.max_total = max_total
+
+    def _putConnection(self, key, connection):
+        if (self.max_total is not None and
+                len(self._timeouts) >= self.max_total and
+                len(self._connections.get(key, ())) <
+                    self.maxPersistentPerHost):
+            # Make room by dropping whichever cached connection would
+            # have timed out soonest, i.e. the one idle the longest.
+            oldest = min(self._timeouts,
+                         key=lambda c: self._timeouts[c].getTime())
+            self._timeouts[oldest].cancel()
+            for oldest_key, connections in self._connections.iteritems():
+                if oldest in connections:
+                    self._removeConnection(oldest_key, oldest)
+                    break
+        HTTPConnectionPool._putConnection(self, key, connection)
+
+
 #
 # Host blacklisting
 #
@@ -80,27 +811,503 @@ class BlacklistedHost(Exception):
             self.hostname, self.ip)
 
 
+def check_address(hostname, ip_str):
+    """Raise `BlacklistedHost` if *ip_str*, the IP address that
+    *hostname* resolved to, is a loopback, private, or link-local
+    address.  Otherwise, return *ip_str* unchanged."""
+    # `ipaddress` takes a Unicode string and I don't really care to
+    # handle `UnicodeDecodeError` separately.
+    ip = ipaddress.ip_address(ip_str.decode('ascii', 'replace'))
+    if ip.is_private or ip.is_loopback or ip.is_link_local:
+        raise BlacklistedHost(hostname, ip)
+    return ip_str
+
+
+class CachingResolver(object):
+    """A callable that resolves hostnames to IP addresses using
+    *resolve*, which defaults to `reactor.resolve`, and remembers the
+    answers.  Successful lookups are cached for *ttl* seconds, and
+    failed lookups for *negative_ttl* seconds.  At most *max_entries*
+    hostnames are remembered at once."""
+
+    def __init__(self, resolve=None, ttl=300, negative_ttl=30,
+                 max_entries=1024, clock=None):
+        self.resolve = resolve or reactor.resolve
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock or reactor
+        self.entries = OrderedDict()
+
+    def __call__(self, hostname):
+        if not hostname:
+            # Such as that of a URL like "foo" or "http:///foo".
+            return fail(DNSLookupError('no hostname given'))
+        hostname = hostname.lower()
+        try:
+            expires, result = self.entries[hostname]
+        except KeyError:
+            pass
+        else:
+            if expires > self.clock.seconds():
+                if isinstance(result, Failure):
+                    return fail(result)
+                return succeed(result)
+            del self.entries[hostname]
+        resolving = self.resolve(hostname)
+        resolving.addCallbacks(self.remember, self.remember_failure,
+                               callbackArgs=(hostname,),
+                               errbackArgs=(hostname,))
+        return resolving
+
+    def store(self, hostname, ttl, result):
+        self.entries.pop(hostname, None)
+        self.entries[hostname] = (self.clock.seconds() + ttl, result)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def remember(self, ip_str, hostname):
+        self.store(hostname, self.ttl, ip_str)
+        return ip_str
+
+    def remember_failure(self, failure, hostname):
+        if failure.check(DNSLookupError):
+            self.store(hostname, self.negative_ttl, failure)
+        return failure
+
+
+class PinnedEndpoint(object):
+    """A client endpoint that resolves *hostname* with *resolve*, checks
+    the resulting address with `check_address`, and connects to that
+    exact address.  If *creator* is given, it is used to start TLS."""
+    implements(IStreamClientEndpoint)
+
+    def __init__(self, reactor, hostname, port, resolve, creator=None,
+                 timeout=30, observe=None):
+        self.reactor = reactor
+        self.hostname = hostname
+        self.port = port
+        self.resolve = resolve
+        self.creator = creator
+        self.timeout = timeout
+        self.observe = observe
+
+    def connect(self, protocolFactory):
+        connecting = self.resolve(self.hostname)
+        connecting.addCallback(lambda ip_str: check_address(self.hostname,
+                                                            ip_str))
+        connecting.addCallback(self.connect_to, protocolFactory)
+        return connecting
+
+    def connect_to(self, ip_str, protocolFactory):
+        if self.creator is None:
+            endpoint = TCP4ClientEndpoint(self.reactor, ip_str, self.port,
+                                          timeout=self.timeout)
+        else:
+            endpoint = SSL4ClientEndpoint(self.reactor, ip_str, self.port,
+                                          self.creator, timeout=self.timeout)
+        connecting = endpoint.connect(protocolFactory)
+        if self.observe is not None:
+            connecting = self.observe('connect', connecting)
+        return connecting
+
+
+class PinnedEndpointFactory(object):
+    """An agent endpoint factory that creates `PinnedEndpoint` objects,
+    so that an `~twisted.web.client.Agent` connects only to addresses
+    that passed the blacklist check.  Sharing a `CachingResolver` as
+    *resolve* with a `BlacklistingAgent` means the address it checked
+    is the one connected to, without a second DNS lookup.
+
+    If *observe* is given, each connection attempt is passed to it as a
+    phase name and a `Deferred`, as with `TitleFetcher.timed`, and
+    whatever it returns is used instead."""
+    implements(IAgentEndpointFactory)
+
+    def __init__(self, reactor, resolve, policy=None, timeout=30,
+                 observe=None):
+        self.reactor = reactor
+        self.resolve = resolve
+        self.policy = policy or BrowserLikePolicyForHTTPS()
+        self.timeout = timeout
+        self.observe = observe
+
+    def endpointForURI(self, uri):
+        creator = None
+        if uri.scheme == 'https':
+            creator = self.policy.creatorForNetloc(uri.host, uri.port)
+        elif uri.scheme != 'http':
+            raise SchemeNotSupported(
+                'Unsupported scheme: {!r}'.format(uri.scheme))
+        return PinnedEndpoint(self.reactor, uri.host, uri.port, self.resolve,
+                              creator, self.timeout, self.observe)
+
+
 class BlacklistingAgent(object):
     """An `~twisted.web.client.Agent` wrapper that forbids requests to
-    loopback, private, and internal IP addresses."""
+    loopback, private, and internal IP addresses.  Hostnames are looked
+    up with *resolve*, which defaults to a new `CachingResolver`."""
     implements(IAgent)
 
     def __init__(self, agent, resolve=None):
         self.agent = agent
-        self.resolve = resolve or reactor.resolve
+        self.resolve = resolve or CachingResolver()
 
-    @inlineCallbacks
     def request(self, method, uri, headers=None, bodyProducer=None):
         """Issue a request to the server indicated by *uri*."""
+        # This is a plain callback chain, rather than inlineCallbacks,
+        # so that cancelling the result also cancels the request.
         hostname = urlparse(uri).hostname
-        ip_str = yield self.resolve(hostname)
-        # `ipaddress` takes a Unicode string and I don't really care to
-        # handle `UnicodeDecodeError` separately.
-        ip = ipaddress.ip_address(ip_str.decode('ascii', 'replace'))
-        if ip.is_private or ip.is_loopback or ip.is_link_local:
-            raise BlacklistedHost(hostname, ip)
-        response = yield self.agent.request(method, uri, headers, bodyProducer)
-        returnValue(response)
+        requesting = self.resolve(hostname)
+        requesting.addCallback(lambda ip_str: check_address(hostname, ip_str))
+        requesting.addCallback(lambda _: self.agent.request(
+            method, uri, headers, bodyProducer))
+        return requesting
+
+
+#
+# Per-host rate limiting
+#
+
+def parse_retry_after(value, now):
+    """Return the number of seconds to wait according to the HTTP
+    ``Retry-After`` header *value*, which is either a number of seconds
+    or a date, given the current time *now*.  Return `None` if *value*
+    is malformed."""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(stringToDatetime(value) - now, 0)
+    except (IndexError, KeyError, ValueError):
+        return None
+
+
+class HostThrottle(object):
+    """The rate limiting state of a single host, as kept by a
+    `ThrottlingAgent`."""
+
+    def __init__(self, tokens, now):
+        #: The number of requests that may be started right away.
+        self.tokens = tokens
+        #: When `tokens` was last brought up to date.
+        self.updated = now
+        #: The number of requests waiting for a response.
+        self.active = 0
+        #: Requests waiting to be started, as `ThrottledRequest` objects.
+        self.queue = deque()
+        #: The time before which no requests may be started.
+        self.blocked_until = now
+        #: The current delay after a 429 or 503 response without a
+        #: ``Retry-After`` header, which doubles each time.
+        self.backoff = 0
+        #: The delayed call that will start more requests, if any.
+        self.wakeup = None
+
+    def refill(self, now, rate, burst):
+        """Add the tokens earned at *rate* per second since `updated`,
+        up to a maximum of *burst*."""
+        self.tokens = min(self.tokens + (now - self.updated) * rate, burst)
+        self.updated = now
+
+    def is_idle(self, now):
+        return (not self.queue and not self.active and
+                self.wakeup is None and self.blocked_until <= now)
+
+
+class ThrottledRequest(object):
+    """A request made through a `ThrottlingAgent`."""
+
+    def __init__(self, args, retries):
+        self.args = args
+        self.retries = retries
+        self.waiter = None
+        self.running = None
+
+
+class ThrottlingAgent(object):
+    """An `~twisted.web.client.Agent` wrapper that is polite to servers.
+
+    Requests to each host are started at an average of at most *rate*
+    per second, with bursts of up to *burst*, and at most *max_per_host*
+    at a time may be waiting for a response.  Requests beyond those
+    limits wait in a queue for that host alone, so a throttled host
+    never holds up requests to the others.
+
+    When a host responds with status 429 or 503, no new requests are
+    sent to it until the delay given by its ``Retry-After`` header has
+    passed, or, failing that, an exponential backoff of up to
+    *max_backoff* seconds.  The request is retried up to *max_retries*
+    times if the delay is at most *max_retry_delay* seconds; otherwise,
+    the response is passed on as is.
+
+    The state of at most *max_hosts* idle hosts is remembered.  *clock*
+    is an `~twisted.internet.interfaces.IReactorTime` provider used to
+    tell the time, defaulting to the global reactor.
+    """
+    implements(IAgent)
+
+    def __init__(self, agent, rate=1.0, burst=5, max_per_host=4,
+                 max_retries=1, max_retry_delay=10, max_backoff=300,
+                 max_hosts=1024, clock=None):
+        self.agent = agent
+        self.rate = rate
+        self.burst = burst
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.max_retry_delay = max_retry_delay
+        self.max_backoff = max_backoff
+        self.max_hosts = max_hosts
+        self.clock = clock or reactor
+        self.hosts = OrderedDict()
+        #: Bodies of 429 and 503 responses no longer than this many
+        #: bytes are read to the end before the request is retried, so
+        #: that the connection can be reused.  Longer ones are cut off
+        #: right away.
+        self.max_discard_bytes = 16384
+        #: The number of seconds such a body may take to arrive before
+        #: it is cut off too.
+        self.discard_timeout = 10
+        #: The number of seconds to wait for the response headers of
+        #: each request once it has been started, or `None` for no
+        #: limit.  Requests that run out of time fail with
+        #: `FetchTimeout`.
+        self.headers_timeout = None
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        """Issue a request to the server indicated by *uri*, once that
+        server's limits allow it."""
+        host = (urlparse(uri).hostname or '').lower()
+        # Requests with bodies can't be replayed.
+        retries = self.max_retries if bodyProducer is None else 0
+        throttled = ThrottledRequest((method, uri, headers, bodyProducer),
+                                     retries)
+        throttled.waiter = Deferred(
+            lambda _: self.cancel(host, throttled))
+        self.throttle_for(host).queue.append(throttled)
+        self.pump(host)
+        return throttled.waiter
+
+    def throttle_for(self, host):
+        """Return the `HostThrottle` for *host*, creating it if needed."""
+        now = self.clock.seconds()
+        throttle = self.hosts.pop(host, None)
+        if throttle is None:
+            throttle = HostThrottle(self.burst, now)
+        self.hosts[host] = throttle
+        if len(self.hosts) > self.max_hosts:
+            for other, other_throttle in self.hosts.iteritems():
+                if other_throttle.is_idle(now):
+                    del self.hosts[other]
+                    break
+        return throttle
+
+    def pump(self, host):
+        """Start as many of *host*'s queued requests as its limits
+        allow, and arrange to try again later if some are left."""
+        throttle = self.hosts[host]
+        now = self.clock.seconds()
+        throttle.refill(now, self.rate, self.burst)
+        delay = None
+        while throttle.queue and throttle.active < self.max_per_host:
+            if now < throttle.blocked_until:
+                delay = throttle.blocked_until - now
+                break
+            if throttle.tokens < 1:
+                delay = (1 - throttle.tokens) / self.rate
+                break
+            throttle.tokens -= 1
+            self.start(host, throttle, throttle.queue.popleft())
+        if delay is not None and throttle.wakeup is None:
+            throttle.wakeup = self.clock.callLater(delay, self.wake, host)
+
+    def wake(self, host):
+        self.hosts[host].wakeup = None
+        self.pump(host)
+
+    def start(self, host, throttle, throttled):
+        throttle.active += 1
+        # The wrapped agent may raise instead of failing a Deferred, and
+        # the slot has to be given back either way.
+        throttled.running = maybeDeferred(self.agent.request,
+                                          *throttled.args)
+        if self.headers_timeout is not None:
+            throttled.running = Deadline(self.clock).limit(
+                throttled.running, self.headers_timeout)
+        throttled.running.addBoth(self.finish, host, throttled)
+
+    def finish(self, result, host, throttled):
+        throttle = self.hosts[host]
+        throttle.active -= 1
+        throttled.running = None
+        if isinstance(result, Failure):
+            pass
+        elif result.code in (429, 503):
+            now = self.clock.seconds()
+            delay = parse_retry_after(result.headers.getRawHeaders(
+                'Retry-After', [''])[0], now)
+            if delay is None:
+                throttle.backoff = min(max(throttle.backoff * 2, 1),
+                                       self.max_backoff)
+                delay = throttle.backoff
+            delay = min(delay, self.max_backoff)
+            throttle.blocked_until = max(throttle.blocked_until, now + delay)
+            if throttled.retries > 0 and delay <= self.max_retry_delay:
+                throttled.retries -= 1
+                discard_body(Deadline(self.clock).limit_body(
+                    result, self.discard_timeout), self.max_discard_bytes)
+                throttle.queue.appendleft(throttled)
+                self.pump(host)
+                return
+        else:
+            throttle.backoff = 0
+        self.pump(host)
+        if isinstance(result, Failure):
+            throttled.waiter.errback(result)
+        else:
+            throttled.waiter.callback(result)
+
+    def cancel(self, host, throttled):
+        if throttled.running is not None:
+            throttled.running.cancel()
+            return
+        throttle = self.hosts.get(host)
+        if throttle is not None and throttled in throttle.queue:
+            throttle.queue.remove(throttled)
+
+
+#
+# Admission control
+#
+
+#: The priority classes of fetches queued by an `AdmissionQueue`, from
+#: most to least urgent.
+PRIORITIES = ('interactive', 'default', 'bulk')
+
+
+class Overloaded(Exception):
+    """Raised when an `AdmissionQueue` sheds a fetch instead of letting
+    it wait any longer."""
+
+
+class QueuedFetch(object):
+    """A fetch waiting in an `AdmissionQueue`."""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.waiter = None
+        #: The delayed call that sheds this fetch once it is too old.
+        self.expiry = None
+
+
+class AdmissionQueue(object):
+    """Limits the number of fetches running at once, making the rest
+    wait their turn by priority.
+
+    At most *max_active* fetches are admitted at a time.  The rest wait
+    in a first-in, first-out queue for each priority class in
+    `PRIORITIES`, and are admitted from the most urgent class first.
+    At most *max_queued* fetches may wait in all.  When the queue is
+    full, a new fetch displaces the newest one of a less urgent class,
+    or is shed itself if there is none.  Fetches that have waited for
+    *max_age* seconds, according to *clock*, are shed too.  Shed fetches
+    fail at once with `Overloaded`, so that callers can give up quickly
+    instead of piling on more work.
+    """
+
+    def __init__(self, max_active=64, max_queued=1024, max_age=10,
+                 clock=None):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_age = max_age
+        self.clock = clock or reactor
+        #: The number of fetches admitted and not yet released.
+        self.active = 0
+        #: Maps each priority class to a `deque` of `QueuedFetch`
+        #: objects.
+        self.queues = dict((priority, deque()) for priority in PRIORITIES)
+        #: The number of fetches shed so far.
+        self.shed = 0
+
+    @property
+    def queued(self):
+        """The number of fetches waiting to be admitted."""
+        return sum(len(queue) for queue in self.queues.itervalues())
+
+    def has_room(self, count=1, priority='default'):
+        """Return whether *count* more fetches of *priority* can be
+        admitted or queued right now, displacing less urgent ones if
+        necessary."""
+        room = (max(self.max_active - self.active, 0) +
+                self.max_queued - self.queued)
+        for other in PRIORITIES[PRIORITIES.index(priority) + 1:]:
+            room += len(self.queues[other])
+        return count <= room
+
+    def acquire(self, priority='default'):
+        """Return a `Deferred` that fires once a fetch of *priority* may
+        start, or fails with `Overloaded` if it is shed.  Call `release`
+        once an admitted fetch has finished.  Cancelling the `Deferred`
+        takes the fetch out of the queue."""
+        if priority not in self.queues:
+            raise ValueError('unknown priority {!r}'.format(priority))
+        if self.active < self.max_active:
+            self.active += 1
+            return succeed(None)
+        if self.queued >= self.max_queued:
+            for other in reversed(PRIORITIES[PRIORITIES.index(priority) + 1:]):
+                if self.queues[other]:
+                    self.drop(self.queues[other].pop(),
+                              'displaced by a more urgent fetch')
+                    break
+            else:
+                self.shed += 1
+                return fail(Overloaded('admission queue is full'))
+        queued = QueuedFetch(priority)
+        queued.waiter = Deferred(lambda _: self.remove(queued))
+        if self.max_age is not None:
+            queued.expiry = self.clock.callLater(
+                self.max_age, self.expire, queued)
+        self.queues[priority].append(queued)
+        return queued.waiter
+
+    def release(self):
+        """Note that an admitted fetch has finished, and admit the next
+        one waiting, if any."""
+        self.active -= 1
+        self.pump()
+
+    def pump(self):
+        while self.active < self.max_active:
+            for priority in PRIORITIES:
+                if self.queues[priority]:
+                    queued = self.queues[priority].popleft()
+                    break
+            else:
+                return
+            if queued.expiry is not None:
+                queued.expiry.cancel()
+            self.active += 1
+            queued.waiter.callback(None)
+
+    def remove(self, queued):
+        """Take *queued* out of its queue, if it's still there."""
+        if queued in self.queues[queued.priority]:
+            self.queues[queued.priority].remove(queued)
+        if queued.expiry is not None and queued.expiry.active():
+            queued.expiry.cancel()
+
+    def drop(self, queued, reason):
+        """Shed the `QueuedFetch` *queued*, which has already been taken
+        out of its queue, because of *reason*."""
+        if queued.expiry is not None and queued.expiry.active():
+            queued.expiry.cancel()
+        self.shed += 1
+        queued.waiter.errback(Overloaded(reason))
+
+    def expire(self, queued):
+        self.queues[queued.priority].remove(queued)
+        self.drop(queued, 'waited too long to be admitted')
 
 
 #
@@ -127,44 +1334,475 @@ class ITitleExtractor(IPlugin):
         yielding either."""
 
 
+#: Maps MIME content types to the fully qualified names of the built-in
+#: title extractors that handle them, so that they can be found without
+#: importing them.  This must agree with their ``content_types``.
+BUILTIN_EXTRACTORS = {
+    'application/xhtml+xml': 'littlebrother.plugins.html.extractor',
+    'audio/mpeg': 'littlebrother.plugins.av.extractor',
+    'image/gif': 'littlebrother.plugins.image.extractor',
+    'image/jpeg': 'littlebrother.plugins.image.extractor',
+    'image/png': 'littlebrother.plugins.image.extractor',
+    'text/html': 'littlebrother.plugins.html.extractor',
+    'text/plain': 'littlebrother.plugins.text.extractor',
+    'video/mp4': 'littlebrother.plugins.av.extractor',
+    'video/webm': 'littlebrother.plugins.av.extractor',
+    'video/x-matroska': 'littlebrother.plugins.av.extractor'}
+
+
+class ExtractorRegistry(object):
+    """A read-only mapping from MIME content types to title extractors
+    that imports each extractor only when it is first looked up.
+
+    *extractors* is an iterable of extractors to register immediately.
+    *entry_points* maps content types to the fully qualified names of
+    extractors to import on demand, and defaults to the built-in ones.
+    If *scan_plugins* is true, the first lookup of a content type that
+    neither covers also loads every `ITitleExtractor` plugin in the
+    `littlebrother.plugins` package, without importing the built-in
+    ones.
+    Pass an explicit list of *extractors*, an empty *entry_points*, and
+    a false *scan_plugins* to avoid plugin discovery entirely.
+
+    Extractors that fail to import are logged and then treated as if
+    they were never registered.
+    """
+
+    def __init__(self, extractors=(), entry_points=None, scan_plugins=True):
+        if entry_points is None:
+            entry_points = BUILTIN_EXTRACTORS
+        self.entry_points = dict(entry_points)
+        self.scan_plugins = scan_plugins
+        self._extractors = {}
+        for extractor in extractors:
+            self.register(extractor)
+
+    def register(self, extractor):
+        """Use *extractor* for every content type it supports."""
+        for content_type in extractor.content_types:
+            self._extractors[content_type] = extractor
+            self.entry_points.pop(content_type, None)
+
+    def load(self, name):
+        """Import the extractor with the fully qualified *name*, and use
+        it for every content type it supports."""
+        content_types = [content_type for content_type, entry_point
+                         in self.entry_points.iteritems()
+                         if entry_point == name]
+        for content_type in content_types:
+            del self.entry_points[content_type]
+        try:
+            extractor = namedAny(name)
+        except Exception:
+            log.err(None, 'Error loading title extractor {}'.format(name))
+            return
+        self.register(extractor)
+
+    def scan(self):
+        """Load every third-party `ITitleExtractor` plugin.  Content
+        types that are already registered keep their extractors."""
+        self.scan_plugins = False
+        # Twisted's dropin cache would import every module in a plugin
+        # directory whose cache is missing or stale, built-in ones and
+        # their heavy dependencies included, so look for plugins here.
+        builtin_modules = set(name.rsplit('.', 1)[0]
+                              for name in BUILTIN_EXTRACTORS.itervalues())
+        for module in getModule(plugins.__name__).iterModules():
+            if module.name in builtin_modules:
+                continue
+            try:
+                loaded = module.load()
+            except Exception:
+                log.err(None, 'Error loading title extractor plugins '
+                              'from {}'.format(module.name))
+                continue
+            for extractor in vars(loaded).values():
+                if not ITitleExtractor.providedBy(extractor):
+                    continue
+                for content_type in extractor.content_types:
+                    if (content_type not in self._extractors and
+                            content_type not in self.entry_points):
+                        self._extractors[content_type] = extractor
+
+    def get(self, content_type, default=None):
+        """Return the extractor for *content_type*, importing it first
+        if necessary, or *default* if there is none."""
+        if content_type in self._extractors:
+            return self._extractors[content_type]
+        if not content_type:
+            return default
+        if content_type in self.entry_points:
+            self.load(self.entry_points[content_type])
+        elif self.scan_plugins:
+            self.scan()
+        return self._extractors.get(content_type, default)
+
+    def __getitem__(self, content_type):
+        extractor = self.get(content_type)
+        if extractor is None:
+            raise KeyError(content_type)
+        return extractor
+
+    def __contains__(self, content_type):
+        return self.get(content_type) is not None
+
+
 #
 # Object-oriented API
 #
 
-default_extractors = {}
-for extractor in getPlugins(ITitleExtractor, plugins):
-    for content_type in extractor.content_types:
-        default_extractors[content_type] = extractor
+#: The `ExtractorRegistry` used by default by every `TitleFetcher`.
+default_extractors = ExtractorRegistry()
 
 
-def describe_error(failure):
-    """If *failure* is a common connection error, return a Unicode
-    string describing it.  Otherwise, return *failure*."""
+#: Unicode strings describing each class of error named by
+#: `classify_error`.
+ERROR_DESCRIPTIONS = {
+    'redirects': u'Encountered too many redirects.',
+    'incomplete': u'Received incomplete response from server.',
+    'connect': u'Could not connect to server.',
+    'timeout': u'Timed out waiting for server.',
+    'overloaded': u'Too many titles are being fetched; try again later.',
+}
+
+
+def classify_error(failure):
+    """If *failure* is a common connection error, return the name of its
+    class in `ERROR_DESCRIPTIONS`.  Otherwise, return `None`."""
     if failure.check(ResponseFailed):
         if any(f.check(InfiniteRedirection)
                for f in failure.value.reasons):
-            return u'Encountered too many redirects.'
-        return u'Received incomplete response from server.'
-    if failure.check(ConnectError, DNSLookupError, BlacklistedHost):
-        return u'Could not connect to server.'
-    return failure
+            return 'redirects'
+        return 'incomplete'
+    if failure.check(ConnectError, DNSLookupError, TimeoutError,
+                     BlacklistedHost):
+        return 'connect'
+    if failure.check(FetchTimeout):
+        return 'timeout'
+    if failure.check(Overloaded):
+        return 'overloaded'
+    return None
+
+
+def describe_error(failure):
+    """If *failure* is a common connection error, return a Unicode
+    string describing it.  Otherwise, return *failure*."""
+    error_class = classify_error(failure)
+    if error_class is None:
+        return failure
+    return ERROR_DESCRIPTIONS[error_class]
+
+
+CONTENT_RANGE_RE = re.compile(r'^bytes\s+(\d+)-(\d+)/(\d+|\*)$')
+
+
+def parse_content_range(value):
+    """Parse the ``Content-Range`` header *value* and return a tuple of
+    the first and last byte positions and the complete length, which is
+    `None` if unknown.  Return `None` if *value* is malformed."""
+    match = CONTENT_RANGE_RE.match(value.strip())
+    if match is None:
+        return None
+    first, last, length = match.groups()
+    return int(first), int(last), None if length == '*' else int(length)
+
+
+def response_content_type(response):
+    """Return the MIME content type of a Twisted Web *response*, without
+    any parameters, or an empty string if it doesn't have one."""
+    return cgi.parse_header(
+        response.headers.getRawHeaders('Content-Type', [''])[0])[0]
+
+
+def guess_content_type(url):
+    """Guess the MIME content type of the document at the Twisted `URL`
+    *url* from its path's extension, returning `None` if unknown."""
+    if not url.path:
+        return None
+    return mimetypes.guess_type(url.path[-1])[0]
+
+
+def cache_directives(headers):
+    """Return a dictionary of the ``Cache-Control`` directives in the
+    Twisted Web *headers*, mapping lowercased names to any arguments."""
+    directives = {}
+    for value in headers.getRawHeaders('Cache-Control', []):
+        for directive in value.split(','):
+            name, _, argument = directive.partition('=')
+            if name.strip():
+                directives[name.strip().lower()] = argument.strip().strip('"')
+    return directives
+
+
+def cache_lifetime(headers, now):
+    """Return the number of seconds a response with the Twisted Web
+    *headers*, received at the time *now*, stays fresh according to its
+    ``Cache-Control`` and ``Expires`` headers, or `None` if they don't
+    say.  Responses that must be revalidated before every use, or not
+    stored at all, have a lifetime of zero."""
+    directives = cache_directives(headers)
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+    if 'max-age' in directives:
+        try:
+            return max(int(directives['max-age']), 0)
+        except ValueError:
+            return 0
+    expires = headers.getRawHeaders('Expires')
+    if expires:
+        date = headers.getRawHeaders('Date')
+        try:
+            if date:
+                now = stringToDatetime(date[0])
+            return max(stringToDatetime(expires[0]) - now, 0)
+        except (IndexError, KeyError, ValueError):
+            # Invalid dates, such as "0", mean "already expired".
+            return 0
+    return None
+
+
+def validators(headers):
+    """Return a tuple of the ``ETag`` and ``Last-Modified`` values in
+    the Twisted Web *headers*, either of which may be `None`."""
+    return (headers.getRawHeaders('ETag', [None])[0],
+            headers.getRawHeaders('Last-Modified', [None])[0])
+
+
+def to_url(url):
+    """Return *url*, a Unicode string IRI, byte string URI, or Twisted
+    `URL`, as a Twisted `URL`."""
+    if isinstance(url, unicode):
+        return URL.fromText(url)
+    if isinstance(url, str):
+        return URL.fromText(url.decode('ascii'))
+    return url
+
+
+class BatchFetch(object):
+    """Fetches the title of each URL in *urls* with *fetch_title*, for
+    `TitleFetcher.fetch_titles`, which describes the arguments.
+
+    URLs are pulled from *urls* only while a fetch slot is free.  A URL
+    whose host already has *max_per_host* fetches running is set aside,
+    and the next one is pulled instead, so that a run of URLs for one
+    host doesn't hold up the others.  At most *max_concurrent* URLs are
+    set aside at once, after which pulling waits for a host to free up.
+    """
+
+    def __init__(self, fetch_title, urls, callback, max_concurrent,
+                 max_per_host):
+        self.fetch_title = fetch_title
+        self.urls = enumerate(urls)
+        self.callback = callback
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
+        #: The number of fetches running for each host.
+        self.running = {}
+        self.active = 0
+        #: ``(index, url, host)`` tuples set aside until *host* has room.
+        self.waiting = deque()
+        #: Whether a `Deferred` pulled from *urls* has yet to fire.
+        self.pulling = False
+        self.exhausted = False
+        self.error = None
+        self.filling = False
+        self.finished = Deferred()
+
+    def start(self):
+        """Start fetching, and return a `Deferred` that fires once every
+        URL has been handled."""
+        self.fill()
+        return self.finished
+
+    def report(self, index, result):
+        try:
+            self.callback(index, result)
+        except Exception:
+            log.err(None, 'Error handling the title of URL {}'.format(index))
+
+    def fill(self):
+        """Start as many fetches as there is room for."""
+        if self.filling:
+            # The loop already running picks up whatever changed.
+            return
+        self.filling = True
+        try:
+            while self.active < self.max_concurrent:
+                if self.start_waiting():
+                    continue
+                if (self.pulling or self.exhausted or
+                        len(self.waiting) >= self.max_concurrent):
+                    break
+                self.pull()
+        finally:
+            self.filling = False
+        if (self.exhausted and not (self.active or self.pulling or
+                                    self.waiting or self.finished.called)):
+            if self.error is None:
+                self.finished.callback(None)
+            else:
+                self.finished.errback(self.error)
+
+    def start_waiting(self):
+        """Start the first fetch set aside whose host now has room, and
+        return whether there was one."""
+        for item in self.waiting:
+            if self.running.get(item[2], 0) < self.max_per_host:
+                self.waiting.remove(item)
+                self.fetch(*item)
+                return True
+        return False
+
+    def pull(self):
+        try:
+            index, url = next(self.urls)
+        except StopIteration:
+            self.exhausted = True
+            return
+        except Exception:
+            self.error = Failure()
+            self.exhausted = True
+            return
+        if isinstance(url, Deferred):
+            self.pulling = True
+            url.addBoth(self.pulled, index)
+        else:
+            self.add(index, url)
+
+    def pulled(self, url, index):
+        self.pulling = False
+        if isinstance(url, Failure):
+            self.report(index, url)
+        elif url is not None:
+            self.add(index, url)
+        self.fill()
+
+    def add(self, index, url):
+        try:
+            url = to_url(url)
+            host = url.host
+        except Exception:
+            self.report(index, Failure())
+            return
+        self.waiting.append((index, url, host))
+
+    def fetch(self, index, url, host):
+        self.running[host] = self.running.get(host, 0) + 1
+        self.active += 1
+        fetching = maybeDeferred(self.fetch_title, url)
+        fetching.addBoth(self.fetched, index, host)
+
+    def fetched(self, result, index, host):
+        self.active -= 1
+        self.running[host] -= 1
+        if not self.running[host]:
+            del self.running[host]
+        self.report(index, result)
+        self.fill()
 
 
 class TitleFetcher(object):
-    """Does exactly what it says on the tin."""
+    """Does exactly what it says on the tin.
 
-    def __init__(self):
+    HTTP connections are kept alive and reused across requests through
+    *pool*, an `~twisted.web.client.HTTPConnectionPool`.  If *pool* is
+    not given, a new `ConnectionPool` with default limits is created.
+    Call `close` to shut down any idle connections when the fetcher is
+    no longer needed.
+
+    If *cache* is given, it is used to store results and answer repeat
+    requests for the same URL without touching the network.  It should
+    have the same interface as `~.cache.TitleCache`, except that its
+    methods may return `Deferred` objects, as `~.cache.SQLiteTitleCache`
+    does.
+
+    Requests to each host are throttled by a `ThrottlingAgent` with its
+    default limits: at most four at a time, started at an average of one
+    per second after an initial burst of five.  Adjust the attributes of
+    `throttle` to change that.
+    """
+
+    def __init__(self, pool=None, cache=None):
+        #: The connection pool shared by every request from this fetcher.
+        self.pool = pool or ConnectionPool(reactor)
+        #: The `CachingResolver` used to look up and vet hostnames.
+        self.resolve = CachingResolver()
+        #: The `PinnedEndpointFactory` used to connect to servers.  Its
+        #: ``timeout`` is the number of seconds to wait for a connection.
+        self.endpoint_factory = PinnedEndpointFactory(
+            reactor, self.resolve, timeout=10, observe=self.timed)
+        #: The `ThrottlingAgent` that limits the rate of requests to
+        #: each host.  Every hop of a redirect chain passes through it,
+        #: and waits for its response headers once it has been started.
+        self.throttle = ThrottlingAgent(BlacklistingAgent(
+            Agent.usingEndpointFactory(
+                reactor, self.endpoint_factory, pool=self.pool),
+            resolve=self.resolve_timed))
         #: The Twisted Web `Agent` used to make HTTP requests.
-        self.agent = ContentDecoderAgent(
-            RedirectAgent(BlacklistingAgent(Agent(reactor))),
-            [('gzip', GzipDecoder)])
-        #: A dictionary of extractors enabled for this fetcher.
+        self.agent = ContentDecoderAgent(RedirectAgent(self.throttle),
+                                         content_decoders())
+        #: The `~twisted.internet.interfaces.IReactorTime` provider used
+        #: to enforce timeouts.
+        self.clock = reactor
+        #: The default number of seconds a fetch may take in total,
+        #: including redirects, or `None` for no limit.
+        self.timeout = 60
+        self.headers_timeout = 20
+        #: The number of seconds to wait for each response's body to
+        #: arrive, or for an extractor to read as much as it wants.
+        self.body_timeout = 20
+        #: A mapping from content types to the extractors enabled for
+        #: this fetcher, usually an `ExtractorRegistry`.
         self.extractors = default_extractors
         #: The maximum number of "soft" redirects to follow per request.
         self.max_soft_redirects = 2
+        #: Whether to ask for only the start of documents whose URL
+        #: suggests a content type handled by an extractor with a true
+        #: ``range_requests`` attribute, using a ``Range`` header bounded
+        #: by that extractor's ``max_download_bytes``.
+        self.range_requests = True
+        #: Bodies of documents with no extractor that are known to be no
+        #: longer than this many bytes are read and thrown away, so that
+        #: their connection can be reused.  Longer or unknown-length
+        #: bodies are cut off as soon as their headers arrive.
+        self.max_discard_bytes = 16384
+        #: A set of hostnames, as Unicode strings, known to serve large
+        #: files.  Documents on these hosts are checked with a ``HEAD``
+        #: request first, and only fetched with ``GET`` if an extractor
+        #: can handle their content type.
+        self.head_first_hosts = set()
+        #: An optional `~.cache.TitleCache` or `~.cache.SQLiteTitleCache`
+        #: consulted before fetching.
+        self.cache = cache
+        #: An optional `~.cache.RedirectCache` of permanent and soft
+        #: redirects, which later fetches jump straight past.
+        self.redirects = RedirectCache()
+        #: A list of `~.metrics.IFetchObserver` providers told about the
+        #: progress of every fetch, such as `~.metrics.FetchMetrics`.
+        self.observers = []
+        #: An optional `AdmissionQueue` that fetches must pass through,
+        #: unless they can be answered from the cache or share a fetch
+        #: already in flight.
+        self.admission = None
+        # Maps normalized URLs being fetched to a tuple of the Deferred
+        # for the underlying fetch, its Deadline, and a list of Deferreds
+        # waiting on it.
+        self._in_flight = {}
 
-    @inlineCallbacks
-    def fetch_title(self, url, hostname_tag=False, friendly_errors=False):
+    @property
+    def headers_timeout(self):
+        """The number of seconds to wait for each response's headers
+        once `throttle` has started its request, including the time
+        taken to look up the host and connect, but not any time spent
+        waiting in the throttle's queue."""
+        return self.throttle.headers_timeout
+
+    @headers_timeout.setter
+    def headers_timeout(self, value):
+        self.throttle.headers_timeout = value
+
+    def fetch_title(self, url, hostname_tag=False, friendly_errors=False,
+                    timeout=None, priority='default'):
         """Fetch the document at *url* and return a `Deferred` yielding
         the document title or summary as a Unicode string.  *url* may be
         a Unicode string IRI, a byte string URI, or a Twisted `URL`.
@@ -177,63 +1815,418 @@ class TitleFetcher(object):
         If *friendly_errors* is true, catch common connection errors and
         return a description of the error as the extracted title instead
         of reraising.  Otherwise, all errors bubble to the caller.
+
+        If *timeout* is given, give up with a `FetchTimeout` for the
+        ``'call'`` phase after that many seconds, even if the fetch
+        itself, which may be shared with other callers, is allowed to
+        take up to `timeout` seconds.
+
+        If this fetcher has an `admission` queue, the fetch waits in it
+        under the class *priority*, one of `PRIORITIES`, and fails with
+        `Overloaded` if it is shed.  Cancelling the returned `Deferred`
+        while the fetch is queued frees its place in the queue.
         """
+        # Older versions of Twisted don't pass cancellation on to the
+        # Deferred an inlineCallbacks generator is waiting on, so keep
+        # track of it here.
+        waiting = []
+        titled = Deferred(lambda _: waiting and waiting[-1].cancel())
+        def fire(result):
+            # A canceller that couldn't stop the fetch has already
+            # failed titled; drop whatever the fetch ends with.
+            if not titled.called:
+                titled.callback(result)
+        self._fetch_title(url, hostname_tag, friendly_errors, timeout,
+                          priority, waiting).addBoth(fire)
+        return titled
+
+    @inlineCallbacks
+    def _fetch_title(self, url, hostname_tag, friendly_errors, timeout,
+                     priority, waiting):
+        url = to_url(url)
+        key = url.asURI().asText()
+        cached = None
+        if self.cache is not None:
+            waiting.append(maybeDeferred(self.cache.get, key))
+            cached = yield waiting[-1]
+        if cached is None or (cached.error and not friendly_errors):
+            admitted = False
+            try:
+                if self.admission is not None and key not in self._in_flight:
+                    waiting.append(self.admission.acquire(priority))
+                    yield waiting[-1]
+                    admitted = True
+                fetching = self.fetch_shared(key, url)
+                if timeout is not None:
+                    fetching = Deadline(self.clock).limit(fetching, timeout,
+                                                          'call')
+                waiting.append(fetching)
+                cached = yield fetching
+            except Exception:
+                failure = Failure()
+                if failure.check(Overloaded):
+                    self.report('fetch_failed', 'overloaded')
+                description = describe_error(failure)
+                if description is failure or not friendly_errors:
+                    failure.raiseException()
+                cached = CachedTitle(description, None, True)
+            finally:
+                if admitted:
+                    self.admission.release()
+        title = cached.title
+        if hostname_tag:
+            tag = url.host
+            if cached.final_host is not None and cached.final_host != tag:
+                tag = u'{} \u2192 {}'.format(tag, cached.final_host)
+            title = u'[{}] {}'.format(tag, title)
+        returnValue(title)
+
+    def fetch_titles(self, urls, callback, max_concurrent=16,
+                     max_per_host=4, **kwargs):
+        """Fetch the title of each URL in the iterable *urls*, with at
+        most *max_concurrent* fetches in flight at once and at most
+        *max_per_host* of those to any single host.  Keyword arguments
+        are passed on to `fetch_title`.
+
+        *urls* is consumed lazily, one item at a time as fetch slots
+        become available, so it may be an unbounded iterator.  Items may
+        also be `Deferred` objects yielding a URL, to allow URLs to come
+        from an asynchronous source; any that yield `None` are skipped.
+        URLs for a host that already has as many fetches as it may are
+        set aside, so that they don't hold up other hosts.
+
+        As each fetch finishes, *callback* is called with two arguments:
+        the URL's index in *urls*, and either the title or a `Failure`,
+        which is also what an item that fails to yield a URL gets.
+        Results are reported in order of completion, not input order.
+        Errors raised by *callback* are logged.  Return a `Deferred` that
+        fires once every URL has been handled.
+        """
+        return BatchFetch(partial(self.fetch_title, **kwargs), urls,
+                          callback, max_concurrent, max_per_host).start()
+
+    def fetch_shared(self, key, url):
+        """Return a `Deferred` yielding a `~.cache.CachedTitle` for the
+        Twisted `URL` *url*, which has the normalized form *key*.
+
+        Concurrent calls with the same *key* share a single underlying
+        fetch, whose result is fanned out to every caller.  Cancelling
+        the `Deferred` returned to one caller does not affect the
+        others; the underlying fetch is only cancelled once every
+        caller has given up on it.
+        """
+        try:
+            fetching, deadline, waiters = self._in_flight[key]
+        except KeyError:
+            deadline = Deadline(self.clock, self.timeout)
+            fetching = self._fetch_and_cache(key, url, deadline)
+            if fetching.called:
+                # Nothing to share; the result is already here.
+                return fetching
+            waiters = []
+            self._in_flight[key] = (fetching, deadline, waiters)
+            fetching.addBoth(self._fan_out, key)
+        def cancel(waiter):
+            waiters.remove(waiter)
+            if not waiters:
+                deadline.cancel()
+                fetching.cancel()
+        waiter = Deferred(cancel)
+        waiters.append(waiter)
+        return waiter
+
+    def _fan_out(self, result, key):
+        _, _, waiters = self._in_flight.pop(key)
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    @inlineCallbacks
+    def _fetch_and_cache(self, key, url, deadline):
+        stale = None
+        if self.cache is not None:
+            stale = yield self.cache.get_stale(key)
+        started = self.clock.seconds()
+        try:
+            cached = yield self.fetch_untagged(url, deadline, stale)
+        except Exception:
+            failure = Failure()
+            self.report('phase_finished', 'fetch',
+                        self.clock.seconds() - started)
+            self.report('fetch_failed',
+                        classify_error(failure) or failure.type.__name__)
+            description = describe_error(failure)
+            if self.cache is not None and description is not failure:
+                yield self.cache.put(key, CachedTitle(description, None, True))
+            failure.raiseException()
+        self.report('phase_finished', 'fetch', self.clock.seconds() - started)
+        if self.cache is not None:
+            yield self.cache.put(key, cached)
+        returnValue(cached)
+
+    @inlineCallbacks
+    def fetch_untagged(self, url, deadline=None, stale=None):
+        """Fetch the document at the Twisted `URL` *url*, following any
+        soft redirects, and return a `Deferred` yielding a
+        `~.cache.CachedTitle` for it, carrying the document's validators
+        and freshness lifetime.  Errors are never caught.  The fetch is
+        timed with *deadline*, which defaults to a new `Deadline` that
+        expires after `timeout` seconds.  Redirects remembered in
+        `redirects` are skipped, and any new ones are added to it.
+
+        If *stale* is a `~.cache.CachedTitle` with validators, the
+        request is made conditional on them, and if the server answers
+        that the document hasn't changed, *stale* is returned with its
+        freshness updated instead of fetching the document again.
+        """
+        if deadline is None:
+            deadline = Deadline(self.clock, self.timeout)
+        headers = None
+        if stale is not None and (stale.etag or stale.last_modified):
+            headers = Headers()
+            if stale.etag:
+                headers.addRawHeader('If-None-Match', stale.etag)
+            if stale.last_modified:
+                headers.addRawHeader('If-Modified-Since', stale.last_modified)
         title = None
-        if isinstance(url, unicode):
-            url = URL.fromText(url)
-        elif isinstance(url, str):
-            url = URL.fromText(url.decode('ascii'))
         current = url
+        skipped_soft = False
+        if self.redirects is not None:
+            source = url.asURI().asText()
+            target, skipped_soft = self.redirects.resolve(source)
+            if target != source:
+                current = URL.fromText(target)
         response = None
-        for _ in xrange(self.max_soft_redirects):
+        for soft_redirects in xrange(self.max_soft_redirects):
             last_response = response
-            # This encoding should be safe, since asURI() only returns
-            # URIs with ASCII code points.
-            request = self.agent.request(
-                'GET', current.asURI().asText().encode('ascii'))
-            if friendly_errors:
-                request.addErrback(describe_error)
-            response = yield request
-            if isinstance(response, basestring):
-                # We got an error message from describe_error.  Bail.
-                title = response
-                break
+            response = yield self.request(current, deadline, headers)
             response.setPreviousResponse(last_response)
-            content_type = cgi.parse_header(
-                response.headers.getRawHeaders('Content-Type', [''])[0])[0]
+            if response.code == 304 and headers is not None:
+                self.discard(response, deadline)
+                etag, last_modified = validators(response.headers)
+                self.report('fetch_succeeded', None)
+                returnValue(stale._replace(
+                    etag=etag or stale.etag,
+                    last_modified=last_modified or stale.last_modified,
+                    max_age=cache_lifetime(response.headers,
+                                           self.clock.seconds())))
+            # Validators only make sense for the URL they came from.
+            headers = None
+            content_type = response_content_type(response)
             if content_type in self.extractors:
                 extractor = self.extractors[content_type]
-                extracted = yield extractor.extract(response)
+                body = deadline.limit_body(response, self.body_timeout)
+                observing = bool(self.observers)
+                if observing:
+                    body = CountingResponse(body, self.clock)
+                    started = self.clock.seconds()
+                try:
+                    extracted = yield extractor.extract(body)
+                finally:
+                    if observing:
+                        self.report_extraction(body, started)
+                deadline.check()
                 if isinstance(extracted, Redirect):
-                    current = URL.fromText(
-                        response.request.absoluteURI.decode('ascii')).click(
-                        extracted.location)
+                    source = URL.fromText(
+                        response.request.absoluteURI.decode('ascii'))
+                    current = source.click(extracted.location)
+                    if self.redirects is not None:
+                        self.redirects.put(source.asURI().asText(),
+                                           current.asURI().asText())
                     continue
                 title = extracted
+            else:
+                # There's no need to wait for this; the title only
+                # depends on the headers.
+                self.discard(response, deadline, self.max_discard_bytes)
             # The only case where we'd want to loop again is when the
             # response returned is a soft redirect.
             break
         else:
-            if friendly_errors:
-                title = u'Encountered too many redirects.'
-            else:
-                raise ResponseFailed([Failure(InfiniteRedirection(
-                    599, 'Too many soft redirects',
-                    location=current.asURI().asText().encode('ascii')))])
+            raise ResponseFailed([Failure(InfiniteRedirection(
+                599, 'Too many soft redirects',
+                location=current.asURI().asText().encode('ascii')))])
         if title is None:
             title = u'{} document'.format(content_type or u'Unknown')
             if response.length is not UNKNOWN_LENGTH:
                 title += u' ({})'.format(filesize(response.length))
-        if hostname_tag:
-            tag = url.host
-            if isinstance(response, Response):
-                initial = url.host
-                final = URL.fromText(
-                    response.request.absoluteURI.decode('ascii')).host
-                if initial != final:
-                    tag = u'{} \u2192 {}'.format(initial, final)
-            title = u'[{}] {}'.format(tag, title)
-        returnValue(title)
+        self.report('fetch_succeeded', content_type)
+        final_host = URL.fromText(
+            response.request.absoluteURI.decode('ascii')).host
+        etag = last_modified = None
+        if soft_redirects == 0 and not skipped_soft and (
+                'no-store' not in cache_directives(response.headers)):
+            # After a soft redirect, the validators belong to a different
+            # document from the one that would be requested next time,
+            # once the redirect has been forgotten.
+            etag, last_modified = validators(response.headers)
+        returnValue(CachedTitle(
+            title, final_host, False, etag, last_modified,
+            cache_lifetime(response.headers, self.clock.seconds())))
+
+    def discard(self, response, deadline, max_bytes=0):
+        """Throw away the body of *response* with `discard_body`, within
+        the limits of *deadline* and `body_timeout`, and report the
+        number of bytes read to `observers`."""
+        discarding = discard_body(
+            deadline.limit_body(response, self.body_timeout), max_bytes)
+        if self.observers:
+            discarding.addCallback(
+                lambda received: self.report('bytes_received', 0, received))
+        return discarding
+
+    def report_extraction(self, response, started):
+        """Report the time taken to run an extractor on the
+        `CountingResponse` *response* from *started* onward, and the
+        time taken and bytes read by the part of the body it saw, to
+        `observers`."""
+        counter = response.counter
+        if counter is not None:
+            if counter.last_received is not None:
+                self.report('phase_finished', 'body',
+                            counter.last_received - started)
+            self.report('bytes_received', counter.received, 0)
+        self.report('phase_finished', 'extract', self.clock.seconds() - started)
+
+    def range_for(self, content_type):
+        """Return the number of bytes to request from the start of a
+        document with the MIME *content_type*, or `None` to request all
+        of it."""
+        extractor = self.extractors.get(content_type)
+        if (not self.range_requests or
+                not getattr(extractor, 'range_requests', False)):
+            return None
+        return extractor.max_download_bytes
+
+    @inlineCallbacks
+    def request(self, url, deadline, headers=None):
+        """Issue a GET request for the Twisted `URL` *url* with any extra
+        *headers* and return a `Deferred` yielding the response.  Each
+        request waits at most `headers_timeout` seconds once `throttle`
+        starts it, or until *deadline* runs out.
+
+        If *url*'s host is in `head_first_hosts`, a HEAD request is sent
+        first, and its response is returned instead if no extractor
+        handles the content type it reports.
+
+        If `range_for` says so, only the start of the document is asked
+        for, using the content type reported by any HEAD request or else
+        guessed from *url*.  A partial response is passed on with its
+        ``length`` set to the length of the complete document, as
+        extractors expect, as long as it contains everything the
+        extractor for its actual content type wants.  Otherwise, the
+        whole document is requested again without a ``Range`` header.
+        """
+        # This encoding should be safe, since asURI() only returns URIs
+        # with ASCII code points.
+        uri = url.asURI().asText().encode('ascii')
+        content_type = guess_content_type(url)
+        if url.host in self.head_first_hosts:
+            head = yield self._send('HEAD', uri, headers, deadline)
+            if head.code < 400:
+                content_type = response_content_type(head)
+                if content_type not in self.extractors:
+                    # Twisted reports a length of zero for every HEAD
+                    # response, so use the one the server sent.
+                    content_length = head.headers.getRawHeaders(
+                        'Content-Length', [''])[0]
+                    head.length = (int(content_length)
+                                   if content_length.isdigit()
+                                   else UNKNOWN_LENGTH)
+                    returnValue(head)
+                # Skip any redirects the HEAD request already followed.
+                uri = head.request.absoluteURI
+        range_bytes = self.range_for(content_type)
+        if range_bytes is None:
+            response = yield self._send('GET', uri, headers, deadline)
+            returnValue(response)
+        range_headers = Headers() if headers is None else headers.copy()
+        range_headers.setRawHeaders(
+            'Range', ['bytes=0-{}'.format(range_bytes - 1)])
+        response = yield self._send('GET', uri, range_headers, deadline)
+        if response.code == 206:
+            content_range = parse_content_range(
+                response.headers.getRawHeaders('Content-Range', [''])[0])
+            if content_range is not None and content_range[0] == 0:
+                _, last, length = content_range
+                extractor = self.extractors.get(
+                    response_content_type(response))
+                wanted = (getattr(extractor, 'max_download_bytes', 0)
+                          if extractor is not None else 0)
+                if last + 1 == length or last + 1 >= wanted:
+                    response.length = (UNKNOWN_LENGTH if length is None
+                                       else length)
+                    returnValue(response)
+        elif response.code != 416:
+            returnValue(response)
+        # Either the range wasn't satisfiable, or the partial response
+        # isn't enough.  Read what was sent, so that the connection can
+        # go back to the pool, and start over.
+        discarded = yield read_body(
+            deadline.limit_body(response, self.body_timeout))
+        self.report('bytes_received', 0, len(discarded))
+        deadline.check()
+        response = yield self._send('GET', uri, headers, deadline)
+        returnValue(response)
+
+    def _send(self, method, uri, headers, deadline):
+        # The throttle times the headers of each request it starts, so
+        # that waiting in its queue doesn't count against them.
+        sending = deadline.limit(self.agent.request(method, uri, headers),
+                                 None)
+        if self.redirects is not None:
+            sending.addCallback(self.remember_redirects)
+        return self.timed('headers', sending)
+
+    def remember_redirects(self, response):
+        """Add every hard redirect followed on the way to *response* to
+        `redirects`, and return *response*."""
+        now = self.clock.seconds()
+        target = response
+        while True:
+            source = getattr(target, 'previousResponse', None)
+            if source is None:
+                break
+            self.redirects.put(
+                source.request.absoluteURI.decode('ascii'),
+                target.request.absoluteURI.decode('ascii'),
+                source.code, cache_lifetime(source.headers, now))
+            target = source
+        return response
+
+    def report(self, event, *args):
+        """Call the method named *event* of each of `observers` with
+        *args*, logging any exceptions raised."""
+        for observer in self.observers:
+            try:
+                getattr(observer, event)(*args)
+            except Exception:
+                log.err(None, 'Error reporting {} to {!r}'.format(
+                    event, observer))
+
+    def timed(self, phase, deferred):
+        """Return *deferred*, after arranging for the time it takes to
+        fire to be reported to `observers` as *phase*."""
+        if not self.observers:
+            return deferred
+        started = self.clock.seconds()
+        def finished(result):
+            self.report('phase_finished', phase,
+                        self.clock.seconds() - started)
+            return result
+        return deferred.addBoth(finished)
+
+    def resolve_timed(self, hostname):
+        """Look up *hostname* with `resolve`, reporting the time it takes
+        to `observers`."""
+        return self.timed('resolve', self.resolve(hostname))
+
+    def close(self):
+        """Close all idle connections in this fetcher's pool, and
+        return a `Deferred` that fires once they have been closed."""
+        return self.pool.closeCachedConnections()
 
 
 #
@@ -242,10 +2235,12 @@ class TitleFetcher(object):
 
 fetcher = None
 def get_fetcher():
-    """Return a default `TitleFetcher`."""
+    """Return a default `TitleFetcher`, whose idle connections are
+    closed when the reactor shuts down."""
     global fetcher
     if fetcher is None:
         fetcher = TitleFetcher()
+        reactor.addSystemEventTrigger('before', 'shutdown', fetcher.close)
     return fetcher
 
 
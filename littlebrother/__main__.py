@@ -2,44 +2,306 @@
 
 
 import argparse
-from itertools import imap
 import locale
 import sys
 
-from twisted.internet.defer import DeferredList
+from twisted.internet.defer import Deferred, DeferredQueue, succeed
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.internet.stdio import StandardIO
 from twisted.internet.task import react
+from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
+from twisted.web.server import Site
+from zope.interface import implements
 
-from . import fetch_title
+from . import ExtractorRegistry, get_fetcher
+from .cache import SQLiteTitleCache
+from .executors import (InlineExecutor, ProcessExecutor, ThreadExecutor,
+                        set_default_executor)
+from .metrics import FetchMetrics, MetricsExporter
+from .service import ServiceResource, TitleService
 
 
-def print_and_exit(results):
-    """Print each result and stop the reactor."""
-    for success, value in results:
-        if success:
-            print value.encode(locale.getpreferredencoding())
+class Console(LineReceiver):
+    """A protocol for standard I/O that reads URIs, one per line, and
+    writes titles back out.  It can be iterated over to get `Deferred`
+    objects yielding each URI read, as `TitleFetcher.fetch_titles`
+    expects, so that input is consumed only as fast as it is fetched."""
+    implements(IHalfCloseableProtocol)
+
+    delimiter = '\n'
+    MAX_LENGTH = 65536
+    #: Stop reading input while this many URIs are waiting to be fetched.
+    max_pending = 256
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.uris = DeferredQueue()
+        self.reading = True
+        self.paused = False
+        #: A `Deferred` that fires once the console has been closed.
+        self.closed = Deferred()
+
+    def lineReceived(self, line):
+        uri = line.strip()
+        if not uri:
+            return
+        self.uris.put(uri.decode(self.encoding))
+        if not self.paused and len(self.uris.pending) >= self.max_pending:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def lineLengthExceeded(self, line):
+        # Skip it, rather than dropping the connection as LineReceiver
+        # does by default.
+        pass
+
+    def readConnectionLost(self):
+        remaining = self.clearLineBuffer()
+        if remaining:
+            self.lineReceived(remaining)
+        self.reading = False
+        # Tell anyone still waiting for a URI that none are coming.
+        while self.uris.waiting:
+            self.uris.put(None)
+
+    def writeConnectionLost(self):
+        pass
+
+    def connectionLost(self, reason):
+        self.closed.callback(None)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.reading and not self.uris.pending:
+            raise StopIteration
+        uri = self.uris.get()
+        if self.paused and len(self.uris.pending) <= self.max_pending // 2:
+            self.paused = False
+            self.transport.resumeProducing()
+        return uri
+
+    def write_result(self, result):
+        """Write a title, or the traceback of a failed fetch."""
+        if isinstance(result, Failure):
+            result.printTraceback()
         else:
-            value.printTraceback()
+            self.transport.write(result.encode(self.encoding) + '\n')
+
+
+class ReorderBuffer(object):
+    """Passes results to *output* in index order, holding on to those
+    that finish early.  At most *window* indices past the oldest result
+    not yet output are allowed to be in flight at once; `wait_for_room`
+    holds back the rest."""
+
+    def __init__(self, output, window):
+        self.output = output
+        self.window = window
+        self.next_index = 0
+        self.results = {}
+        self.waiting = {}
+
+    def wait_for_room(self, index):
+        """Return a `Deferred` that fires once *index* falls inside the
+        window of results allowed in flight."""
+        if index < self.next_index + self.window:
+            return succeed(None)
+        self.waiting[index] = Deferred()
+        return self.waiting[index]
+
+    def add(self, index, result):
+        """Add the *result* for *index*, and output every result that is
+        now ready in order."""
+        self.results[index] = result
+        while self.next_index in self.results:
+            self.output(self.results.pop(self.next_index))
+            self.next_index += 1
+        for index in sorted(self.waiting):
+            if index >= self.next_index + self.window:
+                break
+            self.waiting.pop(index).callback(None)
+
+
+def windowed(uris, reorder_buffer):
+    """Yield a `Deferred` for each item of *uris* that fires with that
+    item once *reorder_buffer* has room for it."""
+    for index, uri in enumerate(uris):
+        room = reorder_buffer.wait_for_room(index)
+        room.addCallback(lambda _, uri=uri: uri)
+        yield room
+
+
+def add_fetcher_arguments(parser):
+    """Add options for setting up the title fetcher to the argument
+    *parser*."""
+    parser.add_argument(
+        '--parse-with', choices=('inline', 'threads', 'processes'),
+        default='inline',
+        help='where to run CPU-bound document parsing '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--parse-workers', type=int, default=None, metavar='N',
+        help='use N threads or processes for parsing (default: 4 '
+             'threads or one process per CPU)')
+    parser.add_argument(
+        '--no-plugin-scan', action='store_true',
+        help='use only the built-in title extractors, without searching '
+             'for third-party plugins')
+    parser.add_argument(
+        '--cache', metavar='FILE',
+        help='keep fetched titles in the SQLite database FILE, which '
+             'may be shared with other processes')
+    parser.add_argument(
+        '--metrics', metavar='FILE',
+        help='write fetch timings and counts to FILE periodically')
+    parser.add_argument(
+        '--metrics-format', choices=('prometheus', 'json'),
+        default='prometheus',
+        help='write metrics in the Prometheus text format, replacing FILE, '
+             'or append them as JSON lines (default: %(default)s)')
+    parser.add_argument(
+        '--metrics-interval', type=float, default=60, metavar='SECONDS',
+        help='write metrics every SECONDS seconds (default: %(default)s)')
+
+
+def set_up_fetcher(reactor, args):
+    """Return the default `.TitleFetcher`, set up according to the
+    options added by `add_fetcher_arguments` and parsed into *args*,
+    and a function to call once it is no longer needed."""
+    if args.parse_with == 'threads':
+        executor = ThreadExecutor(args.parse_workers or 4, reactor=reactor)
+    elif args.parse_with == 'processes':
+        executor = ProcessExecutor(args.parse_workers, reactor=reactor)
+    else:
+        executor = InlineExecutor()
+    set_default_executor(executor)
+    fetcher = get_fetcher()
+    if args.no_plugin_scan:
+        fetcher.extractors = ExtractorRegistry(scan_plugins=False)
+    if args.cache:
+        fetcher.cache = SQLiteTitleCache(args.cache, clock=reactor)
+    exporter = None
+    if args.metrics:
+        metrics = FetchMetrics()
+        fetcher.observers.append(metrics)
+        exporter = MetricsExporter(
+            metrics, args.metrics, format=args.metrics_format,
+            interval=args.metrics_interval, clock=reactor)
+        exporter.start()
+    def tear_down():
+        executor.close()
+        if args.cache:
+            fetcher.cache.close()
+        if exporter is not None:
+            exporter.stop()
+    return fetcher, tear_down
+
+
+def serve(reactor, argv):
+    """Command line entry point for the HTTP title service."""
+    parser = argparse.ArgumentParser(
+        prog='python -m littlebrother serve',
+        description='Run an HTTP service that fetches titles and returns '
+                    'them as JSON.',
+        epilog='GET /title?url=URL fetches one title.  POST a JSON array '
+               'of URLs to /titles to fetch many, with results streamed '
+               'back as newline-delimited JSON.  GET /status reports the '
+               'load on the service.')
+    parser.add_argument(
+        '-p', '--port', type=int, default=8080,
+        help='listen on PORT (default: %(default)s)')
+    parser.add_argument(
+        '--interface', default='127.0.0.1', metavar='ADDRESS',
+        help='listen on the interface with ADDRESS (default: %(default)s)')
+    parser.add_argument(
+        '-j', '--concurrency', type=int, default=64, metavar='N',
+        help='fetch at most N URIs at once (default: %(default)s)')
+    parser.add_argument(
+        '--max-queued', type=int, default=1024, metavar='N',
+        help='queue at most N more URIs, refusing requests with 503 '
+             'Service Unavailable beyond that (default: %(default)s)')
+    parser.add_argument(
+        '--max-age', type=float, default=10, metavar='SECONDS',
+        help='shed URIs that have been queued for SECONDS seconds '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--max-batch', type=int, default=1000, metavar='N',
+        help='accept at most N URIs per batch request '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--timeout', type=float, default=None, metavar='SECONDS',
+        help='give up on each lookup after SECONDS seconds (default: the '
+             'fetcher\'s own timeouts)')
+    add_fetcher_arguments(parser)
+    args = parser.parse_args(argv)
+    fetcher, tear_down = set_up_fetcher(reactor, args)
+    service = TitleService(fetcher, max_concurrent=args.concurrency,
+                           max_queued=args.max_queued, max_age=args.max_age,
+                           timeout=args.timeout, clock=reactor)
+    reactor.listenTCP(args.port,
+                      Site(ServiceResource(service, args.max_batch)),
+                      interface=args.interface)
+    reactor.addSystemEventTrigger('before', 'shutdown', tear_down)
+    # Run until interrupted.
+    return Deferred()
 
 
 def main(reactor):
     """Main command line entry point."""
+    if sys.argv[1:2] == ['serve']:
+        return serve(reactor, sys.argv[2:])
     parser = argparse.ArgumentParser(
         description='Fetch a URI or series of URIs and print a title '
                     'or summary for each.',
         epilog='If no URIs are passed on the command line, they are '
-               'read from standard input, one per line.')
+               'read from standard input, one per line.  Run "python -m '
+               'littlebrother serve --help" for the HTTP title service.')
     parser.add_argument(
         'uris', metavar='URI', nargs='*', help='URI to fetch')
     parser.add_argument(
         '-H', '--hostname-tag', action='store_true',
         help='prefix titles with a hostname tag')
+    parser.add_argument(
+        '-j', '--concurrency', type=int, default=16, metavar='N',
+        help='fetch at most N URIs at once (default: %(default)s)')
+    parser.add_argument(
+        '--per-host', type=int, default=4, metavar='N',
+        help='fetch at most N URIs from one host at once '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-u', '--unordered', action='store_true',
+        help='print titles as soon as they are fetched, instead of in '
+             'the order the URIs were given')
+    add_fetcher_arguments(parser)
     args = parser.parse_args()
-    uris = args.uris or imap(lambda x: x.strip(), sys.stdin)
-    finished = DeferredList([
-        fetch_title(uri.decode(locale.getpreferredencoding()),
-                    hostname_tag=args.hostname_tag, friendly_errors=True)
-        for uri in uris])
-    finished.addCallback(print_and_exit)
+    fetcher, tear_down = set_up_fetcher(reactor, args)
+    encoding = locale.getpreferredencoding()
+    console = Console(encoding)
+    StandardIO(console, reactor=reactor)
+    if args.uris:
+        console.transport.pauseProducing()
+        uris = [uri.decode(encoding) for uri in args.uris]
+    else:
+        uris = console
+    if args.unordered:
+        callback = lambda index, result: console.write_result(result)
+    else:
+        reorder_buffer = ReorderBuffer(console.write_result,
+                                       window=4 * args.concurrency)
+        uris = windowed(uris, reorder_buffer)
+        callback = reorder_buffer.add
+    finished = fetcher.fetch_titles(
+        uris, callback,
+        max_concurrent=args.concurrency, max_per_host=args.per_host,
+        hostname_tag=args.hostname_tag, friendly_errors=True)
+    @finished.addCallback
+    def close(_):
+        tear_down()
+        console.transport.loseConnection()
+        return console.closed
     return finished
 
 
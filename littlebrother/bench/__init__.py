@@ -0,0 +1,5 @@
+"""Benchmarks for Little Brother.
+
+`.pipeline` drives a real `.TitleFetcher` against the synthetic
+documents served by `.server`, over loopback connections.
+"""
@@ -0,0 +1,400 @@
+"""Measure the CPU cost of each title extractor, and check it against a
+stored baseline.
+
+Run ``python -m littlebrother.bench.extractors --help`` for options.
+Each benchmark case is a document, either one recorded in the test
+suite's cassettes or one generated here to stress a parser, which is fed
+straight from memory into the `extract` method of the extractor for its
+content type through a `PayloadResponse`, with CPU-bound parsing run
+inline.  No network or reactor time is counted, except for the thread
+hand-off of extractors that parse in a thread pool while data arrives.
+
+Timings are divided by the time taken by a fixed pure-Python workload
+on the same machine, so that a baseline recorded on one computer means
+something on another.  Allocations are counted as the number of
+garbage-collected objects still alive after one extraction, and, where
+`tracemalloc` is available, the peak number of bytes allocated during
+it.
+"""
+
+
+from __future__ import division
+import argparse
+import base64
+from collections import namedtuple
+import gc
+import glob
+import io
+import json
+import os.path
+import sys
+import timeit
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.error import ConnectionAborted
+from twisted.internet.task import react
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IResponse
+from zope.interface import implements
+
+from .. import ExtractorRegistry
+from ..executors import InlineExecutor, set_default_executor
+from .server import mp3_payload, png_payload
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+#: The directory holding the test suite's recorded HTTP interactions.
+CASSETTE_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test', 'fixtures', 'cassettes')
+
+#: The baseline file checked by default.
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'baseline.json')
+
+
+#
+# Payloads
+#
+
+#: A document to benchmark.  *length* is the length the fake response
+#: claims, which may be more than the length of *body* if the document
+#: was truncated when it was recorded, or `UNKNOWN_LENGTH`.
+Case = namedtuple('Case', ['name', 'content_type', 'body', 'length'])
+
+
+class PayloadTransport(object):
+    """The transport given to the body protocol of a `PayloadResponse`,
+    which only notes when it is asked to stop."""
+
+    def __init__(self):
+        self.stopped = False
+
+    def loseConnection(self):
+        self.stopped = True
+
+    stopProducing = loseConnection
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+
+class PayloadResponse(object):
+    """A Twisted Web response to a request for the benchmark *case*,
+    whose body is delivered *chunk_size* bytes at a time as soon as
+    `deliverBody` is called, until the body protocol stops it."""
+    implements(IResponse)
+
+    version = ('HTTP', 1, 1)
+    code = 200
+    phrase = 'OK'
+    request = None
+    previousResponse = None
+
+    def __init__(self, case, chunk_size=16384):
+        self.headers = Headers({'Content-Type': [case.content_type]})
+        self.length = case.length
+        # Slice the body now, so that slicing isn't counted.
+        self.chunks = [case.body[i:i + chunk_size]
+                       for i in xrange(0, len(case.body), chunk_size)]
+
+    def deliverBody(self, protocol):
+        transport = PayloadTransport()
+        protocol.makeConnection(transport)
+        for chunk in self.chunks:
+            if transport.stopped:
+                protocol.connectionLost(Failure(ConnectionAborted()))
+                return
+            protocol.dataReceived(chunk)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+    def setPreviousResponse(self, response):
+        self.previousResponse = response
+
+
+def cassette_cases(directory=CASSETTE_DIRECTORY):
+    """Return a list of benchmark cases for the first response recorded
+    in each cassette file under *directory*, named after the file."""
+    cases = []
+    for path in sorted(glob.glob(os.path.join(directory, '*', '*.json'))):
+        with open(path, 'rb') as f:
+            response = json.load(f)['http_interactions'][0]['response']
+        body = response['body']
+        if 'base64_string' in body:
+            body = base64.b64decode(body['base64_string'])
+        else:
+            body = body['string'].encode(body.get('encoding') or 'utf-8')
+        headers = response['headers']
+        length = headers.get('Content-Length')
+        kind = os.path.basename(os.path.dirname(path))
+        name = os.path.splitext(os.path.basename(path))[0]
+        cases.append(Case(
+            'cassette/{}/{}'.format(kind, name),
+            headers.get('Content-Type', [''])[0], body,
+            int(length[0]) if length else len(body)))
+    return cases
+
+
+def html_case(name, markup):
+    return Case('html/' + name, 'text/html; charset=utf-8', markup,
+                len(markup))
+
+
+def image_case(name, image, image_format, content_type, truncate=None,
+               **params):
+    """Return a benchmark case for the Pillow *image* saved in
+    *image_format*, keeping only the first *truncate* bytes if given but
+    claiming the full length."""
+    output = io.BytesIO()
+    image.save(output, image_format, **params)
+    body = output.getvalue()
+    return Case('image/' + name, content_type, body[:truncate], len(body))
+
+
+def synthetic_cases():
+    """Return a list of generated benchmark cases, each meant to be hard
+    on one extractor in some way.  Cases that need Pillow are left out
+    if it isn't installed."""
+    cases = [
+        html_case('huge-inline-script',
+                  '<!DOCTYPE html><html><head><script>' +
+                  'if (a < b && "</p>" != c) { d = "<title>"; }\n' * 20000 +
+                  '</script><title>After the script</title></head></html>'),
+        html_case('deep-nesting',
+                  '<!DOCTYPE html><html>' + '<div><span>' * 5000 +
+                  '<title>Deep inside</title>' + '</span></div>' * 5000 +
+                  '</html>'),
+        html_case('many-meta',
+                  '<!DOCTYPE html><html><head>' + ''.join(
+                      '<meta name="key{0}" content="value {0}">'.format(i)
+                      for i in xrange(3000)) +
+                  '<title>After the metadata</title></head></html>'),
+        html_case('many-entities',
+                  '<!DOCTYPE html><html><head><title>' +
+                  '&amp;&#233;&eacute;&#x1F600;' * 2000 +
+                  '</title></head></html>'),
+        html_case('no-title',
+                  '<!DOCTYPE html><html><head></head><body>' +
+                  '<p>No title anywhere.</p>\n' * 5000 + '</body></html>'),
+        Case('text/long-line', 'text/plain; charset=utf-8',
+             'All on one line. ' * 20000, 340000),
+        Case('image/png-truncated', 'image/png', png_payload()[:24],
+             len(png_payload())),
+        Case('av/mp3-silence', 'audio/mpeg', mp3_payload(),
+             len(mp3_payload()))]
+    try:
+        from PIL import Image
+    except ImportError:
+        return cases
+    photo = Image.new('RGB', (1920, 1080), (64, 128, 192))
+    cases.append(image_case('jpeg-progressive', photo, 'JPEG', 'image/jpeg',
+                            quality=90, progressive=True))
+    frames = [Image.new('P', (320, 240), i) for i in xrange(50)]
+    cases.append(image_case('gif-truncated', frames[0], 'GIF', 'image/gif',
+                            truncate=2048, save_all=True,
+                            append_images=frames[1:], duration=40))
+    return cases
+
+
+#
+# Measurement
+#
+
+def calibrate(repeat=5):
+    """Return the best time, in seconds, taken by a fixed pure-Python
+    workload over *repeat* runs."""
+    def workload():
+        counts = {}
+        for i in xrange(100000):
+            key = i % 97
+            counts[key] = counts.get(key, 0) + len(str(i))
+        return counts
+    return min(timeit.repeat(workload, number=1, repeat=repeat))
+
+
+@inlineCallbacks
+def extract(extractor, case):
+    """Run *extractor* on a fresh response for *case*, and return a
+    `Deferred` yielding the title, or the `repr` of anything else it
+    returned, such as a soft redirect."""
+    title = yield extractor.extract(PayloadResponse(case))
+    if title is not None and not isinstance(title, unicode):
+        title = unicode(repr(title))
+    returnValue(title)
+
+
+@inlineCallbacks
+def measure(extractor, case, iterations=20, repeat=3):
+    """Return a `Deferred` yielding a dictionary of measurements of
+    *extractor* on *case*: ``seconds``, the best mean over *repeat*
+    rounds of *iterations* extractions; ``objects``, the number of
+    garbage-collected objects left alive by one extraction after a
+    warm-up; ``peak_bytes``, the most memory it allocated at once, or
+    `None` without `tracemalloc`; and ``title``."""
+    title = yield extract(extractor, case)
+    timer = timeit.default_timer
+    best = None
+    for _ in xrange(repeat):
+        started = timer()
+        for _ in xrange(iterations):
+            yield extract(extractor, case)
+        elapsed = (timer() - started) / iterations
+        if best is None or elapsed < best:
+            best = elapsed
+    gc.collect()
+    gc.disable()
+    try:
+        # With collection off, the first generation's count goes up by
+        # one for every tracked object created and down for every one
+        # freed, so the difference is what survived.
+        before = gc.get_count()[0]
+        yield extract(extractor, case)
+        objects = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    peak_bytes = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            yield extract(extractor, case)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    returnValue({'seconds': best, 'objects': objects,
+                 'peak_bytes': peak_bytes, 'title': title})
+
+
+@inlineCallbacks
+def run(cases, registry=None, iterations=20, repeat=3):
+    """Measure the extractor from *registry*, defaulting to a fresh
+    `.ExtractorRegistry`, for each of *cases*, and return a `Deferred`
+    yielding a results dictionary with the calibration time and a
+    dictionary of measurements by case name.  Cases with no extractor
+    are left out."""
+    registry = registry or ExtractorRegistry(scan_plugins=False)
+    calibration = calibrate()
+    measured = {}
+    for case in cases:
+        extractor = registry.get(case.content_type.partition(';')[0]
+                                 .strip().lower())
+        if extractor is None:
+            continue
+        result = yield measure(extractor, case, iterations, repeat)
+        result['relative'] = result['seconds'] / calibration
+        measured[case.name] = result
+    returnValue({'calibration': calibration, 'cases': measured})
+
+
+def compare(results, baseline, tolerance=0.25, object_slack=16):
+    """Compare *results* against *baseline*, both as returned by `run`,
+    and return a list of ``(name, reason)`` pairs for each case that has
+    regressed.  A case regresses if its calibrated time is more than a
+    fraction *tolerance* over the baseline's, if it leaves more than
+    *object_slack* more objects alive than the baseline, or if its
+    title changed.  Cases missing from either are ignored."""
+    regressions = []
+    for name, result in sorted(results['cases'].iteritems()):
+        old = baseline['cases'].get(name)
+        if old is None:
+            continue
+        if result['relative'] > old['relative'] * (1 + tolerance):
+            regressions.append((name, 'time up {:.0%}'.format(
+                result['relative'] / old['relative'] - 1)))
+        if result['objects'] > old['objects'] + object_slack:
+            regressions.append((name, '{} more objects left alive'.format(
+                result['objects'] - old['objects'])))
+        if result['title'] != old['title']:
+            regressions.append((name, 'title changed to {!r}'.format(
+                result['title'])))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """Return a human-readable table of *results*, as returned by
+    `run`, with the change from *baseline* if given."""
+    lines = ['{:<52} {:>12} {:>8} {:>10} {:>8}'.format(
+        'case', 'time', 'change', 'objects', 'peak')]
+    for name, result in sorted(results['cases'].iteritems()):
+        change = ''
+        if baseline is not None and name in baseline['cases']:
+            change = '{:+.0%}'.format(
+                result['relative'] / baseline['cases'][name]['relative'] - 1)
+        peak = result['peak_bytes']
+        lines.append('{:<52} {:>9.1f} us {:>8} {:>10} {:>8}'.format(
+            name, result['seconds'] * 1e6, change, result['objects'],
+            'n/a' if peak is None else '{:.0f}K'.format(peak / 1024)))
+    return '\n'.join(lines)
+
+
+@inlineCallbacks
+def main(reactor):
+    """Extractor benchmark command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the CPU cost of each title extractor on '
+                    'recorded and adversarial documents.')
+    parser.add_argument(
+        '-n', '--iterations', type=int, default=20, metavar='N',
+        help='extract each document N times per round '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3, metavar='N',
+        help='keep the best of N rounds (default: %(default)s)')
+    parser.add_argument(
+        '-k', '--only', metavar='TEXT',
+        help='only run cases whose names contain TEXT')
+    parser.add_argument(
+        '--baseline', default=DEFAULT_BASELINE, metavar='FILE',
+        help='compare against the baseline in FILE (default: the one '
+             'shipped with Little Brother)')
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='write the results to the baseline file instead of '
+             'comparing against it')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25, metavar='FRACTION',
+        help='allowed slowdown before a case counts as a regression '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    cases = [case for case in cassette_cases() + synthetic_cases()
+             if args.only is None or args.only in case.name]
+    set_default_executor(InlineExecutor())
+    results = yield run(cases, iterations=args.iterations,
+                        repeat=args.repeat)
+    if args.save_baseline:
+        with open(args.baseline, 'wb') as f:
+            json.dump(results, f, indent=2, separators=(',', ': '),
+                      sort_keys=True)
+            f.write('\n')
+        return
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'rb') as f:
+            baseline = json.load(f)
+    if args.json:
+        print json.dumps(results, sort_keys=True)
+    else:
+        print format_results(results, baseline)
+    if baseline is None:
+        return
+    regressions = compare(results, baseline, args.tolerance)
+    for name, reason in regressions:
+        sys.stderr.write('regression in {}: {}\n'.format(name, reason))
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    react(main)
@@ -0,0 +1,319 @@
+"""Measure the throughput and latency of the whole fetch pipeline.
+
+Run ``python -m littlebrother.bench.pipeline --help`` for options.  By
+default, a `.SyntheticResource` is served on a loopback port in the
+same process, and a `.TitleFetcher` is pointed at it at each requested
+concurrency level in turn.  Use ``--serve`` in one process and
+``--target`` in another to keep the server's work out of the numbers.
+"""
+
+
+from __future__ import division
+from collections import Counter
+import argparse
+import json
+import math
+import random
+import resource
+import sys
+
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.task import react
+from twisted.python.failure import Failure
+from twisted.web.client import Agent
+from twisted.web.iweb import IAgentEndpointFactory
+from twisted.web.server import Site
+from zope.interface import implements
+
+from .. import ConnectionPool, TitleFetcher
+from ..executors import (InlineExecutor, ProcessExecutor, ThreadExecutor,
+                         set_default_executor)
+from ..metrics import FetchMetrics
+from .server import CONTENT_TYPES, SyntheticResource
+
+
+class LoopbackEndpointFactory(object):
+    """An agent endpoint factory that connects to port *port* of *host*
+    for every request, whatever its URL says, so that made-up hostnames
+    can be used to spread requests over several "hosts"."""
+    implements(IAgentEndpointFactory)
+
+    def __init__(self, reactor, host, port):
+        self.reactor = reactor
+        self.host = host
+        self.port = port
+
+    def endpointForURI(self, uri):
+        return TCP4ClientEndpoint(self.reactor, self.host, self.port)
+
+
+def benchmark_fetcher(reactor, host, port, concurrency):
+    """Return a `.TitleFetcher` that sends every request to port *port*
+    of *host*, with up to *concurrency* requests and idle connections
+    per host.  Hostnames aren't looked up or checked against the
+    blacklist, and requests aren't rate limited, but everything else
+    works as usual."""
+    fetcher = TitleFetcher(pool=ConnectionPool(
+        reactor, max_per_host=concurrency, max_total=None))
+    fetcher.throttle.agent = Agent.usingEndpointFactory(
+        reactor, LoopbackEndpointFactory(reactor, host, port),
+        pool=fetcher.pool)
+    fetcher.throttle.rate = fetcher.throttle.burst = 1e9
+    fetcher.throttle.max_per_host = concurrency
+    return fetcher
+
+
+def make_urls(host, port, count, mix, hosts=8, redirects=0, refreshes=0,
+              redirect_depth=2, seed=0):
+    """Return a list of *count* unique URLs of documents served by a
+    `.SyntheticResource` at port *port* of *host*.
+
+    *mix* maps file names served by the resource to relative weights.
+    Each URL has a made-up hostname, one of *hosts*.  A fraction
+    *redirects* of URLs lead through *redirect_depth* redirects, and a
+    fraction *refreshes* through a ``<meta>`` refresh.  The same *seed*
+    always gives the same URLs.
+    """
+    rng = random.Random(seed)
+    names = sorted(mix)
+    total = sum(mix.itervalues())
+    urls = []
+    for i in xrange(count):
+        pick = rng.uniform(0, total)
+        for name in names:
+            pick -= mix[name]
+            if pick <= 0:
+                break
+        path = name
+        detour = rng.random()
+        if detour < redirects:
+            path = 'redirect/{}/{}'.format(redirect_depth, path)
+        elif detour < redirects + refreshes:
+            path = 'refresh/' + path
+        urls.append('http://host{}.bench.test:{}/{}?{}'.format(
+            rng.randrange(hosts), port, path, i))
+    return urls
+
+
+def percentile(values, fraction):
+    """Return the value at *fraction* of the way through the sorted list
+    *values*, using the nearest-rank method, or `None` if it's empty."""
+    if not values:
+        return None
+    rank = min(max(int(math.ceil(fraction * len(values))), 1), len(values))
+    return values[rank - 1]
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@inlineCallbacks
+def run_level(clock, fetcher, urls, concurrency, max_per_host):
+    """Fetch every URL in *urls* with *fetcher*, *concurrency* at a time
+    and at most *max_per_host* to one host, and return a `Deferred`
+    yielding a dictionary of statistics.  Each URL's latency is counted
+    from the moment a fetch slot is free for it."""
+    metrics = FetchMetrics()
+    fetcher.observers.append(metrics)
+    starts = []
+    latencies = []
+    errors = Counter()
+    def pull():
+        for url in urls:
+            starts.append(clock.seconds())
+            yield url
+    def done(index, result):
+        latencies.append(clock.seconds() - starts[index])
+        if isinstance(result, Failure):
+            errors[result.type.__name__] += 1
+    started = clock.seconds()
+    yield fetcher.fetch_titles(pull(), done, max_concurrent=concurrency,
+                               max_per_host=max_per_host)
+    elapsed = clock.seconds() - started
+    fetcher.observers.remove(metrics)
+    latencies.sort()
+    titles = len(latencies) - sum(errors.itervalues())
+    stats = {
+        'concurrency': concurrency,
+        'requests': len(urls),
+        'titles': titles,
+        'errors': dict(errors),
+        'seconds': elapsed,
+        'titles_per_second': titles / elapsed if elapsed else None,
+        'p50_latency': percentile(latencies, 0.5),
+        'p99_latency': percentile(latencies, 0.99),
+        'peak_rss': peak_rss(),
+        'bytes_downloaded': metrics.bytes_downloaded,
+        'bytes_discarded': metrics.bytes_discarded}
+    yield fetcher.close()
+    returnValue(stats)
+
+
+def format_stats(stats):
+    """Return a one-line human-readable summary of *stats*, as returned
+    by `run_level`."""
+    def milliseconds(seconds):
+        return 'n/a' if seconds is None else '{:.1f} ms'.format(seconds * 1000)
+    summary = (
+        'concurrency {:>4}: {}/{} titles in {:.2f} s ({:.1f}/s), '
+        'p50 {}, p99 {}, peak RSS {:.1f} MiB, {} B read, {} B discarded'
+        .format(stats['concurrency'], stats['titles'], stats['requests'],
+                stats['seconds'], stats['titles_per_second'] or 0,
+                milliseconds(stats['p50_latency']),
+                milliseconds(stats['p99_latency']),
+                stats['peak_rss'] / 1048576, stats['bytes_downloaded'],
+                stats['bytes_discarded']))
+    if 'bytes_sent' in stats:
+        summary += ', {} B sent'.format(stats['bytes_sent'])
+    if stats['errors']:
+        summary += ', errors: ' + ', '.join(
+            '{} {}'.format(count, name)
+            for name, count in sorted(stats['errors'].iteritems()))
+    return summary
+
+
+def parse_mix(value):
+    """Parse a comma-separated list of ``name=weight`` pairs."""
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in CONTENT_TYPES:
+            raise argparse.ArgumentTypeError(
+                'unknown document {!r}; choose from {}'.format(
+                    name, ', '.join(sorted(CONTENT_TYPES))))
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'invalid weight {!r}'.format(weight))
+    return mix
+
+
+def parse_levels(value):
+    """Parse a comma-separated list of concurrency levels."""
+    try:
+        return [int(level) for level in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid concurrency levels {!r}'.format(value))
+
+
+@inlineCallbacks
+def main(reactor):
+    """Benchmark command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the title fetching pipeline against a '
+                    'local server of synthetic documents.')
+    parser.add_argument(
+        '-n', '--requests', type=int, default=500, metavar='N',
+        help='fetch N URLs at each concurrency level (default: %(default)s)')
+    parser.add_argument(
+        '-j', '--concurrency', type=parse_levels, default=[1, 16, 64],
+        metavar='N[,N...]',
+        help='concurrency levels to run at (default: 1,16,64)')
+    parser.add_argument(
+        '--per-host', type=int, default=None, metavar='N',
+        help='fetch at most N URLs from one host at once (default: the '
+             'concurrency level)')
+    parser.add_argument(
+        '--mix', type=parse_mix,
+        default={'page.html': 6, 'notes.txt': 1, 'image.png': 2,
+                 'audio.mp3': 1},
+        metavar='NAME=WEIGHT[,...]',
+        help='relative weights of the documents to fetch, out of {} '
+             '(default: 6 HTML, 1 text, 2 PNG, 1 MP3)'.format(
+                 ', '.join(sorted(CONTENT_TYPES))))
+    parser.add_argument(
+        '--hosts', type=int, default=8, metavar='N',
+        help='spread URLs over N made-up hostnames (default: %(default)s)')
+    parser.add_argument(
+        '--redirects', type=float, default=0.1, metavar='FRACTION',
+        help='fraction of URLs behind a redirect chain '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--redirect-depth', type=int, default=2, metavar='N',
+        help='length of each redirect chain (default: %(default)s)')
+    parser.add_argument(
+        '--refreshes', type=float, default=0.05, metavar='FRACTION',
+        help='fraction of URLs behind a <meta> refresh '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='random seed for choosing URLs (default: %(default)s)')
+    parser.add_argument(
+        '--latency', type=float, default=0, metavar='SECONDS',
+        help='delay every response by SECONDS (default: %(default)s)')
+    parser.add_argument(
+        '--trickle', type=int, default=0, metavar='BYTES',
+        help='send response bodies BYTES at a time (default: all at once)')
+    parser.add_argument(
+        '--trickle-interval', type=float, default=0.01, metavar='SECONDS',
+        help='wait SECONDS between trickled chunks (default: %(default)s)')
+    parser.add_argument(
+        '--parse-with', choices=('inline', 'threads', 'processes'),
+        default='inline',
+        help='where to run CPU-bound document parsing '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print a line of JSON for each level instead of a summary')
+    servers = parser.add_mutually_exclusive_group()
+    servers.add_argument(
+        '--serve', type=int, metavar='PORT',
+        help='only serve synthetic documents on PORT, until interrupted')
+    servers.add_argument(
+        '--target', metavar='HOST:PORT',
+        help='fetch from a server already started with --serve')
+    args = parser.parse_args()
+
+    site_resource = SyntheticResource(
+        latency=args.latency, trickle_bytes=args.trickle,
+        trickle_interval=args.trickle_interval, clock=reactor)
+    if args.serve is not None:
+        reactor.listenTCP(args.serve, Site(site_resource))
+        yield Deferred()
+    if args.target:
+        host, _, port = args.target.rpartition(':')
+        port = int(port)
+        site_resource = None
+    else:
+        host = '127.0.0.1'
+        listening = reactor.listenTCP(0, Site(site_resource), interface=host)
+        port = listening.getHost().port
+
+    if args.parse_with == 'threads':
+        executor = ThreadExecutor(reactor=reactor)
+    elif args.parse_with == 'processes':
+        executor = ProcessExecutor(reactor=reactor)
+    else:
+        executor = InlineExecutor()
+    set_default_executor(executor)
+    try:
+        for level, concurrency in enumerate(args.concurrency):
+            urls = make_urls(
+                host, port, args.requests, args.mix, hosts=args.hosts,
+                redirects=args.redirects, refreshes=args.refreshes,
+                redirect_depth=args.redirect_depth,
+                seed=args.seed + level)
+            sent_before = site_resource and site_resource.bytes_sent
+            fetcher = benchmark_fetcher(reactor, host, port, concurrency)
+            stats = yield run_level(reactor, fetcher, urls, concurrency,
+                                    args.per_host or concurrency)
+            if site_resource is not None:
+                stats['bytes_sent'] = site_resource.bytes_sent - sent_before
+            if args.json:
+                print json.dumps(stats, sort_keys=True)
+            else:
+                print format_stats(stats)
+            sys.stdout.flush()
+    finally:
+        executor.close()
+
+
+if __name__ == '__main__':
+    react(main)
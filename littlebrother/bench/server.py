@@ -0,0 +1,169 @@
+"""A local web server that serves synthetic documents for benchmarks."""
+
+
+import re
+import struct
+import zlib
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+
+def html_payload(size):
+    """Return an HTML document of about *size* bytes."""
+    head = ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+            '<title>Synthetic benchmark page</title></head><body>\n')
+    tail = '</body></html>\n'
+    filler = '<p>Lorem ipsum dolor sit amet, consectetur adipiscing.</p>\n'
+    repeats = max(size - len(head) - len(tail), 0) // len(filler)
+    return head + filler * repeats + tail
+
+
+def refresh_payload(location):
+    """Return an HTML document that refreshes to *location* at once."""
+    return ('<!DOCTYPE html>\n<html><head>'
+            '<meta http-equiv="refresh" content="0; url={}">'
+            '<title>Redirecting</title></head><body></body></html>\n'
+            .format(location))
+
+
+def text_payload(size):
+    """Return a plain text document of about *size* bytes."""
+    line = 'The quick brown fox jumps over the lazy dog.\n'
+    return 'Synthetic benchmark notes\n' + line * (size // len(line))
+
+
+def png_payload(width=640, height=480):
+    """Return a blank grayscale PNG image of *width* by *height*
+    pixels."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    # Each scanline starts with a filter type byte.
+    pixels = ('\x00' * (width + 1)) * height
+    return ('\x89PNG\r\n\x1a\n' + chunk('IHDR', header) +
+            chunk('IDAT', zlib.compress(pixels)) + chunk('IEND', ''))
+
+
+def mp3_payload(frames=2000):
+    """Return a silent MPEG-1 Layer III stream of *frames* frames, at
+    128 kbit/s and 44.1 kHz, lasting about 26 milliseconds each."""
+    # Frames at this bit rate and sampling rate are 417 bytes long,
+    # including the four-byte header.
+    return ('\xff\xfb\x90\x64' + '\x00' * 413) * frames
+
+
+#: Maps the file names `SyntheticResource` serves to their MIME types.
+CONTENT_TYPES = {
+    'page.html': 'text/html; charset=utf-8',
+    'notes.txt': 'text/plain; charset=utf-8',
+    'image.png': 'image/png',
+    'audio.mp3': 'audio/mpeg'}
+
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class SyntheticResource(Resource):
+    """A web resource serving synthetic documents under each of the file
+    names in `CONTENT_TYPES`.  Prefixing a path with ``redirect/N/``
+    adds a chain of *N* permanent redirects in front of it, and with
+    ``refresh/``, a ``<meta>`` refresh.  Query strings are ignored, but
+    kept across redirects, so that they can be used to make each URL
+    unique.
+
+    Every response is delayed by *latency* seconds, according to
+    *clock*.  If *trickle_bytes* is nonzero, bodies are sent that many
+    bytes at a time, every *trickle_interval* seconds.  Simple ``Range``
+    requests are honored.
+    """
+    isLeaf = True
+
+    def __init__(self, html_size=16384, text_size=4096, latency=0,
+                 trickle_bytes=0, trickle_interval=0.01, clock=None):
+        self.payloads = {
+            'page.html': html_payload(html_size),
+            'notes.txt': text_payload(text_size),
+            'image.png': png_payload(),
+            'audio.mp3': mp3_payload()}
+        self.latency = latency
+        self.trickle_bytes = trickle_bytes
+        self.trickle_interval = trickle_interval
+        self.clock = clock or reactor
+        #: The number of requests received.
+        self.requests = 0
+        #: The number of body bytes sent.
+        self.bytes_sent = 0
+
+    def render_GET(self, request):
+        self.requests += 1
+        if self.latency:
+            self.clock.callLater(self.latency, self.respond, request)
+        else:
+            self.respond(request)
+        return NOT_DONE_YET
+
+    def respond(self, request):
+        """Send the response to *request*."""
+        segments = request.postpath
+        query = request.uri.partition('?')[2]
+        suffix = '?' + query if query else ''
+        if (len(segments) > 2 and segments[0] == 'redirect' and
+                segments[1].isdigit()):
+            hops = int(segments[1])
+            rest = '/'.join(segments[2:])
+            if hops > 1:
+                location = '/redirect/{}/{}'.format(hops - 1, rest)
+            else:
+                location = '/' + rest
+            request.setResponseCode(301)
+            request.setHeader('Location', location + suffix)
+            self.send(request, '')
+            return
+        if len(segments) > 1 and segments[0] == 'refresh':
+            request.setHeader('Content-Type', CONTENT_TYPES['page.html'])
+            self.send(request, refresh_payload(
+                '/' + '/'.join(segments[1:]) + suffix))
+            return
+        name = '/'.join(segments)
+        if name not in self.payloads:
+            request.setResponseCode(404)
+            self.send(request, '')
+            return
+        request.setHeader('Content-Type', CONTENT_TYPES[name])
+        body = self.payloads[name]
+        match = RANGE_RE.match(request.getHeader('Range') or '')
+        if match is not None and int(match.group(1)) < len(body):
+            first = int(match.group(1))
+            last = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+            request.setResponseCode(206)
+            request.setHeader('Content-Range', 'bytes {}-{}/{}'.format(
+                first, last, len(body)))
+            body = body[first:last + 1]
+        self.send(request, body)
+
+    def send(self, request, body):
+        """Send *body* in response to *request*, trickling it out if
+        necessary, and finish the response."""
+        request.setHeader('Content-Length', str(len(body)))
+        if not self.trickle_bytes:
+            request.write(body)
+            self.bytes_sent += len(body)
+            request.finish()
+            return
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        def trickle(offset):
+            if gone:
+                return
+            chunk = body[offset:offset + self.trickle_bytes]
+            if chunk:
+                request.write(chunk)
+                self.bytes_sent += len(chunk)
+            offset += len(chunk)
+            if offset < len(body):
+                self.clock.callLater(self.trickle_interval, trickle, offset)
+            else:
+                request.finish()
+        trickle(0)
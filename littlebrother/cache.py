@@ -0,0 +1,301 @@
+"""Caches for fetched document titles."""
+
+
+from collections import namedtuple, OrderedDict
+
+from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import reactor
+
+
+#: A cached `TitleFetcher` result.  *title* is the extracted title as a
+#: Unicode string, *final_host* is the hostname of the URL the title was
+#: ultimately extracted from, or `None` if the fetch failed, and *error*
+#: is true if *title* is a friendly error message from `describe_error`.
+#: *etag* and *last_modified* are the document's HTTP validators, if
+#: any, used to revalidate a stale entry.  *max_age* is the number of
+#: seconds the entry stays fresh according to the server, or `None` to
+#: let the cache decide.
+CachedTitle = namedtuple('CachedTitle', ['title', 'final_host', 'error',
+                                         'etag', 'last_modified', 'max_age'])
+CachedTitle.__new__.__defaults__ = (None, None, None)
+
+
+class TitleCache(object):
+    """An in-memory cache holding at most *max_entries* titles, evicting
+    the least recently used first.  Titles expire after their *max_age*
+    or, if that is `None`, after *ttl* seconds, and friendly error
+    messages after *error_ttl* seconds.  Expired titles with validators
+    are kept until evicted, so that they can be revalidated.  *clock* is
+    an `~twisted.internet.interfaces.IReactorTime` provider used to tell
+    the time, defaulting to the global reactor."""
+
+    def __init__(self, max_entries=1024, ttl=3600, error_ttl=60, clock=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.clock = clock or reactor
+        #: The number of lookups that found an unexpired entry.
+        self.hits = 0
+        #: The number of lookups that did not.
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the `CachedTitle` stored under *key*, or `None` if
+        there is no such entry or it has expired."""
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires <= self.clock.seconds():
+            if value.etag or value.last_modified:
+                self._entries[key] = (expires, value)
+            self.misses += 1
+            return None
+        # Reinsert the entry to mark it as the most recently used.
+        self._entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def get_stale(self, key):
+        """Return the `CachedTitle` stored under *key*, even if it has
+        expired, or `None` if there is no such entry."""
+        entry = self._entries.get(key)
+        return None if entry is None else entry[1]
+
+    def put(self, key, value):
+        """Store the `CachedTitle` *value* under *key*."""
+        if value.error:
+            ttl = self.error_ttl
+        elif value.max_age is not None:
+            ttl = value.max_age
+        else:
+            ttl = self.ttl
+        if ttl <= 0 and not (value.etag or value.last_modified):
+            self._entries.pop(key, None)
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock.seconds() + ttl, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries from this cache."""
+        self._entries.clear()
+
+
+#: The number of seconds `RedirectCache` remembers a redirect for by
+#: default, keyed by HTTP status code.  Redirects with other codes,
+#: which are only temporary, aren't remembered at all.
+REDIRECT_TTLS = {301: 86400, 308: 86400}
+
+
+class RedirectCache(object):
+    """An in-memory cache of resolved redirects, holding at most
+    *max_entries* and evicting the least recently used first.  Hard
+    redirects expire after the number of seconds in *ttls* for their
+    status code, defaulting to `REDIRECT_TTLS`, and soft redirects after
+    *soft_ttl* seconds.  *clock* is used to tell the time, as with
+    `TitleCache`."""
+
+    def __init__(self, max_entries=4096, ttls=None, soft_ttl=3600,
+                 clock=None):
+        self.max_entries = max_entries
+        self.ttls = REDIRECT_TTLS if ttls is None else ttls
+        self.soft_ttl = soft_ttl
+        self.clock = clock or reactor
+        #: The number of lookups that found an unexpired redirect.
+        self.hits = 0
+        #: The number of lookups that did not.
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, source):
+        """Return a tuple of the URL that *source* redirects to and
+        whether the redirect was a soft one, or `None` if no unexpired
+        redirect from *source* is known."""
+        try:
+            expires, target, soft = self._entries.pop(source)
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires <= self.clock.seconds():
+            self.misses += 1
+            return None
+        self._entries[source] = (expires, target, soft)
+        self.hits += 1
+        return target, soft
+
+    def resolve(self, source, max_hops=20):
+        """Follow known redirects from *source*, for at most *max_hops*,
+        and return a tuple of the URL they end up at and whether any of
+        them was a soft redirect."""
+        seen = set([source])
+        any_soft = False
+        for _ in xrange(max_hops):
+            redirect = self.get(source)
+            if redirect is None:
+                break
+            source, soft = redirect
+            any_soft = any_soft or soft
+            if source in seen:
+                # Don't go round in circles; let the fetch fail on its
+                # own if the loop is real.
+                break
+            seen.add(source)
+        return source, any_soft
+
+    def put(self, source, target, code=None, max_age=None):
+        """Remember that *source* redirects to *target* with the HTTP
+        status *code*, or with a soft redirect if *code* is `None`.  If
+        *max_age* is not `None`, it overrides the default lifetime."""
+        if max_age is not None:
+            ttl = max_age
+        elif code is None:
+            ttl = self.soft_ttl
+        else:
+            ttl = self.ttls.get(code, 0)
+        self._entries.pop(source, None)
+        if ttl <= 0 or source == target:
+            return
+        self._entries[source] = (self.clock.seconds() + ttl, target,
+                                 code is None)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries from this cache."""
+        self._entries.clear()
+
+
+class SQLiteTitleCache(object):
+    """A title cache stored in the SQLite database at *path*, so that it
+    survives restarts and can be shared by several processes at once.
+    It otherwise behaves like a `TitleCache`, except that every method
+    but `close` returns a `Deferred`, since database access happens in
+    a thread pool to keep the reactor responsive.
+
+    When more than *max_entries* titles are stored, the least recently
+    used are evicted first.  *clock* is used to tell the time, as with
+    `TitleCache`.
+    """
+
+    def __init__(self, path, max_entries=65536, ttl=3600, error_ttl=60,
+                 clock=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.clock = clock or reactor
+        #: The number of lookups that found an unexpired entry.
+        self.hits = 0
+        #: The number of lookups that did not.
+        self.misses = 0
+        self.closed = False
+        # SQLite only allows one writer at a time, so there is no point
+        # in having more than one connection per process.  Other
+        # processes are waited on for up to *timeout* seconds.
+        self.dbpool = ConnectionPool(
+            'sqlite3', path, timeout=30, check_same_thread=False,
+            cp_min=1, cp_max=1, cp_openfun=self._prepare)
+
+    @staticmethod
+    def _prepare(connection):
+        # Write-ahead logging lets readers in other processes carry on
+        # while one of them writes.
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS titles ('
+            'key TEXT PRIMARY KEY, title TEXT, final_host TEXT, '
+            'error INTEGER, etag TEXT, last_modified TEXT, '
+            'expires REAL, used REAL)')
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS titles_used ON titles (used)')
+        connection.commit()
+
+    def get(self, key):
+        """Return a `Deferred` yielding the `CachedTitle` stored under
+        *key*, or `None` if there is no such entry or it has expired."""
+        getting = self.dbpool.runInteraction(
+            self._get, key, self.clock.seconds(), False)
+        getting.addCallback(self._count)
+        return getting
+
+    def get_stale(self, key):
+        """Return a `Deferred` yielding the `CachedTitle` stored under
+        *key*, even if it has expired, or `None` if there is none."""
+        return self.dbpool.runInteraction(
+            self._get, key, self.clock.seconds(), True)
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def _get(self, cursor, key, now, stale):
+        cursor.execute(
+            'SELECT title, final_host, error, etag, last_modified, expires '
+            'FROM titles WHERE key = ?', (key,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        title, final_host, error, etag, last_modified, expires = row
+        if expires <= now and not stale:
+            if not (etag or last_modified):
+                cursor.execute('DELETE FROM titles WHERE key = ?', (key,))
+            return None
+        cursor.execute('UPDATE titles SET used = ? WHERE key = ?', (now, key))
+        return CachedTitle(
+            title, final_host, bool(error),
+            None if etag is None else etag.encode('latin-1'),
+            (None if last_modified is None
+             else last_modified.encode('latin-1')))
+
+    def put(self, key, value):
+        """Store the `CachedTitle` *value* under *key*, and return a
+        `Deferred` that fires once it has been written."""
+        if value.error:
+            ttl = self.error_ttl
+        elif value.max_age is not None:
+            ttl = value.max_age
+        else:
+            ttl = self.ttl
+        return self.dbpool.runInteraction(
+            self._put, key, value, ttl, self.clock.seconds())
+
+    def _put(self, cursor, key, value, ttl, now):
+        if ttl <= 0 and not (value.etag or value.last_modified):
+            cursor.execute('DELETE FROM titles WHERE key = ?', (key,))
+            return
+        # Validators are byte strings, which SQLite won't take as text.
+        cursor.execute(
+            'INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, value.title, value.final_host, int(bool(value.error)),
+             None if value.etag is None else value.etag.decode('latin-1'),
+             (None if value.last_modified is None
+              else value.last_modified.decode('latin-1')),
+             now + ttl, now))
+        cursor.execute('SELECT count(*) FROM titles')
+        excess = cursor.fetchone()[0] - self.max_entries
+        if excess > 0:
+            cursor.execute(
+                'DELETE FROM titles WHERE key IN '
+                '(SELECT key FROM titles ORDER BY used LIMIT ?)', (excess,))
+
+    def clear(self):
+        """Remove all entries from this cache."""
+        return self.dbpool.runOperation('DELETE FROM titles')
+
+    def close(self):
+        """Close the connection to the database, if it is still open."""
+        if not self.closed:
+            self.closed = True
+            self.dbpool.close()
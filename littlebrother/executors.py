@@ -0,0 +1,150 @@
+"""Executors for CPU-bound title extraction work.
+
+Title extractors hand expensive parsing off to an executor so that it
+doesn't have to run on the reactor thread.  An executor is any object
+with a ``submit(f, *args, **kwargs)`` method that calls *f* with the
+given arguments somewhere and returns a `Deferred` yielding the result.
+"""
+
+
+import cPickle as pickle
+import multiprocessing
+import signal
+
+from twisted.internet import reactor as global_reactor
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class InlineExecutor(object):
+    """Runs work immediately on the calling thread."""
+
+    def submit(self, f, *args, **kwargs):
+        return maybeDeferred(f, *args, **kwargs)
+
+    def close(self):
+        pass
+
+
+class ThreadExecutor(object):
+    """Runs work in a pool of up to *size* threads.  The pool is started
+    on first use, and stopped when *reactor* shuts down."""
+
+    def __init__(self, size=4, reactor=None):
+        self.reactor = reactor or global_reactor
+        self.pool = ThreadPool(minthreads=0, maxthreads=size,
+                               name='littlebrother')
+        self._shutdown_trigger = None
+
+    def submit(self, f, *args, **kwargs):
+        if not self.pool.started:
+            self.pool.start()
+            self._shutdown_trigger = self.reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.close)
+        return deferToThreadPool(self.reactor, self.pool, f, *args, **kwargs)
+
+    def close(self):
+        """Stop the thread pool, waiting for any running work."""
+        if self._shutdown_trigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+        if self.pool.started:
+            self.pool.stop()
+
+
+class ExecutorClosed(Exception):
+    """Raised for work still pending when its executor is closed."""
+
+
+def _call_and_capture(call):
+    # Python 2's `multiprocessing.Pool.apply_async` never calls back if
+    # the call fails, or if its arguments or result can't be pickled.
+    # So the call is pickled by the caller, and both its result and any
+    # exception are pickled here, where failing to do so can be caught.
+    try:
+        f, args, kwargs = pickle.loads(call)
+        result = True, f(*args, **kwargs)
+    except Exception as e:
+        result = False, e
+    try:
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return pickle.dumps((False, pickle.PicklingError(
+            'unpicklable {} from worker: {}'.format(
+                'result' if result[0] else 'exception', e))))
+
+
+def _reset_signals():
+    # Worker processes forked while the reactor is running inherit its
+    # signal handlers, which would keep `Pool.terminate` from stopping
+    # them.  Interrupts are left for the parent process to deal with.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.set_wakeup_fd(-1)
+
+
+class ProcessExecutor(object):
+    """Runs work in a pool of *size* worker processes, or one per CPU if
+    *size* is `None`.  Results are handed back to *reactor*'s thread.
+    Only picklable functions and arguments, such as module-level
+    functions called with byte strings, can be used.
+
+    Work lost to a worker process that dies can't be detected, but it
+    fails with `ExecutorClosed` once the executor is closed."""
+
+    def __init__(self, size=None, reactor=None):
+        self.reactor = reactor or global_reactor
+        self.pool = multiprocessing.Pool(size, initializer=_reset_signals)
+        #: The `Deferred` objects for work that hasn't finished yet.
+        self.pending = set()
+
+    def submit(self, f, *args, **kwargs):
+        try:
+            call = pickle.dumps((f, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return fail()
+        finished = Deferred()
+        def deliver(result):
+            if finished not in self.pending:
+                return
+            self.pending.remove(finished)
+            try:
+                succeeded, value = pickle.loads(result)
+            except Exception:
+                finished.errback()
+                return
+            if succeeded:
+                finished.callback(value)
+            else:
+                finished.errback(value)
+        self.pending.add(finished)
+        self.pool.apply_async(
+            _call_and_capture, (call,),
+            callback=lambda result: self.reactor.callFromThread(
+                deliver, result))
+        return finished
+
+    def close(self):
+        """Terminate the worker processes, failing any pending work."""
+        self.pool.terminate()
+        self.pool.join()
+        pending, self.pending = self.pending, set()
+        for finished in pending:
+            finished.errback(ExecutorClosed())
+
+
+_default_executor = InlineExecutor()
+
+
+def get_default_executor():
+    """Return the executor used by title extractors that don't have one
+    of their own."""
+    return _default_executor
+
+
+def set_default_executor(executor):
+    """Make *executor* the one used by title extractors that don't have
+    one of their own."""
+    global _default_executor
+    _default_executor = executor
@@ -0,0 +1,246 @@
+"""Instrumentation for title fetches.
+
+A `.TitleFetcher` reports what it is doing to every object in its
+``observers`` list, each of which should provide `IFetchObserver`.
+`FetchMetrics` is an observer that keeps running totals, which
+`MetricsExporter` periodically writes out in the Prometheus text format
+or as JSON lines.
+"""
+
+
+from bisect import bisect_left
+from collections import Counter
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from zope.interface import Interface, implements
+
+
+class IFetchObserver(Interface):
+    """An object told about each step of the fetches made by a
+    `.TitleFetcher`.  Methods are called on the reactor thread, and
+    should return quickly."""
+
+    def phase_finished(phase, seconds):
+        """Called when a phase of a fetch has finished, successfully or
+        not, after taking *seconds* seconds.  *phase* is one of:
+
+        ``'resolve'``
+            Looking up a hostname before sending a request to it.
+        ``'connect'``
+            Opening a new connection to a server.
+        ``'headers'``
+            Waiting for a response's headers, including any lookups and
+            connections needed to send the request.
+        ``'body'``
+            Receiving the part of a response's body that an extractor
+            read, up to the last chunk it was given.
+        ``'extract'``
+            Running an extractor, including reading and parsing the
+            body.
+        ``'fetch'``
+            The whole fetch of one URL, including redirects.
+        """
+
+    def bytes_received(downloaded, discarded):
+        """Called when *downloaded* bytes of response bodies have been
+        read by an extractor, and *discarded* bytes read only so that
+        their connection could be reused."""
+
+    def fetch_succeeded(content_type):
+        """Called when a fetch has produced a title for a document of
+        the MIME *content_type*, or `None` if unknown or if the server
+        said that a cached title was still current."""
+
+    def fetch_failed(error_class):
+        """Called when a fetch has failed.  *error_class* is the name of
+        the class of error returned by `.classify_error`, or the name of
+        the exception type for unusual errors."""
+
+
+#: The upper bounds, in seconds, of the buckets `FetchMetrics` sorts
+#: phase timings into.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+
+
+class PhaseTimings(object):
+    """A histogram of the time taken by one phase."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        #: The number of timings in each bucket, with one extra for
+        #: timings greater than every bound.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        """Return a list of pairs of bucket bounds, as strings, and the
+        number of timings no greater than each, ending with ``'+Inf'``
+        and the total count."""
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((repr(float(bound)), total))
+        pairs.append(('+Inf', self.count))
+        return pairs
+
+
+def escape_label(value):
+    """Return the Unicode or byte string *value* escaped for use as a
+    Prometheus label value."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class FetchMetrics(object):
+    """An `IFetchObserver` that counts fetches by content type and by
+    class of error, adds up the bytes received, and sorts the time taken
+    by each phase into a histogram with the upper bounds in *buckets*,
+    defaulting to `DEFAULT_BUCKETS`."""
+    implements(IFetchObserver)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        #: A dictionary mapping phase names to `PhaseTimings`.
+        self.phases = {}
+        #: A `Counter` of successful fetches by content type.
+        self.fetches = Counter()
+        #: A `Counter` of failed fetches by class of error.
+        self.errors = Counter()
+        self.bytes_downloaded = 0
+        self.bytes_discarded = 0
+
+    def phase_finished(self, phase, seconds):
+        try:
+            timings = self.phases[phase]
+        except KeyError:
+            timings = self.phases[phase] = PhaseTimings(self.buckets)
+        timings.add(seconds)
+
+    def bytes_received(self, downloaded, discarded):
+        self.bytes_downloaded += downloaded
+        self.bytes_discarded += discarded
+
+    def fetch_succeeded(self, content_type):
+        self.fetches[content_type or 'unknown'] += 1
+
+    def fetch_failed(self, error_class):
+        self.errors[error_class] += 1
+
+    def snapshot(self):
+        """Return the current totals as a dictionary that can be
+        serialized as JSON."""
+        return {
+            'phases': dict(
+                (phase, {'count': timings.count, 'sum': timings.sum,
+                         'buckets': timings.cumulative()})
+                for phase, timings in self.phases.iteritems()),
+            'fetches': dict(self.fetches),
+            'errors': dict(self.errors),
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_discarded': self.bytes_discarded}
+
+    def json_line(self, now):
+        """Return the current totals, timestamped with *now*, as a line
+        of JSON."""
+        snapshot = self.snapshot()
+        snapshot['time'] = now
+        return json.dumps(snapshot, sort_keys=True) + '\n'
+
+    def prometheus(self):
+        """Return the current totals in the Prometheus text exposition
+        format, as a byte string."""
+        lines = [
+            '# HELP littlebrother_phase_seconds '
+            'Time taken by each phase of a fetch.',
+            '# TYPE littlebrother_phase_seconds histogram']
+        for phase, timings in sorted(self.phases.iteritems()):
+            phase = escape_label(phase)
+            for bound, count in timings.cumulative():
+                lines.append('littlebrother_phase_seconds_bucket'
+                             '{{phase="{}",le="{}"}} {}'.format(
+                                 phase, bound, count))
+            lines.append('littlebrother_phase_seconds_sum{{phase="{}"}} {!r}'
+                         .format(phase, timings.sum))
+            lines.append('littlebrother_phase_seconds_count{{phase="{}"}} {}'
+                         .format(phase, timings.count))
+        for name, label, counter, description in (
+                ('fetches', 'content_type', self.fetches,
+                 'Successful fetches by content type.'),
+                ('fetch_errors', 'error', self.errors,
+                 'Failed fetches by class of error.')):
+            lines.append('# HELP littlebrother_{}_total {}'.format(
+                name, description))
+            lines.append('# TYPE littlebrother_{}_total counter'.format(name))
+            for value, count in sorted(counter.iteritems()):
+                lines.append('littlebrother_{}_total{{{}="{}"}} {}'.format(
+                    name, label, escape_label(value), count))
+        for name, total, description in (
+                ('downloaded', self.bytes_downloaded,
+                 'Bytes of response bodies read by extractors.'),
+                ('discarded', self.bytes_discarded,
+                 'Bytes of response bodies read and thrown away.')):
+            lines.append('# HELP littlebrother_bytes_{}_total {}'.format(
+                name, description))
+            lines.append('# TYPE littlebrother_bytes_{}_total counter'.format(
+                name))
+            lines.append('littlebrother_bytes_{}_total {}'.format(
+                name, total))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+    """Writes the totals kept by the `FetchMetrics` *metrics* to the
+    file at *path* every *interval* seconds, according to *clock*, once
+    `start` is called.  If *format* is ``'prometheus'``, the file is
+    replaced each time, as the Prometheus node exporter's textfile
+    collector expects.  If it is ``'json'``, a line of JSON is appended
+    to the file each time."""
+
+    def __init__(self, metrics, path, format='prometheus', interval=60,
+                 clock=None):
+        if format not in ('prometheus', 'json'):
+            raise ValueError('unknown metrics format {!r}'.format(format))
+        self.metrics = metrics
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.clock = clock or reactor
+        self._loop = LoopingCall(self.write)
+        self._loop.clock = self.clock
+
+    def write(self):
+        """Write out the current totals right away."""
+        if self.format == 'json':
+            with open(self.path, 'ab') as f:
+                f.write(self.metrics.json_line(self.clock.seconds()))
+            return
+        # Write to a temporary file first, so that nothing ever sees a
+        # partly written one.
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(self.metrics.prometheus())
+        os.rename(temporary, self.path)
+
+    def start(self):
+        """Start writing out totals periodically."""
+        self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        """Stop writing out totals periodically, and write them out one
+        last time."""
+        if self._loop.running:
+            self._loop.stop()
+        self.write()
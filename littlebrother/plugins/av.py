@@ -2,18 +2,34 @@
 
 
 from __future__ import absolute_import, division
-import os
-import tempfile
+from io import BytesIO
 
 import av
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.web.iweb import UNKNOWN_LENGTH
 from zope.interface import implements
 
-from .. import ITitleExtractor, read_body
+from .. import BodyFile, BodyFileProtocol, ITitleExtractor, read_body
+from ..executors import ThreadExecutor, get_default_executor
 from ..humanize import duration, filesize
 
 
+def probe_media(source):
+    """Open *source*, a byte string, `bytearray`, or file-like object
+    containing a media file, with PyAV and return a tuple of its
+    container format name, a list of descriptions of its streams, and
+    its duration in seconds, or `None` if the file can't be opened."""
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    try:
+        container = av.open(source)
+    except av.AVError:
+        return None
+    return (container.format.long_name,
+            [s.long_name + ' ' + s.type for s in container.streams],
+            container.duration / av.time_base)
+
+
 class AVTitleExtractor(object):
     implements(ITitleExtractor)
     content_types = ('audio/mpeg', 'video/mp4',
@@ -22,26 +38,61 @@ class AVTitleExtractor(object):
     def __init__(self):
         #: The maximum number of bytes this extractor will download.
         self.max_download_bytes = 4194304
+        #: Whether `.TitleFetcher` should ask servers for only the first
+        #: `max_download_bytes` bytes of a file with a ``Range`` header.
+        self.range_requests = True
+        #: Whether to probe the file while it is still downloading, and
+        #: stop as soon as PyAV has read the container header and
+        #: stream information.  Streaming probes block waiting for
+        #: data, so each one takes a thread of its own.
+        self.streaming = True
+        #: The maximum number of streaming probes at once.  Files that
+        #: arrive while that many are running are downloaded first, as
+        #: if `streaming` were false.
+        self.max_streaming_probes = 4
+        #: The executor used to run PyAV when not streaming, or `None`
+        #: to use the one returned by `.executors.get_default_executor`.
+        self.executor = None
+        #: The `.executors.ThreadExecutor` that runs streaming probes,
+        #: created when first needed.
+        self.probe_executor = None
+        self.streaming_probes = 0
 
     @inlineCallbacks
     def extract(self, response):
-        with tempfile.NamedTemporaryFile() as f:
+        if self.streaming and (self.streaming_probes <
+                               self.max_streaming_probes):
+            probed = yield self.probe_streaming(response)
+        else:
             content = yield read_body(response,
-                                      max_bytes=self.max_download_bytes)
-            f.write(content)
-            f.flush()
-            os.fsync(f.fileno())
-            try:
-                container = av.open(f.name)
-            except av.AVError:
-                returnValue(None)
-            returnValue(u'{} file containing {} ({}{})'.format(
-                container.format.long_name,
-                u' and '.join([s.long_name + ' ' + s.type
-                               for s in container.streams]),
-                duration(container.duration / av.time_base),
-                (u'' if response.length is UNKNOWN_LENGTH
-                     else u', ' + filesize(response.length))))
+                                      max_bytes=self.max_download_bytes,
+                                      as_buffer=True)
+            executor = self.executor or get_default_executor()
+            probed = yield executor.submit(probe_media, content)
+        if probed is None:
+            returnValue(None)
+        format_name, streams, media_duration = probed
+        returnValue(u'{} file containing {} ({}{})'.format(
+            format_name, u' and '.join(streams), duration(media_duration),
+            (u'' if response.length is UNKNOWN_LENGTH
+                 else u', ' + filesize(response.length))))
+
+    @inlineCallbacks
+    def probe_streaming(self, response):
+        """Return a `Deferred` yielding the result of `probe_media` on
+        the body of *response*, probed as it arrives."""
+        if self.probe_executor is None:
+            self.probe_executor = ThreadExecutor(self.max_streaming_probes)
+        body_file = BodyFile()
+        protocol = BodyFileProtocol(body_file, self.max_download_bytes)
+        response.deliverBody(protocol)
+        self.streaming_probes += 1
+        try:
+            probed = yield self.probe_executor.submit(probe_media, body_file)
+        finally:
+            self.streaming_probes -= 1
+            protocol.stop()
+        returnValue(probed)
 
 
 extractor = AVTitleExtractor()
@@ -2,19 +2,195 @@
 
 
 import cgi
+import codecs
+from HTMLParser import HTMLParser, HTMLParseError
 import re
 
 from bs4 import BeautifulSoup
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 from zope.interface import implements
 
-from .. import ITitleExtractor, read_body, Redirect
+from .. import ITitleExtractor, ParsingReadBodyProtocol, read_body, Redirect
+from ..executors import get_default_executor
 
 
 #: Beautiful Soup attribute selector for ``<meta>`` refreshes.
 META_REFRESH_ATTRS = {'http-equiv': re.compile('refresh', re.IGNORECASE),
                       'content': True}
 
+#: Elements that may appear in a document head.  Any other start tag
+#: outside of the title implicitly begins the document body.
+HEAD_ELEMENTS = frozenset(['html', 'head', 'title', 'base', 'link', 'meta',
+                           'noscript', 'script', 'style', 'template'])
+
+
+def parse_refresh(content, max_delay):
+    """Return the URL from a ``<meta>`` refresh *content* attribute if
+    its delay is no greater than *max_delay* seconds, or `None`."""
+    seconds, params = cgi.parse_header(content)
+    try:
+        seconds = int(seconds, 10)
+    except ValueError:
+        # Not a valid number; just pretend it's zero.
+        seconds = 0
+    if seconds <= max_delay and 'url' in params:
+        return params['url']
+    return None
+
+
+def soup_title(content, charset, parser, max_refresh_delay, ignore_noscript):
+    """Return the title or soft redirect in the HTML document *content*
+    by parsing all of it with the Beautiful Soup *parser*.  The other
+    arguments correspond to `HTMLTitleExtractor` attributes."""
+    soup = BeautifulSoup(content, parser, from_encoding=charset)
+    if ignore_noscript:
+        for noscript in soup('noscript'):
+            noscript.clear()
+    # Handle any <meta> refreshes.
+    for refresh in soup('meta', attrs=META_REFRESH_ATTRS):
+        location = parse_refresh(refresh['content'], max_refresh_delay)
+        if location is not None:
+            return Redirect(location)
+    if soup.title:
+        # Join twice: once because soup.title.strings is an iterator
+        # and once after splitting to coalesce whitespace.
+        return u' '.join(u''.join(soup.title.strings).split())
+    return None
+
+
+class HeadParser(HTMLParser):
+    """An incremental HTML parser that picks the title and any ``<meta>``
+    refresh out of a document head as data is fed to it.
+
+    Byte strings passed to `feed` are parsed as Latin-1, which maps each
+    byte to exactly one code point, and only decoded with the document's
+    actual encoding once `result` is called.  This lets the parser run
+    before any ``<meta charset>`` declaration has been seen.
+    """
+
+    def __init__(self, max_refresh_delay, ignore_noscript=True):
+        HTMLParser.__init__(self)
+        self.max_refresh_delay = max_refresh_delay
+        self.ignore_noscript = ignore_noscript
+        #: Whether the parser has seen everything it needs, either
+        #: because the document head has ended or because a soft
+        #: redirect was found.
+        self.done = False
+        #: Whether the parser choked on malformed input.
+        self.failed = False
+        self.meta_charset = None
+        self.refresh = None
+        self.title_parts = None
+        self.in_title = False
+        self.noscript_depth = 0
+
+    def feed(self, data):
+        if self.done or self.failed:
+            return
+        try:
+            HTMLParser.feed(self, data.decode('latin-1'))
+        except HTMLParseError:
+            self.failed = True
+
+    def close(self):
+        if self.done or self.failed:
+            return
+        try:
+            HTMLParser.close(self)
+        except HTMLParseError:
+            self.failed = True
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if self.noscript_depth:
+            if tag == 'noscript':
+                self.noscript_depth += 1
+            return
+        if tag == 'noscript' and self.ignore_noscript:
+            self.noscript_depth = 1
+        elif tag == 'title' and self.title_parts is None:
+            self.title_parts = []
+            self.in_title = True
+        elif tag == 'meta':
+            self.handle_meta(dict(attrs))
+        elif not self.in_title and (tag == 'body' or
+                                    tag not in HEAD_ELEMENTS):
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if self.noscript_depth:
+            if tag == 'noscript':
+                self.noscript_depth -= 1
+            return
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
+
+    # Entity and character references are left escaped until the title
+    # has been decoded, since they may refer to code points outside of
+    # the Latin-1 range.
+
+    def handle_entityref(self, name):
+        self.handle_data(u'&{};'.format(name))
+
+    def handle_charref(self, name):
+        self.handle_data(u'&#{};'.format(name))
+
+    def handle_meta(self, attrs):
+        if attrs.get('charset'):
+            self.meta_charset = attrs['charset']
+        http_equiv = (attrs.get('http-equiv') or '').lower()
+        content = attrs.get('content')
+        if content is None:
+            return
+        if http_equiv == 'content-type':
+            self.meta_charset = cgi.parse_header(content)[1].get(
+                'charset', self.meta_charset)
+        elif 'refresh' in http_equiv:
+            location = parse_refresh(content, self.max_refresh_delay)
+            if location is not None:
+                self.refresh = location
+                self.done = True
+
+    def decode(self, text, charset=None):
+        """Decode *text* that was parsed as Latin-1 using *charset*, any
+        encoding declared by the document, or a best guess, and resolve
+        any entity references it contains."""
+        raw = text.encode('latin-1', 'xmlcharrefreplace')
+        for encoding in (charset, self.meta_charset):
+            if not encoding:
+                continue
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                continue
+            decoded = raw.decode(encoding, 'replace')
+            break
+        else:
+            try:
+                decoded = raw.decode('utf-8')
+            except UnicodeDecodeError:
+                decoded = raw.decode('windows-1252', 'replace')
+        return self.unescape(decoded)
+
+    def result(self, charset=None):
+        """Return a `Redirect` for any soft redirect found, the document
+        title as a Unicode string, or `None` if neither was found.  The
+        HTTP *charset*, if any, takes precedence over the document's
+        own encoding declaration."""
+        if self.refresh is not None:
+            return Redirect(self.decode(self.refresh, charset))
+        if self.title_parts is not None:
+            return u' '.join(
+                self.decode(u''.join(self.title_parts), charset).split())
+        return None
+
 
 class HTMLTitleExtractor(object):
     implements(ITitleExtractor)
@@ -31,6 +207,14 @@ class HTMLTitleExtractor(object):
         self.max_refresh_delay = 15
         #: Whether to ignore the contents of ``<noscript>`` elements.
         self.ignore_noscript = True
+        #: Whether to parse documents incrementally as they arrive and
+        #: stop downloading at the end of the document head.  Beautiful
+        #: Soup is still used if this is false, or if the incremental
+        #: parser can't make sense of the document.
+        self.streaming = True
+        #: The executor used to run Beautiful Soup, or `None` to use the
+        #: one returned by `.executors.get_default_executor`.
+        self.executor = None
 
     @inlineCallbacks
     def extract(self, response):
@@ -38,27 +222,32 @@ class HTMLTitleExtractor(object):
         # to use it to decode the document.
         params = cgi.parse_header(
             response.headers.getRawHeaders('Content-Type', [''])[0])[1]
-        content = yield read_body(response, max_bytes=self.max_download_bytes)
-        soup = BeautifulSoup(content, self.parser,
-                             from_encoding=params.get('charset'))
-        if self.ignore_noscript:
-            for noscript in soup('noscript'):
-                noscript.clear()
-        # Handle any <meta> refreshes.
-        for refresh in soup('meta', attrs=META_REFRESH_ATTRS):
-            seconds, params = cgi.parse_header(refresh['content'])
-            try:
-                seconds = int(seconds, 10)
-            except ValueError:
-                # Not a valid number; just pretend it's zero.
-                seconds = 0
-            if seconds <= self.max_refresh_delay and 'url' in params:
-                returnValue(Redirect(params['url']))
-        if soup.title:
-            # Join twice: once because soup.title.strings is an iterator
-            # and once after splitting to coalesce whitespace.
-            returnValue(u' '.join(u''.join(soup.title.strings).split()))
-        returnValue(None)
+        charset = params.get('charset')
+        if not self.streaming:
+            content = yield read_body(response,
+                                      max_bytes=self.max_download_bytes)
+            title = yield self.extract_from_soup(content, charset)
+            returnValue(title)
+        head_parser = HeadParser(self.max_refresh_delay,
+                                 self.ignore_noscript)
+        finished = Deferred()
+        response.deliverBody(ParsingReadBodyProtocol(
+            response.code, response.phrase, finished,
+            self.max_download_bytes, head_parser, response.length))
+        content = yield finished
+        head_parser.close()
+        if head_parser.failed:
+            title = yield self.extract_from_soup(content, charset)
+            returnValue(title)
+        returnValue(head_parser.result(charset))
+
+    def extract_from_soup(self, content, charset=None):
+        """Return a `Deferred` yielding the title or soft redirect in the
+        HTML document *content*, parsed with Beautiful Soup on this
+        extractor's executor."""
+        executor = self.executor or get_default_executor()
+        return executor.submit(soup_title, content, charset, self.parser,
+                               self.max_refresh_delay, self.ignore_noscript)
 
 
 extractor = HTMLTitleExtractor()
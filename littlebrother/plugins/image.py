@@ -3,16 +3,195 @@
 
 from __future__ import division
 from io import BytesIO
+import struct
 
 from PIL import Image
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 from twisted.web.iweb import UNKNOWN_LENGTH
 from zope.interface import implements
 
-from .. import ITitleExtractor, read_body
+from .. import ITitleExtractor, ParsingReadBodyProtocol, read_body
+from ..executors import get_default_executor
 from ..humanize import duration, filesize
 
 
+def probe_image(content, complete=True):
+    """Open the image *content* with Pillow and return a tuple of its
+    format, width, height, type (``'image'`` or ``'animation'``), and
+    animation duration in seconds, or `None` if the image can't be
+    opened.  The duration is only calculated if *complete* is true,
+    since frames may be missing otherwise, and is `None` if unknown."""
+    try:
+        image = Image.open(BytesIO(content))
+    except IOError:
+        # The image content is invalid.  It might be our fault for
+        # truncating the image too early.  Who knows?
+        return None
+    image_type = 'image'
+    image_duration = None
+    try:
+        if getattr(image, 'is_animated', False):
+            image_type = 'animation'
+            if complete:
+                # Assume a GIF animation.
+                frame_duration = image.info.get('duration')
+                if frame_duration is not None:
+                    image_duration = image.n_frames * frame_duration / 1000
+    except IOError:
+        # Couldn't seek because of truncated image.
+        pass
+    return image.format, image.width, image.height, image_type, image_duration
+
+
+class _NeedMoreData(Exception):
+    pass
+
+
+#: JPEG start-of-frame markers, which carry the image dimensions.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - frozenset([0xC4, 0xC8, 0xCC])
+
+
+class HeaderParser(object):
+    """An incremental parser that reads just enough of a PNG, GIF, or
+    JPEG image to learn its format and dimensions.  GIFs are read up to
+    their second frame to tell whether they are animated, and if
+    *complete* is true, to the end to find the animation duration, in
+    the same way as `probe_image`."""
+
+    def __init__(self, complete=True):
+        self.complete = complete
+        #: Whether the parser has seen everything it needs.
+        self.done = False
+        #: Whether the image is in a format this parser doesn't know, or
+        #: is malformed.
+        self.failed = False
+        self.format = None
+        self.width = None
+        self.height = None
+        self.frames = 0
+        self.frame_duration = None
+        self.buffer = bytearray()
+        self.offset = 0
+        self.step = self.parse_signature
+
+    def feed(self, data):
+        if self.done or self.failed:
+            return
+        self.buffer += data
+        try:
+            while not (self.done or self.failed):
+                self.step()
+        except _NeedMoreData:
+            pass
+        # Throw away everything already parsed.  If the offset is past
+        # the end of the buffer, the rest of the skip is carried over
+        # to the next call.
+        consumed = min(self.offset, len(self.buffer))
+        del self.buffer[:consumed]
+        self.offset -= consumed
+
+    def peek(self, size):
+        """Return the next *size* bytes without consuming them."""
+        if self.offset + size > len(self.buffer):
+            raise _NeedMoreData
+        return bytes(self.buffer[self.offset:self.offset + size])
+
+    def parse_signature(self):
+        if self.peek(2) == b'\xff\xd8':
+            self.format = 'JPEG'
+            self.offset += 2
+            self.step = self.parse_jpeg_segment
+        elif self.peek(6) in (b'GIF87a', b'GIF89a'):
+            self.format = 'GIF'
+            self.step = self.parse_gif_screen
+        elif self.peek(8) == b'\x89PNG\r\n\x1a\n':
+            self.format = 'PNG'
+            self.step = self.parse_png_header
+        else:
+            self.failed = True
+
+    def parse_png_header(self):
+        header = self.peek(24)
+        if header[12:16] != b'IHDR':
+            self.failed = True
+            return
+        self.width, self.height = struct.unpack('>II', header[16:24])
+        self.done = True
+
+    def parse_jpeg_segment(self):
+        marker = self.peek(2)
+        if marker[0] != b'\xff':
+            self.failed = True
+        elif marker[1] == b'\xff':
+            # Fill byte.
+            self.offset += 1
+        elif 0xD0 <= ord(marker[1]) <= 0xD9 or marker[1] == b'\x01':
+            # Standalone markers have no length field.
+            self.offset += 2
+        elif ord(marker[1]) in JPEG_SOF_MARKERS:
+            self.height, self.width = struct.unpack(
+                '>HH', self.peek(9)[5:9])
+            self.done = True
+        else:
+            self.offset += 2 + struct.unpack('>H', self.peek(4)[2:4])[0]
+
+    def parse_gif_screen(self):
+        screen = self.peek(13)
+        self.width, self.height, flags = struct.unpack('<HHB', screen[6:11])
+        self.offset += 13
+        if flags & 0x80:
+            self.offset += 3 << ((flags & 7) + 1)
+        self.step = self.parse_gif_block
+
+    def parse_gif_block(self):
+        introducer = self.peek(1)
+        if introducer == b'\x3b':
+            # Trailer.
+            self.done = True
+        elif introducer == b'\x21':
+            label = self.peek(2)[1]
+            if label == b'\xf9' and self.frames == 0:
+                # The first graphic control extension holds the delay of
+                # the first frame in hundredths of a second.
+                delay = struct.unpack('<H', self.peek(6)[4:6])[0]
+                self.frame_duration = delay * 10
+            self.offset += 2
+            self.step = self.skip_gif_sub_blocks
+        elif introducer == b'\x2c':
+            flags = ord(self.peek(10)[9])
+            self.offset += 10
+            if flags & 0x80:
+                self.offset += 3 << ((flags & 7) + 1)
+            # Skip the LZW minimum code size as well.
+            self.offset += 1
+            self.frames += 1
+            if self.frames > 1 and not self.complete:
+                self.done = True
+            else:
+                self.step = self.skip_gif_sub_blocks
+        else:
+            self.failed = True
+
+    def skip_gif_sub_blocks(self):
+        size = ord(self.peek(1))
+        self.offset += 1 + size
+        if size == 0:
+            self.step = self.parse_gif_block
+
+    def result(self):
+        """Return a tuple like the one `probe_image` would, or `None` if
+        the dimensions were never found.  For a GIF that ended early,
+        the duration is left unknown."""
+        if self.failed or self.width is None:
+            return None
+        image_type = 'animation' if self.frames > 1 else 'image'
+        image_duration = None
+        if (self.frames > 1 and self.done and self.complete and
+                self.frame_duration is not None):
+            image_duration = self.frames * self.frame_duration / 1000
+        return self.format, self.width, self.height, image_type, image_duration
+
+
 class ImageTitleExtractor(object):
     implements(ITitleExtractor)
     content_types = ('image/png', 'image/gif', 'image/jpeg')
@@ -20,35 +199,46 @@ class ImageTitleExtractor(object):
     def __init__(self):
         #: The maximum number of bytes this extractor will download.
         self.max_download_bytes = 65536
+        #: Whether `.TitleFetcher` should ask servers for only the first
+        #: `max_download_bytes` bytes of a file with a ``Range`` header.
+        self.range_requests = True
+        #: Whether to parse image headers as they arrive and stop
+        #: downloading as soon as the format and dimensions are known.
+        #: Pillow is still used if this is false, or if the header
+        #: parser can't make sense of the image.
+        self.streaming = True
+        #: The executor used to run Pillow, or `None` to use the one
+        #: returned by `.executors.get_default_executor`.
+        self.executor = None
 
     @inlineCallbacks
     def extract(self, response):
         truncated = (response.length is UNKNOWN_LENGTH or
                      response.length > self.max_download_bytes)
-        content = yield read_body(response, max_bytes=self.max_download_bytes)
-        try:
-            image = Image.open(BytesIO(content))
-        except IOError:
-            # The image content is invalid.  It might be our fault for
-            # truncating the image too early.  Who knows?
+        if self.streaming:
+            header_parser = HeaderParser(complete=not truncated)
+            finished = Deferred()
+            response.deliverBody(ParsingReadBodyProtocol(
+                response.code, response.phrase, finished,
+                self.max_download_bytes, header_parser,
+                response.length, as_buffer=True))
+            content = yield finished
+            probed = header_parser.result()
+        else:
+            content = yield read_body(response,
+                                      max_bytes=self.max_download_bytes,
+                                      as_buffer=True)
+            probed = None
+        if probed is None:
+            executor = self.executor or get_default_executor()
+            probed = yield executor.submit(probe_image, content, not truncated)
+        if probed is None:
             returnValue(None)
-        image_type = 'image'
-        image_duration = u''
-        try:
-            if getattr(image, 'is_animated', False):
-                image_type = 'animation'
-                if not truncated:
-                    # Assume a GIF animation.
-                    frame_duration = image.info.get('duration') / 1000
-                    if frame_duration is not None:
-                        image_duration = u', {}'.format(
-                            duration(image.n_frames * frame_duration))
-        except IOError:
-            # Couldn't seek because of truncated image.
-            pass
+        image_format, width, height, image_type, image_duration = probed
         returnValue(u'{} {} ({:n} \u00d7 {:n} pixels{}{})'.format(
-            image.format, image_type,
-            image.width, image.height, image_duration,
+            image_format, image_type, width, height,
+            (u'' if image_duration is None
+                 else u', ' + duration(image_duration)),
             (u'' if response.length is UNKNOWN_LENGTH
                  else u', ' + filesize(response.length))))
 
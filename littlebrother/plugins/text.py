@@ -26,7 +26,8 @@ class PlainTextTitleExtractor(object):
         params = cgi.parse_header(
             response.headers.getRawHeaders('Content-Type', [''])[0])[1]
         encoding = params.get('charset', self.default_encoding)
-        content = yield read_body(response, max_bytes=self.max_download_bytes)
+        content = yield read_body(response, max_bytes=self.max_download_bytes,
+                                  as_buffer=True)
         try:
             decoded = content.decode(encoding, 'replace')
         except LookupError:  # someone gave us a bad encoding name
@@ -0,0 +1,256 @@
+"""A long-running HTTP service that fetches titles for other programs.
+
+A `TitleService` sends every lookup through one shared `.TitleFetcher`,
+so that all clients benefit from its connection pool, caches, and
+sharing of identical fetches in flight.  `ServiceResource` exposes it
+over HTTP, with JSON responses:
+
+``GET /title?url=URL``
+    Fetch the title of *URL*, and respond with an object holding the
+    ``url`` and either its ``title``, or an ``error`` description and
+    ``error_class``.
+``POST /titles``
+    Fetch the title of each URL in the JSON array in the request body,
+    or in the ``urls`` array of a JSON object, and stream back one such
+    object per line as each fetch finishes, with the URL's ``index`` in
+    the request added.
+``GET /status``
+    Respond with the numbers of fetches running, queued, and shed.
+
+Both lookup endpoints accept a ``hostname_tag`` query parameter to
+prefix titles with hostname tags, and a ``priority`` parameter naming
+one of the classes in `.PRIORITIES`.  Single lookups are
+``interactive`` by default, and batches ``bulk``, so that people waiting
+on a title aren't stuck behind a backfill.  When accepting a request
+would put more URLs in the queue than it allows, the service responds
+with a 503 status and the current ``queue_depth`` instead.  Queued URLs
+that are shed later, to make room for more urgent ones or because they
+waited too long, get an ``overloaded`` error.
+"""
+
+
+import json
+
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from . import PRIORITIES, AdmissionQueue, classify_error, describe_error
+
+
+class TitleService(object):
+    """Fetches titles with *fetcher*, running at most *max_concurrent*
+    fetches at once and queueing up to *max_queued* more by priority in
+    an `.AdmissionQueue`, which sheds those that have waited *max_age*
+    seconds according to *clock*.  The queue becomes the fetcher's
+    ``admission`` queue, so lookups answered from its cache or sharing a
+    fetch already in flight skip it.  If *timeout* is given, each fetch
+    gives up after that many seconds."""
+
+    def __init__(self, fetcher, max_concurrent=64, max_queued=1024,
+                 max_age=10, timeout=None, clock=None):
+        self.fetcher = fetcher
+        self.timeout = timeout
+        #: The `.AdmissionQueue` every fetch passes through.
+        self.admission = fetcher.admission = AdmissionQueue(
+            max_concurrent, max_queued, max_age, clock=clock)
+
+    def has_room(self, count=1, priority='default'):
+        """Return whether *count* more lookups of *priority* can start
+        or be queued."""
+        return self.admission.has_room(count, priority)
+
+    def lookup(self, url, hostname_tag=False, priority='default'):
+        """Return a `Deferred` yielding the title of *url*, fetched once
+        the admission queue lets a fetch of *priority* start.
+        Cancelling it while it is still queued frees its place in the
+        queue."""
+        return self.fetcher.fetch_title(url, hostname_tag=hostname_tag,
+                                        timeout=self.timeout,
+                                        priority=priority)
+
+    def status(self):
+        """Return a dictionary describing this service's load."""
+        return {'active': self.admission.active,
+                'queued': self.admission.queued,
+                'shed': self.admission.shed,
+                'max_concurrent': self.admission.max_active,
+                'max_queued': self.admission.max_queued}
+
+
+def result_object(url, result):
+    """Return a JSON-serializable dictionary describing *result*, either
+    a title or the `Failure` of an attempt to fetch *url*."""
+    if not isinstance(result, Failure):
+        return {'url': url, 'title': result}
+    description = describe_error(result)
+    if description is result:
+        description = result.getErrorMessage().decode('utf-8', 'replace')
+    return {'url': url, 'error': description,
+            'error_class': classify_error(result) or result.type.__name__}
+
+
+def json_line(value):
+    """Return *value* serialized as a line of JSON."""
+    return json.dumps(value, sort_keys=True) + '\n'
+
+
+def respond(request, code, value):
+    """Set the response *code* for *request*, and return *value* as the
+    JSON response body."""
+    request.setResponseCode(code)
+    request.setHeader('Content-Type', 'application/json')
+    return json_line(value)
+
+
+def refuse_overloaded(request, service):
+    """Return a 503 response to *request* saying that *service* has no
+    room in its queue."""
+    request.setHeader('Retry-After', '1')
+    return respond(request, 503, {
+        'error': u'The title service is overloaded; try again later.',
+        'queue_depth': service.admission.queued})
+
+
+def hostname_tag_requested(request):
+    value = request.args.get('hostname_tag', ['0'])[0]
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def requested_priority(request, default):
+    """Return the priority class in the ``priority`` query parameter of
+    *request*, *default* if there is none, or `None` if it's invalid."""
+    priority = request.args.get('priority', [default])[0]
+    return priority if priority in PRIORITIES else None
+
+
+def refuse_priority(request):
+    return respond(request, 400, {
+        'error': u'The "priority" query parameter must be one of {}.'
+                 .format(u', '.join(PRIORITIES))})
+
+
+class LookupResource(Resource):
+    """Base class for resources that look up titles with a
+    `TitleService`."""
+    isLeaf = True
+
+    def __init__(self, service):
+        Resource.__init__(self)
+        self.service = service
+
+    def watch_disconnect(self, request, lookups):
+        """Cancel every `Deferred` in *lookups* that is still waiting if
+        the client goes away before *request* is finished.  Return a
+        list that becomes nonempty when that happens."""
+        gone = []
+        def cancel(reason):
+            gone.append(reason)
+            for lookup in lookups:
+                lookup.cancel()
+        request.notifyFinish().addErrback(cancel)
+        return gone
+
+
+class TitleResource(LookupResource):
+    """Looks up one title per request, as an ``interactive`` fetch
+    unless another priority is requested."""
+
+    def render_GET(self, request):
+        url = request.args.get('url', [''])[0].decode('utf-8', 'replace')
+        if not url:
+            return respond(request, 400, {
+                'error': u'The "url" query parameter is required.'})
+        priority = requested_priority(request, 'interactive')
+        if priority is None:
+            return refuse_priority(request)
+        if not self.service.has_room(1, priority):
+            return refuse_overloaded(request, self.service)
+        lookup = self.service.lookup(url, hostname_tag_requested(request),
+                                     priority)
+        gone = self.watch_disconnect(request, [lookup])
+        def finish(result):
+            if gone:
+                return
+            body = result_object(url, result)
+            request.write(respond(request, 200 if 'title' in body else 502,
+                                  body))
+            request.finish()
+        lookup.addBoth(finish)
+        lookup.addErrback(log.err, 'Error finishing title request')
+        return NOT_DONE_YET
+
+
+class BatchResource(LookupResource):
+    """Looks up up to *max_batch* titles per request, as ``bulk``
+    fetches unless another priority is requested, streaming back the
+    results as newline-delimited JSON in the order they finish."""
+
+    def __init__(self, service, max_batch=1000):
+        LookupResource.__init__(self, service)
+        self.max_batch = max_batch
+
+    def render_POST(self, request):
+        try:
+            urls = json.loads(request.content.read())
+            if isinstance(urls, dict):
+                urls = urls['urls']
+            if not (isinstance(urls, list) and
+                    all(isinstance(url, basestring) for url in urls)):
+                raise ValueError
+        except (ValueError, KeyError):
+            return respond(request, 400, {
+                'error': u'The request body must be a JSON array of URLs, '
+                         u'or an object with a "urls" array.'})
+        if len(urls) > self.max_batch:
+            return respond(request, 413, {
+                'error': u'At most {} URLs are accepted at once.'.format(
+                    self.max_batch)})
+        priority = requested_priority(request, 'bulk')
+        if priority is None:
+            return refuse_priority(request)
+        if not self.service.has_room(len(urls), priority):
+            return refuse_overloaded(request, self.service)
+        request.setHeader('Content-Type', 'application/x-ndjson')
+        if not urls:
+            return ''
+        hostname_tag = hostname_tag_requested(request)
+        lookups = []
+        gone = self.watch_disconnect(request, lookups)
+        remaining = [len(urls)]
+        def finish(result, index, url):
+            remaining[0] -= 1
+            if gone:
+                return
+            body = result_object(url, result)
+            body['index'] = index
+            request.write(json_line(body))
+            if not remaining[0]:
+                request.finish()
+        for index, url in enumerate(urls):
+            lookup = self.service.lookup(url, hostname_tag, priority)
+            lookup.addBoth(finish, index, url)
+            lookup.addErrback(log.err, 'Error streaming title result')
+            lookups.append(lookup)
+        return NOT_DONE_YET
+
+
+class StatusResource(LookupResource):
+    """Reports the load on a `TitleService`."""
+
+    def render_GET(self, request):
+        return respond(request, 200, self.service.status())
+
+
+class ServiceResource(Resource):
+    """The root resource of the HTTP interface to *service*, a
+    `TitleService`, accepting up to *max_batch* URLs per batch
+    request."""
+
+    def __init__(self, service, max_batch=1000):
+        Resource.__init__(self)
+        self.service = service
+        self.putChild('title', TitleResource(service))
+        self.putChild('titles', BatchResource(service, max_batch))
+        self.putChild('status', StatusResource(service))
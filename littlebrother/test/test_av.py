@@ -3,10 +3,14 @@
 
 from twisted.trial.unittest import TestCase
 
-from .. import Redirect
-from ..plugins.av import extractor
 from .helpers import CassetteTestMixin
 
+try:
+    from ..plugins.av import extractor, AVTitleExtractor
+except ImportError:
+    extractor = AVTitleExtractor = None
+    skip = 'PyAV is not installed'
+
 
 class AVTestCase(CassetteTestMixin, TestCase):
     extractor = extractor
@@ -41,3 +45,17 @@ class AVTestCase(CassetteTestMixin, TestCase):
             'av/webm-no-audio',
             u'Matroska / WebM file containing On2 VP8 video (5 sec, '
             u'116 KB)')
+
+
+class BufferedAVTestCase(AVTestCase):
+    def setUp(self):
+        self.extractor = AVTitleExtractor()
+        self.extractor.streaming = False
+
+
+class BusyAVTestCase(AVTestCase):
+    def setUp(self):
+        # With no streaming probe threads free, files are downloaded
+        # before they are probed.
+        self.extractor = AVTitleExtractor()
+        self.extractor.max_streaming_probes = 0
@@ -0,0 +1,126 @@
+"""Tests for the benchmark harness."""
+
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+from twisted.web.server import Site
+
+from .. import ExtractorRegistry
+from ..bench.extractors import (Case, PayloadResponse, cassette_cases,
+                                compare, run)
+from ..bench.pipeline import (benchmark_fetcher, make_urls, percentile,
+                              run_level)
+from ..bench.server import (SyntheticResource, html_payload, mp3_payload,
+                            png_payload)
+from ..plugins.image import HeaderParser
+from ..plugins.text import PlainTextTitleExtractor
+
+
+class PayloadTestCase(TestCase):
+    def test_html_size(self):
+        self.assertApproximates(len(html_payload(16384)), 16384, 64)
+
+    def test_png(self):
+        parser = HeaderParser()
+        parser.feed(png_payload(32, 16))
+        self.assertEqual(parser.result()[:3], ('PNG', 32, 16))
+
+    def test_mp3(self):
+        payload = mp3_payload(frames=3)
+        self.assertEqual(len(payload), 3 * 417)
+        self.assertEqual(payload.count('\xff\xfb'), 3)
+
+
+class MakeURLsTestCase(TestCase):
+    def test_reproducible(self):
+        mix = {'page.html': 1, 'image.png': 1}
+        self.assertEqual(make_urls('127.0.0.1', 80, 50, mix, seed=1),
+                         make_urls('127.0.0.1', 80, 50, mix, seed=1))
+
+    def test_detours(self):
+        urls = make_urls('127.0.0.1', 80, 100, {'notes.txt': 1},
+                         redirects=0.5, refreshes=0.5, redirect_depth=3)
+        self.assertEqual(len(set(urls)), 100)
+        self.assertTrue(all('/redirect/3/notes.txt?' in url or
+                            '/refresh/notes.txt?' in url for url in urls))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertIdentical(percentile([], 0.5), None)
+
+
+class PipelineTestCase(TestCase):
+    def setUp(self):
+        self.resource = SyntheticResource(html_size=2048, trickle_bytes=512,
+                                          trickle_interval=0)
+        port = reactor.listenTCP(0, Site(self.resource),
+                                 interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.port = port.getHost().port
+
+    @inlineCallbacks
+    def test_run_level(self):
+        urls = make_urls('127.0.0.1', self.port, 12,
+                         {'page.html': 1, 'notes.txt': 1, 'image.png': 1},
+                         hosts=2, redirects=0.25, refreshes=0.25)
+        fetcher = benchmark_fetcher(reactor, '127.0.0.1', self.port, 4)
+        stats = yield run_level(reactor, fetcher, urls, 4, 2)
+        self.assertEqual((stats['titles'], stats['errors']), (12, {}))
+        self.assertTrue(stats['p50_latency'] <= stats['p99_latency'])
+        self.assertTrue(stats['bytes_downloaded'] > 0)
+        self.assertTrue(self.resource.requests >= 12)
+
+
+class ExtractorBenchmarkTestCase(TestCase):
+    def setUp(self):
+        self.registry = ExtractorRegistry([PlainTextTitleExtractor()],
+                                          entry_points={},
+                                          scan_plugins=False)
+        self.case = Case('text/lines', 'text/plain; charset=utf-8',
+                         'first line\n' + 'x' * 20000, 20011)
+
+    def test_stops_delivery(self):
+        chunks = []
+        class Protocol(object):
+            def makeConnection(self, transport):
+                self.transport = transport
+            def dataReceived(self, data):
+                chunks.append(data)
+                self.transport.stopProducing()
+            def connectionLost(self, reason):
+                chunks.append(reason)
+        PayloadResponse(self.case, chunk_size=1000).deliverBody(Protocol())
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(len(chunks[0]), 1000)
+
+    def test_cassette_cases(self):
+        cases = dict((case.name, case) for case in cassette_cases())
+        case = cases['cassette/image/gif-animated-truncated']
+        self.assertEqual(case.content_type, 'image/gif')
+        self.assertTrue(len(case.body) < case.length)
+
+    @inlineCallbacks
+    def test_run(self):
+        results = yield run([self.case, Case('image/none', 'image/png',
+                                             '', 0)],
+                            registry=self.registry, iterations=2, repeat=1)
+        self.assertEqual(results['cases'].keys(), ['text/lines'])
+        result = results['cases']['text/lines']
+        self.assertEqual(result['title'], u'first line')
+        self.assertTrue(result['relative'] > 0)
+
+    def test_compare(self):
+        def results(relative, objects, title=u'first line'):
+            return {'cases': {'text/lines': {
+                'relative': relative, 'objects': objects, 'title': title}}}
+        baseline = results(1.0, 20)
+        self.assertEqual(compare(results(1.2, 30), baseline), [])
+        self.assertEqual(
+            compare(results(1.5, 40, u'other'), baseline),
+            [('text/lines', 'time up 50%'),
+             ('text/lines', '20 more objects left alive'),
+             ('text/lines', "title changed to u'other'")])
+        self.assertEqual(compare(results(9.0, 20), {'cases': {}}), [])
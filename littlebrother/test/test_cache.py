@@ -0,0 +1,222 @@
+"""Tests for title caches."""
+
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from ..cache import (CachedTitle, RedirectCache, SQLiteTitleCache,
+                     TitleCache)
+
+
+class TitleCacheTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = TitleCache(max_entries=2, ttl=60, error_ttl=10,
+                                clock=self.clock)
+
+    def test_miss(self):
+        self.assertIdentical(self.cache.get('http://foo.test/'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+    def test_hit(self):
+        value = CachedTitle(u'hello world', u'foo.test', False)
+        self.cache.put('http://foo.test/', value)
+        self.assertEqual(self.cache.get('http://foo.test/'), value)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_expiry(self):
+        self.cache.put('http://foo.test/',
+                       CachedTitle(u'hello world', u'foo.test', False))
+        self.cache.put('http://bar.test/',
+                       CachedTitle(u'Could not connect to server.',
+                                   None, True))
+        self.clock.advance(10)
+        self.assertIdentical(self.cache.get('http://bar.test/'), None)
+        self.assertNotIdentical(self.cache.get('http://foo.test/'), None)
+        self.clock.advance(50)
+        self.assertIdentical(self.cache.get('http://foo.test/'), None)
+
+    def test_lru_eviction(self):
+        for host in ('foo', 'bar'):
+            self.cache.put('http://{}.test/'.format(host),
+                           CachedTitle(host, host, False))
+        self.cache.get('http://foo.test/')
+        self.cache.put('http://baz.test/', CachedTitle('baz', 'baz', False))
+        self.assertEqual(len(self.cache), 2)
+        self.assertIdentical(self.cache.get('http://bar.test/'), None)
+        self.assertNotIdentical(self.cache.get('http://foo.test/'), None)
+        self.assertNotIdentical(self.cache.get('http://baz.test/'), None)
+
+    def test_zero_ttl(self):
+        self.cache.error_ttl = 0
+        self.cache.put('http://foo.test/',
+                       CachedTitle(u'Could not connect to server.',
+                                   None, True))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_age(self):
+        self.cache.put('http://foo.test/',
+                       CachedTitle(u'hello world', u'foo.test', False,
+                                   max_age=120))
+        self.clock.advance(119)
+        self.assertNotIdentical(self.cache.get('http://foo.test/'), None)
+        self.clock.advance(1)
+        self.assertIdentical(self.cache.get('http://foo.test/'), None)
+
+    def test_stale_with_validators(self):
+        value = CachedTitle(u'hello world', u'foo.test', False,
+                            etag='"abc"', max_age=0)
+        self.cache.put('http://foo.test/', value)
+        self.assertIdentical(self.cache.get('http://foo.test/'), None)
+        self.assertEqual(self.cache.get_stale('http://foo.test/'), value)
+
+    def test_stale_without_validators(self):
+        self.cache.put('http://foo.test/',
+                       CachedTitle(u'hello world', u'foo.test', False))
+        self.clock.advance(60)
+        self.assertIdentical(self.cache.get('http://foo.test/'), None)
+        self.assertIdentical(self.cache.get_stale('http://foo.test/'), None)
+
+
+class RedirectCacheTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = RedirectCache(max_entries=2, soft_ttl=60,
+                                   clock=self.clock)
+
+    def test_ttl_by_code(self):
+        self.cache.ttls = {301: 120}
+        self.cache.put(u'http://a.test/', u'http://b.test/', 301)
+        self.cache.put(u'http://c.test/', u'http://d.test/')
+        self.cache.put(u'http://e.test/', u'http://f.test/', 302)
+        self.assertEqual(len(self.cache), 2)
+        self.clock.advance(60)
+        self.assertIdentical(self.cache.get(u'http://c.test/'), None)
+        self.assertEqual(self.cache.get(u'http://a.test/'),
+                         (u'http://b.test/', False))
+        self.clock.advance(60)
+        self.assertIdentical(self.cache.get(u'http://a.test/'), None)
+
+    def test_max_age(self):
+        self.cache.put(u'http://a.test/', u'http://b.test/', 301, max_age=0)
+        self.assertIdentical(self.cache.get(u'http://a.test/'), None)
+
+    def test_resolve(self):
+        self.cache.put(u'http://a.test/', u'http://b.test/', 301)
+        self.cache.put(u'http://b.test/', u'http://c.test/')
+        self.assertEqual(self.cache.resolve(u'http://a.test/'),
+                         (u'http://c.test/', True))
+        self.assertEqual(self.cache.resolve(u'http://c.test/'),
+                         (u'http://c.test/', False))
+
+    def test_resolve_loop(self):
+        self.cache.put(u'http://a.test/', u'http://b.test/', 301)
+        self.cache.put(u'http://b.test/', u'http://a.test/', 301)
+        self.assertEqual(self.cache.resolve(u'http://a.test/'),
+                         (u'http://a.test/', False))
+
+    def test_lru_eviction(self):
+        self.cache.put(u'http://a.test/', u'http://b.test/', 301)
+        self.cache.put(u'http://c.test/', u'http://d.test/', 301)
+        self.cache.get(u'http://a.test/')
+        self.cache.put(u'http://e.test/', u'http://f.test/', 301)
+        self.assertIdentical(self.cache.get(u'http://c.test/'), None)
+        self.assertNotIdentical(self.cache.get(u'http://a.test/'), None)
+
+
+class SQLiteTitleCacheTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+        self.cache = self.open_cache()
+
+    def open_cache(self):
+        cache = SQLiteTitleCache(self.path, max_entries=2, ttl=60,
+                                 error_ttl=10, clock=self.clock)
+        self.addCleanup(cache.close)
+        return cache
+
+    @inlineCallbacks
+    def test_miss(self):
+        value = yield self.cache.get(u'http://foo.test/')
+        self.assertIdentical(value, None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+    @inlineCallbacks
+    def test_hit(self):
+        value = CachedTitle(u'hello world', u'foo.test', False)
+        yield self.cache.put(u'http://foo.test/', value)
+        cached = yield self.cache.get(u'http://foo.test/')
+        self.assertEqual(cached, value)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    @inlineCallbacks
+    def test_persistence(self):
+        value = CachedTitle(u'h\xe9llo world', u'foo.test', False,
+                            etag='"\xe9"', last_modified='yesterday')
+        yield self.cache.put(u'http://foo.test/', value)
+        self.cache.close()
+        cached = yield self.open_cache().get(u'http://foo.test/')
+        self.assertEqual(cached, value)
+        self.assertIsInstance(cached.etag, str)
+
+    @inlineCallbacks
+    def test_shared(self):
+        other = self.open_cache()
+        value = CachedTitle(u'hello world', u'foo.test', False)
+        yield self.cache.put(u'http://foo.test/', value)
+        cached = yield other.get(u'http://foo.test/')
+        self.assertEqual(cached, value)
+
+    @inlineCallbacks
+    def test_expiry(self):
+        yield self.cache.put(u'http://foo.test/',
+                             CachedTitle(u'hello world', u'foo.test', False))
+        yield self.cache.put(u'http://bar.test/',
+                             CachedTitle(u'Could not connect to server.',
+                                         None, True))
+        self.clock.advance(10)
+        cached = yield self.cache.get(u'http://bar.test/')
+        self.assertIdentical(cached, None)
+        cached = yield self.cache.get(u'http://foo.test/')
+        self.assertNotIdentical(cached, None)
+        self.clock.advance(50)
+        cached = yield self.cache.get(u'http://foo.test/')
+        self.assertIdentical(cached, None)
+        cached = yield self.cache.get_stale(u'http://foo.test/')
+        self.assertIdentical(cached, None)
+
+    @inlineCallbacks
+    def test_stale_with_validators(self):
+        value = CachedTitle(u'hello world', u'foo.test', False,
+                            etag='"abc"', max_age=0)
+        yield self.cache.put(u'http://foo.test/', value)
+        cached = yield self.cache.get(u'http://foo.test/')
+        self.assertIdentical(cached, None)
+        cached = yield self.cache.get_stale(u'http://foo.test/')
+        self.assertEqual(cached, value._replace(max_age=None))
+
+    @inlineCallbacks
+    def test_lru_eviction(self):
+        for host in (u'foo', u'bar'):
+            yield self.cache.put(u'http://{}.test/'.format(host),
+                                 CachedTitle(host, host, False))
+            self.clock.advance(1)
+        yield self.cache.get(u'http://foo.test/')
+        self.clock.advance(1)
+        yield self.cache.put(u'http://baz.test/',
+                             CachedTitle(u'baz', u'baz', False))
+        cached = yield self.cache.get(u'http://bar.test/')
+        self.assertIdentical(cached, None)
+        for host in (u'foo', u'baz'):
+            cached = yield self.cache.get(u'http://{}.test/'.format(host))
+            self.assertNotIdentical(cached, None)
+
+    @inlineCallbacks
+    def test_clear(self):
+        yield self.cache.put(u'http://foo.test/',
+                             CachedTitle(u'hello world', u'foo.test', False))
+        yield self.cache.clear()
+        cached = yield self.cache.get_stale(u'http://foo.test/')
+        self.assertIdentical(cached, None)
@@ -0,0 +1,66 @@
+"""Tests for CPU-bound work executors."""
+
+
+import cPickle as pickle
+import threading
+import time
+
+from twisted.trial.unittest import TestCase
+
+from ..executors import (ExecutorClosed, InlineExecutor, ProcessExecutor,
+                         ThreadExecutor)
+
+
+def current_thread_name():
+    return threading.current_thread().name
+
+
+class InlineExecutorTestCase(TestCase):
+    def test_submit(self):
+        d = InlineExecutor().submit(current_thread_name)
+        self.assertEqual(self.successResultOf(d),
+                         threading.current_thread().name)
+
+    def test_failure(self):
+        self.failureResultOf(InlineExecutor().submit(int, 'x'), ValueError)
+
+
+class ThreadExecutorTestCase(TestCase):
+    def setUp(self):
+        self.executor = ThreadExecutor(size=1)
+        self.addCleanup(self.executor.close)
+
+    def test_submit(self):
+        d = self.executor.submit(current_thread_name)
+        d.addCallback(self.assertNotEqual, threading.current_thread().name)
+        return d
+
+    def test_failure(self):
+        return self.assertFailure(self.executor.submit(int, 'x'), ValueError)
+
+
+class ProcessExecutorTestCase(TestCase):
+    def setUp(self):
+        self.executor = ProcessExecutor(size=1)
+        self.addCleanup(self.executor.close)
+
+    def test_submit(self):
+        d = self.executor.submit(sum, [1, 2, 3])
+        d.addCallback(self.assertEqual, 6)
+        return d
+
+    def test_failure(self):
+        return self.assertFailure(self.executor.submit(int, 'x'), ValueError)
+
+    def test_unpicklable_arguments(self):
+        self.failureResultOf(self.executor.submit(len, lambda: None),
+                             pickle.PicklingError)
+
+    def test_unpicklable_result(self):
+        return self.assertFailure(self.executor.submit(threading.Lock),
+                                  pickle.PicklingError)
+
+    def test_close(self):
+        d = self.executor.submit(time.sleep, 60)
+        self.executor.close()
+        self.failureResultOf(d, ExecutorClosed)
@@ -1,10 +1,15 @@
+# -*- coding: utf-8
 """Tests for HTML title extraction."""
 
 
 from twisted.trial.unittest import TestCase
+from twisted.web.client import Response
+from twisted.web.http_headers import Headers
+from twisted.web.test.test_agent import AbortableStringTransport
 
 from .. import Redirect
-from ..plugins.html import extractor
+from ..executors import ThreadExecutor
+from ..plugins.html import extractor, HTMLTitleExtractor
 from .helpers import CassetteTestMixin
 
 
@@ -23,3 +28,81 @@ class HTMLTestCase(CassetteTestMixin, TestCase):
 
     def test_noscript_meta_refresh(self):
         return self.assert_title('html/noscript-meta-refresh', u'hello world')
+
+
+class SoupHTMLTestCase(HTMLTestCase):
+    def setUp(self):
+        self.extractor = HTMLTitleExtractor()
+        self.extractor.streaming = False
+        self.extractor.executor = ThreadExecutor(size=1)
+        self.addCleanup(self.extractor.executor.close)
+
+
+class StreamingHTMLTestCase(TestCase):
+    def setUp(self):
+        self.transport = AbortableStringTransport()
+
+    def deliver(self, chunks, content_type='text/html', finish=False):
+        headers = Headers({'Content-Type': [content_type]})
+        response = Response(('HTTP', 1, 1), 200, 'OK', headers,
+                            self.transport)
+        finished = extractor.extract(response)
+        for chunk in chunks:
+            response._bodyDataReceived(chunk)
+        if finish:
+            response._bodyDataFinished()
+        return finished
+
+    def test_stop_at_head_end(self):
+        finished = self.deliver(['<html><head><ti', 'tle>hello  world',
+                                 '</title></head><body>', 'lorem ipsum'])
+        self.assertEqual(self.successResultOf(finished), u'hello world')
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_stop_at_implicit_body(self):
+        finished = self.deliver(['<title>hello world</title><p>lorem'])
+        self.assertEqual(self.successResultOf(finished), u'hello world')
+
+    def test_stop_at_meta_refresh(self):
+        finished = self.deliver([
+            '<head><meta http-equiv="Refresh" '
+            'content="0; url=http://foo.test/&#x2603;">'])
+        self.assertEqual(self.successResultOf(finished),
+                         Redirect(u'http://foo.test/☃'))
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_refresh_after_title(self):
+        finished = self.deliver([
+            '<head><title>hello world</title><meta http-equiv="refresh" '
+            'content="0;url=http://foo.test/"></head>'])
+        self.assertEqual(self.successResultOf(finished),
+                         Redirect(u'http://foo.test/'))
+
+    def test_end_of_document(self):
+        finished = self.deliver(['<title>hello world</title>'], finish=True)
+        self.assertEqual(self.successResultOf(finished), u'hello world')
+
+    def test_no_title(self):
+        finished = self.deliver(['<html><body>hello world'])
+        self.assertIdentical(self.successResultOf(finished), None)
+
+    def test_http_charset(self):
+        finished = self.deliver(
+            ['<title>caf\xe9 &amp; &eacute;clair</title><body>'],
+            content_type='text/html; charset=iso-8859-1')
+        self.assertEqual(self.successResultOf(finished),
+                         u'café & éclair')
+
+    def test_meta_charset(self):
+        finished = self.deliver([
+            '<meta charset="shift_jis"><title>\x83e\x83X\x83g</title>'
+            '<body>'])
+        self.assertEqual(self.successResultOf(finished), u'テスト')
+
+    def test_undeclared_utf8(self):
+        finished = self.deliver(['<title>caf\xc3\xa9</title><body>'])
+        self.assertEqual(self.successResultOf(finished), u'café')
+
+    def test_undeclared_windows_1252(self):
+        finished = self.deliver(['<title>caf\xe9</title><body>'])
+        self.assertEqual(self.successResultOf(finished), u'café')
@@ -2,17 +2,79 @@
 """Tests for HTTP machinery."""
 
 
-from twisted.internet.defer import Deferred, succeed
-from twisted.internet.error import ConnectError
+import os
+import zlib
+
+from twisted.internet.defer import CancelledError, Deferred, fail, succeed
+from twisted.internet.error import (ConnectError, ConnectionDone,
+                                    DNSLookupError)
+from twisted.internet.protocol import Factory
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
+from twisted.python.url import URL
 from twisted.trial.unittest import TestCase
 from twisted.web.client import RedirectAgent, Response, ResponseFailed
 from twisted.web.http_headers import Headers
+from twisted.test.proto_helpers import MemoryReactor, StringTransport
+from twisted.web.client import URI
+from twisted.web._newclient import TransportProxyProducer
 from twisted.web.test.test_agent import (
     AbortableStringTransport, AgentTestsMixin, FakeReactorAndConnectMixin)
 
-from .. import (TruncatingReadBodyProtocol, BlacklistingAgent,
-                BlacklistedHost, TitleFetcher, Redirect)
+from .. import (BodyBuffer, BodyFile, BodyFileProtocol,
+                ParsingReadBodyProtocol, TruncatingReadBodyProtocol,
+                ConnectionPool, DecodingProtocol, DeflateStream, GzipStream,
+                BrotliStream,
+                brotli, content_decoders,
+                FetchTimeout, CachingResolver, PinnedEndpointFactory,
+                BlacklistingAgent, BlacklistedHost, TitleFetcher, Redirect,
+                ThrottlingAgent, AdmissionQueue, Overloaded, classify_error,
+                parse_retry_after, read_body)
+from ..cache import CachedTitle, TitleCache
+from ..metrics import FetchMetrics
+
+
+class BodyBufferTestCase(TestCase):
+    def test_single_chunk(self):
+        data = '#' * 4
+        body = BodyBuffer(max_bytes=8)
+        self.assertFalse(body.write(data))
+        self.assertIdentical(body.getvalue(), data)
+
+    def test_preallocated(self):
+        body = BodyBuffer(max_bytes=8, length=6)
+        self.assertEqual(body.capacity, 6)
+        body.write('abc')
+        body.write('def')
+        buf = body.getbuffer()
+        self.assertEqual(buf, bytearray('abcdef'))
+        self.assertIdentical(body.getbuffer(), buf)
+
+    def test_truncated(self):
+        body = BodyBuffer(max_bytes=8)
+        self.assertFalse(body.write('abcde'))
+        self.assertTrue(body.write('fghij'))
+        self.assertTrue(body.write('klm'))
+        self.assertEqual((body.size, body.remaining), (8, 0))
+        self.assertEqual(body.getvalue(), 'abcdefgh')
+
+    def test_longer_than_expected(self):
+        body = BodyBuffer(length=2)
+        body.write('abc')
+        body.write('def')
+        self.assertEqual(body.getvalue(), 'abcdef')
+
+    def test_unlimited_length_claimed(self):
+        body = BodyBuffer(length=10 ** 12)
+        self.assertEqual(body.capacity, BodyBuffer.max_preallocated)
+        body.write('abc')
+        body.write('def')
+        self.assertEqual(body.getvalue(), 'abcdef')
+
+    def test_empty(self):
+        body = BodyBuffer()
+        self.assertEqual(body.getvalue(), '')
+        self.assertEqual(body.getbuffer(), bytearray())
 
 
 class TruncatingReadBodyProtocolTestCase(TestCase):
@@ -34,6 +96,175 @@ class TruncatingReadBodyProtocolTestCase(TestCase):
     def test_truncated(self):
         return self.assert_delivery('#' * 16, '#' * 8)
 
+    def test_as_buffer(self):
+        finished = Deferred()
+        response = Response(('HTTP', 1, 1), 200, 'OK', Headers(),
+                            AbortableStringTransport())
+        response.deliverBody(TruncatingReadBodyProtocol(
+            response.code, response.phrase, finished, max_bytes=8,
+            as_buffer=True))
+        response._bodyDataReceived('#' * 4)
+        response._bodyDataReceived('#' * 8)
+        response._bodyDataFinished()
+        self.assertEqual(self.successResultOf(finished), bytearray('#' * 8))
+
+    def test_producer_only_transport(self):
+        # Twisted before 17.1 gives body protocols a transport without a
+        # loseConnection method.
+        transport = StringTransport()
+        protocol = TruncatingReadBodyProtocol(200, 'OK', Deferred(),
+                                              max_bytes=8)
+        protocol.makeConnection(TransportProxyProducer(transport))
+        protocol.dataReceived('#' * 16)
+        self.assertEqual(transport.producerState, 'stopped')
+
+    def test_exact_fit(self):
+        transport = AbortableStringTransport()
+        response = Response(('HTTP', 1, 1), 206, 'Partial Content',
+                            Headers(), transport)
+        finished = Deferred()
+        response.deliverBody(TruncatingReadBodyProtocol(
+            response.code, response.phrase, finished, max_bytes=8))
+        response._bodyDataReceived('#' * 8)
+        response._bodyDataFinished()
+        self.assertEqual(self.successResultOf(finished), '#' * 8)
+        self.assertFalse(transport.disconnecting)
+
+
+class FakeConnection(object):
+    state = 'QUIESCENT'
+
+    def __init__(self):
+        self.transport = StringTransport()
+
+    def abort(self):
+        self.transport.loseConnection()
+        return succeed(None)
+
+
+class LineParser(object):
+    """Collects data until it sees a newline."""
+
+    def __init__(self):
+        self.data = ''
+        self.done = False
+
+    def feed(self, data):
+        self.data += data
+        self.done = '\n' in self.data
+
+
+class ParsingReadBodyProtocolTestCase(TestCase):
+    def setUp(self):
+        self.parser = LineParser()
+        self.finished = Deferred()
+        self.transport = AbortableStringTransport()
+        self.protocol = ParsingReadBodyProtocol(
+            200, 'OK', self.finished, 8, self.parser)
+        self.protocol.makeConnection(self.transport)
+
+    def test_parser_done(self):
+        self.protocol.dataReceived('ab')
+        self.assertNoResult(self.finished)
+        self.protocol.dataReceived('c\nd')
+        self.assertEqual(self.successResultOf(self.finished), 'abc\nd')
+        self.assertTrue(self.transport.disconnecting)
+        self.protocol.dataReceived('ef')
+        self.assertEqual(self.parser.data, 'abc\nd')
+
+    def test_truncated(self):
+        self.protocol.dataReceived('#' * 16)
+        self.assertEqual(self.parser.data, '#' * 8)
+        self.protocol.connectionLost()
+        self.assertEqual(self.successResultOf(self.finished), '#' * 8)
+
+
+class BodyFileTestCase(TestCase):
+    def setUp(self):
+        self.body_file = BodyFile()
+        self.protocol = BodyFileProtocol(self.body_file, max_bytes=8)
+        self.transport = AbortableStringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_read(self):
+        self.protocol.dataReceived('abcd')
+        self.assertEqual(self.body_file.read(2), 'ab')
+        self.assertEqual(self.body_file.tell(), 2)
+        self.assertEqual(self.body_file.read(2), 'cd')
+
+    def test_read_past_end(self):
+        self.protocol.dataReceived('abcd')
+        self.protocol.connectionLost()
+        self.assertEqual(self.body_file.read(8), 'abcd')
+        self.assertEqual(self.body_file.read(8), '')
+
+    def test_truncation(self):
+        self.protocol.dataReceived('#' * 16)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertTrue(self.body_file.finished)
+        self.assertEqual(self.body_file.read(), '#' * 8)
+
+    def test_seek(self):
+        self.protocol.dataReceived('abcdefgh')
+        self.protocol.connectionLost()
+        self.assertEqual(self.body_file.seek(-2, os.SEEK_END), 6)
+        self.assertEqual(self.body_file.read(), 'gh')
+        self.body_file.seek(1)
+        self.body_file.seek(2, os.SEEK_CUR)
+        self.assertEqual(self.body_file.read(1), 'd')
+
+    def test_stop(self):
+        self.protocol.dataReceived('abcd')
+        self.protocol.stop()
+        self.assertTrue(self.transport.disconnecting)
+        self.assertTrue(self.body_file.finished)
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = ConnectionPool(self.clock, max_per_host=2,
+                                   idle_timeout=10, max_total=3)
+
+    def put(self, key):
+        connection = FakeConnection()
+        self.pool._putConnection(key, connection)
+        self.clock.advance(1)
+        return connection
+
+    def test_idle_timeout(self):
+        connection = self.put('a')
+        self.clock.advance(9)
+        self.assertTrue(connection.transport.disconnecting)
+        self.assertEqual(self.pool._connections['a'], [])
+
+    def test_max_per_host(self):
+        first, second, third = self.put('a'), self.put('a'), self.put('a')
+        self.assertTrue(first.transport.disconnecting)
+        self.assertEqual(self.pool._connections['a'], [second, third])
+
+    def test_max_total(self):
+        first, second, third = self.put('a'), self.put('b'), self.put('c')
+        fourth = self.put('d')
+        self.assertTrue(first.transport.disconnecting)
+        self.assertFalse(second.transport.disconnecting)
+        self.assertFalse(third.transport.disconnecting)
+        self.assertEqual(len(self.pool._timeouts), 3)
+        self.assertEqual(self.pool._connections['d'], [fourth])
+
+    def test_unlimited_total(self):
+        self.pool.max_total = None
+        connections = [self.put(key) for key in 'abcde']
+        self.assertFalse(any(c.transport.disconnecting for c in connections))
+
+    def test_fetcher_close(self):
+        fetcher = TitleFetcher(pool=self.pool)
+        connection = self.put('a')
+        fetcher.close()
+        self.assertTrue(connection.transport.disconnecting)
+        self.assertEqual(self.pool._connections, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
 
 class BlacklistingAgentTestCase(AgentTestsMixin,
                                 FakeReactorAndConnectMixin, TestCase):
@@ -75,6 +306,238 @@ class BlacklistingAgentTestCase(AgentTestsMixin,
                     self.assert_blacklist(method, uri)
 
 
+class CachingResolverTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.lookups = []
+        self.resolve = CachingResolver(self.fake_resolve, ttl=60,
+                                       negative_ttl=10, clock=self.clock)
+
+    def fake_resolve(self, hostname):
+        self.lookups.append(hostname)
+        if hostname == 'nx.test':
+            return fail(DNSLookupError(hostname))
+        return succeed('8.8.8.8')
+
+    def test_hit(self):
+        self.assertEqual(self.successResultOf(self.resolve('foo.test')),
+                         '8.8.8.8')
+        self.assertEqual(self.successResultOf(self.resolve('FOO.test')),
+                         '8.8.8.8')
+        self.assertEqual(self.lookups, ['foo.test'])
+
+    def test_expiry(self):
+        self.resolve('foo.test')
+        self.clock.advance(60)
+        self.resolve('foo.test')
+        self.assertEqual(self.lookups, ['foo.test', 'foo.test'])
+
+    def test_negative(self):
+        self.failureResultOf(self.resolve('nx.test'), DNSLookupError)
+        self.failureResultOf(self.resolve('nx.test'), DNSLookupError)
+        self.assertEqual(self.lookups, ['nx.test'])
+        self.clock.advance(10)
+        self.failureResultOf(self.resolve('nx.test'), DNSLookupError)
+        self.assertEqual(self.lookups, ['nx.test', 'nx.test'])
+
+    def test_no_hostname(self):
+        for hostname in (None, ''):
+            self.failureResultOf(self.resolve(hostname), DNSLookupError)
+        self.assertEqual(self.lookups, [])
+
+    def test_max_entries(self):
+        self.resolve.max_entries = 1
+        self.resolve('foo.test')
+        self.resolve('bar.test')
+        self.resolve('foo.test')
+        self.assertEqual(self.lookups, ['foo.test', 'bar.test', 'foo.test'])
+
+
+class PinnedEndpointFactoryTestCase(TestCase):
+    def setUp(self):
+        self.reactor = MemoryReactor()
+        self.factory = PinnedEndpointFactory(
+            self.reactor, BlacklistingAgentTestCase.resolve)
+
+    def test_http(self):
+        endpoint = self.factory.endpointForURI(
+            URI.fromBytes('http://foo.test:8080/'))
+        endpoint.connect(Factory())
+        host, port = self.reactor.tcpClients[0][:2]
+        self.assertEqual((host, port), ('8.8.8.8', 8080))
+
+    def test_https(self):
+        endpoint = self.factory.endpointForURI(
+            URI.fromBytes('https://foo.test/'))
+        endpoint.connect(Factory())
+        host, port = self.reactor.sslClients[0][:2]
+        self.assertEqual((host, port), ('8.8.8.8', 443))
+
+    def test_blacklist(self):
+        endpoint = self.factory.endpointForURI(
+            URI.fromBytes('http://localhost/'))
+        self.failureResultOf(endpoint.connect(Factory()), BlacklistedHost)
+        self.assertEqual(self.reactor.tcpClients, [])
+
+
+class RecordingAgent(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        requesting = Deferred()
+        self.requests.append((uri, requesting))
+        return requesting
+
+
+class ThrottlingAgentTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.recording = RecordingAgent()
+        self.agent = ThrottlingAgent(self.recording, rate=1, burst=2,
+                                     max_per_host=10, clock=self.clock)
+
+    def uris(self):
+        return [uri for uri, _ in self.recording.requests]
+
+    def respond(self, code, headers=None):
+        _, requesting = self.recording.requests.pop(0)
+        response = Response(('HTTP', 1, 1), code, 'Whatever',
+                            Headers(headers or {}),
+                            AbortableStringTransport())
+        requesting.callback(response)
+        return response
+
+    def test_burst(self):
+        for _ in xrange(3):
+            self.agent.request('GET', 'http://foo.test/')
+        self.assertEqual(len(self.recording.requests), 2)
+        self.clock.advance(1)
+        self.assertEqual(len(self.recording.requests), 3)
+
+    def test_other_hosts_unaffected(self):
+        for _ in xrange(3):
+            self.agent.request('GET', 'http://foo.test/')
+        self.agent.request('GET', 'http://bar.test/')
+        self.assertEqual(self.uris()[-1], 'http://bar.test/')
+
+    def test_max_per_host(self):
+        self.agent.max_per_host = 1
+        first = self.agent.request('GET', 'http://foo.test/1')
+        self.agent.request('GET', 'http://foo.test/2')
+        self.clock.advance(10)
+        self.assertEqual(self.uris(), ['http://foo.test/1'])
+        response = self.respond(200)
+        self.assertIdentical(self.successResultOf(first), response)
+        self.assertEqual(self.uris(), ['http://foo.test/2'])
+
+    def test_retry_after(self):
+        finished = self.agent.request('GET', 'http://foo.test/1')
+        self.respond(429, {'Retry-After': ['5']})
+        self.assertNoResult(finished)
+        other = self.agent.request('GET', 'http://foo.test/2')
+        self.clock.advance(4)
+        self.assertEqual(self.recording.requests, [])
+        self.clock.advance(1)
+        # The retry goes first.
+        self.assertEqual(self.uris(),
+                         ['http://foo.test/1', 'http://foo.test/2'])
+        response = self.respond(200)
+        self.assertIdentical(self.successResultOf(finished), response)
+        self.assertNoResult(other)
+
+    def test_retry_slow_body(self):
+        self.agent.request('GET', 'http://foo.test/1')
+        _, requesting = self.recording.requests.pop(0)
+        transport = AbortableStringTransport()
+        response = Response(('HTTP', 1, 1), 429, 'Too Many Requests',
+                            Headers({'Retry-After': ['5']}), transport)
+        response.length = 100
+        requesting.callback(response)
+        self.assertFalse(transport.disconnecting)
+        self.clock.advance(self.agent.discard_timeout)
+        self.assertTrue(transport.disconnecting)
+
+    def test_long_retry_after(self):
+        finished = self.agent.request('GET', 'http://foo.test/1')
+        response = self.respond(503, {'Retry-After': ['60']})
+        self.assertIdentical(self.successResultOf(finished), response)
+        self.agent.request('GET', 'http://foo.test/2')
+        self.clock.advance(59)
+        self.assertEqual(self.recording.requests, [])
+        self.clock.advance(1)
+        self.assertEqual(self.uris(), ['http://foo.test/2'])
+
+    def test_backoff(self):
+        self.agent.max_retries = 0
+        self.agent.request('GET', 'http://foo.test/1')
+        self.respond(429)
+        self.agent.request('GET', 'http://foo.test/2')
+        self.clock.advance(1)
+        self.respond(429)
+        self.agent.request('GET', 'http://foo.test/3')
+        self.clock.advance(1)
+        self.assertEqual(self.recording.requests, [])
+        self.clock.advance(1)
+        self.assertEqual(self.uris(), ['http://foo.test/3'])
+
+    def test_cancel_queued(self):
+        self.agent.request('GET', 'http://foo.test/')
+        self.agent.request('GET', 'http://foo.test/')
+        queued = self.agent.request('GET', 'http://foo.test/')
+        queued.cancel()
+        self.failureResultOf(queued, CancelledError)
+        self.clock.advance(1)
+        self.assertEqual(len(self.recording.requests), 2)
+
+    def test_headers_timeout(self):
+        self.agent.max_per_host = 1
+        self.agent.headers_timeout = 5
+        first = self.agent.request('GET', 'http://foo.test/1')
+        self.clock.advance(4)
+        second = self.agent.request('GET', 'http://foo.test/2')
+        self.clock.advance(1)
+        self.failureResultOf(first, FetchTimeout)
+        self.recording.requests.pop(0)
+        # The time spent queued doesn't count.
+        self.clock.advance(4)
+        self.assertNoResult(second)
+        self.respond(200)
+        self.successResultOf(second)
+
+    def test_agent_raises(self):
+        self.agent.max_per_host = 1
+        self.recording.request = lambda *args: 1 / 0
+        for _ in xrange(2):
+            self.failureResultOf(self.agent.request('GET', 'http://foo.test/'),
+                                 ZeroDivisionError)
+        self.assertEqual(self.agent.hosts['foo.test'].active, 0)
+
+    def test_forget_idle_hosts(self):
+        self.agent.max_hosts = 1
+        self.agent.request('GET', 'http://foo.test/')
+        self.respond(200)
+        self.agent.request('GET', 'http://bar.test/')
+        self.assertEqual(list(self.agent.hosts), ['bar.test'])
+
+
+class RetryAfterTestCase(TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after(' 120 ', 0), 120)
+
+    def test_date(self):
+        self.assertEqual(
+            parse_retry_after('Thu, 01 Jan 1970 00:02:00 GMT', 60), 60)
+
+    def test_past_date(self):
+        self.assertEqual(
+            parse_retry_after('Thu, 01 Jan 1970 00:02:00 GMT', 600), 0)
+
+    def test_malformed(self):
+        self.assertIdentical(parse_retry_after('soon', 0), None)
+        self.assertIdentical(parse_retry_after('', 0), None)
+
+
 class SoftRedirectExtractor(object):
     def __init__(self, target):
         self.target = target
@@ -93,6 +556,7 @@ class HostnameTagTestCase(AgentTestsMixin,
         self.agent = RedirectAgent(self.makeAgent())
         self.fetcher = TitleFetcher()
         self.fetcher.agent = self.agent
+        self.fetcher.clock = Clock()
         self.connect(None)
 
     def test_no_redirect(self):
@@ -173,6 +637,85 @@ class HostnameTagTestCase(AgentTestsMixin,
         return finished
 
 
+class RedirectCacheTestCase(AgentTestsMixin,
+                             FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.agent = RedirectAgent(self.makeAgent())
+        self.fetcher = TitleFetcher()
+        self.fetcher.agent = self.agent
+        self.fetcher.clock = Clock()
+        self.connect(None)
+
+    def respond(self, code=200, headers=None):
+        request, result = self.protocol.requests.pop()
+        result.callback(Response._construct(
+            ('HTTP', 1, 1), code, 'OK', headers or Headers(),
+            AbortableStringTransport(), request))
+        return request.absoluteURI
+
+    def redirect(self, code, location, **headers):
+        redirect_headers = Headers({'Location': [location]})
+        for name, value in headers.iteritems():
+            redirect_headers.addRawHeader(name.replace('_', '-'), value)
+        return self.respond(code, redirect_headers)
+
+    def test_permanent_redirect(self):
+        self.fetcher.fetch_title('http://foo.test/')
+        self.redirect(301, 'http://bar.test/')
+        self.respond()
+        finished = self.fetcher.fetch_title(
+            'http://foo.test/', hostname_tag=True)
+        self.assertEqual(self.respond(), 'http://bar.test/')
+        self.assertEqual(self.successResultOf(finished),
+                         u'[foo.test \u2192 bar.test] Unknown document')
+
+    def test_temporary_redirect(self):
+        self.fetcher.fetch_title('http://foo.test/')
+        self.redirect(302, 'http://bar.test/')
+        self.respond()
+        self.fetcher.fetch_title('http://foo.test/')
+        self.assertEqual(self.redirect(302, 'http://bar.test/'),
+                         'http://foo.test/')
+
+    def test_uncacheable_redirect(self):
+        self.fetcher.fetch_title('http://foo.test/')
+        self.redirect(301, 'http://bar.test/', Cache_Control='no-store')
+        self.respond()
+        self.fetcher.fetch_title('http://foo.test/')
+        self.assertEqual(self.redirect(301, 'http://bar.test/'),
+                         'http://foo.test/')
+
+    def test_redirect_chain(self):
+        self.fetcher.fetch_title('http://foo.test/')
+        self.redirect(301, 'http://bar.test/')
+        self.redirect(301, 'http://baz.test/')
+        self.respond()
+        self.fetcher.fetch_title('http://foo.test/')
+        self.assertEqual(self.respond(), 'http://baz.test/')
+
+    def test_soft_redirect(self):
+        self.fetcher.extractors = {
+            'text/html': SoftRedirectExtractor(u'http://bar.test/')}
+        self.fetcher.fetch_title('http://foo.test/')
+        self.respond(headers=Headers({'Content-Type': ['text/html']}))
+        self.respond()
+        self.fetcher.fetch_title('http://foo.test/')
+        self.assertEqual(self.respond(), 'http://bar.test/')
+
+    def test_no_redirect_cache(self):
+        self.fetcher.redirects = None
+        self.fetcher.fetch_title('http://foo.test/')
+        self.redirect(301, 'http://bar.test/')
+        self.respond()
+        self.fetcher.fetch_title('http://foo.test/')
+        self.assertEqual(self.redirect(301, 'http://bar.test/'),
+                         'http://foo.test/')
+
+
 class FriendlyErrorTestCase(AgentTestsMixin,
                             FakeReactorAndConnectMixin, TestCase):
     def makeAgent(self):
@@ -257,3 +800,805 @@ class FriendlyErrorTestCase(AgentTestsMixin,
         _, result = self.protocol.requests.pop()
         result.errback(Failure(ValueError()))
         return self.assertFailure(finished, ValueError)
+
+
+class CacheTestCase(AgentTestsMixin, FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.clock = Clock()
+        self.cache = TitleCache(clock=self.clock)
+        self.agent = RedirectAgent(self.makeAgent())
+        self.fetcher = TitleFetcher(cache=self.cache)
+        self.fetcher.agent = self.agent
+        self.fetcher.clock = self.clock
+        self.connect(None)
+
+    def respond(self):
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', Headers(),
+                                       AbortableStringTransport(), request)
+        result.callback(response)
+
+    def test_repeat_request(self):
+        first = self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond()
+        self.assertEqual(self.successResultOf(first), u'Unknown document')
+        second = self.fetcher.fetch_title(u'http://foo.test/',
+                                          hostname_tag=True)
+        self.assertEqual(self.protocol.requests, [])
+        self.assertEqual(self.successResultOf(second),
+                         u'[foo.test] Unknown document')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_cached_error(self):
+        first = self.fetcher.fetch_title(
+            u'http://foo.test/', friendly_errors=True)
+        _, result = self.protocol.requests.pop()
+        result.errback(Failure(ConnectError()))
+        self.assertEqual(self.successResultOf(first),
+                         u'Could not connect to server.')
+        second = self.fetcher.fetch_title(
+            u'http://foo.test/', friendly_errors=True)
+        self.assertEqual(self.successResultOf(second),
+                         u'Could not connect to server.')
+        self.assertEqual(self.protocol.requests, [])
+
+    def test_cached_error_when_disabled(self):
+        first = self.fetcher.fetch_title(
+            u'http://foo.test/', friendly_errors=True)
+        _, result = self.protocol.requests.pop()
+        result.errback(Failure(ConnectError()))
+        self.successResultOf(first)
+        second = self.fetcher.fetch_title(u'http://foo.test/')
+        _, result = self.protocol.requests.pop()
+        result.errback(Failure(ConnectError()))
+        self.failureResultOf(second, ConnectError)
+
+    def test_cancel_during_lookup(self):
+        looking_up = Deferred()
+        self.cache.get = lambda key: looking_up
+        fetching = self.fetcher.fetch_title(u'http://foo.test/')
+        fetching.cancel()
+        self.failureResultOf(fetching, CancelledError)
+        looking_up.callback(None)
+        self.assertEqual(self.protocol.requests, [])
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_expiry(self):
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond()
+        self.clock.advance(self.cache.ttl)
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.assertEqual(len(self.protocol.requests), 1)
+
+
+class LengthExtractor(object):
+    range_requests = True
+    max_download_bytes = 8
+
+    def extract(self, response):
+        return succeed(u'{} bytes'.format(response.length))
+
+
+class RangeRequestTestCase(AgentTestsMixin,
+                           FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.agent = RedirectAgent(self.makeAgent())
+        self.fetcher = TitleFetcher()
+        self.fetcher.agent = self.agent
+        self.fetcher.extractors = {'image/png': LengthExtractor(),
+                                   'text/html': SoftRedirectExtractor(None)}
+        self.connect(None)
+
+    def respond(self, code, content_type='image/png', content_range=None,
+                body=''):
+        request, result = self.protocol.requests.pop(0)
+        headers = Headers({'Content-Type': [content_type]})
+        if content_range is not None:
+            headers.addRawHeader('Content-Range', content_range)
+        response = Response._construct(('HTTP', 1, 1), code, 'Whatever',
+                                       headers, AbortableStringTransport(),
+                                       request)
+        response.length = len(body)
+        result.callback(response)
+        response._bodyDataReceived(body)
+        response._bodyDataFinished()
+        return request
+
+    def test_partial(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/a.png')
+        request = self.respond(206, content_range='bytes 0-7/100',
+                               body='#' * 8)
+        self.assertEqual(request.headers.getRawHeaders('Range'),
+                         ['bytes=0-7'])
+        self.assertEqual(self.successResultOf(finished), u'100 bytes')
+
+    def test_whole(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/a.png')
+        self.respond(200, body='#' * 4)
+        self.assertEqual(self.successResultOf(finished), u'4 bytes')
+
+    def test_unsatisfiable(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/a.png')
+        self.respond(416, content_range='bytes */0')
+        request = self.respond(200)
+        self.assertIdentical(request.headers.getRawHeaders('Range'), None)
+        self.assertEqual(self.successResultOf(finished), u'0 bytes')
+
+    def test_insufficient(self):
+        # The path says PNG, but the server sends a truncated document
+        # whose extractor wants more than was asked for.
+        self.fetcher.extractors['text/html'] = LengthExtractor()
+        self.fetcher.extractors['text/html'].max_download_bytes = 64
+        finished = self.fetcher.fetch_title(u'http://foo.test/a.png')
+        self.respond(206, content_type='text/html',
+                     content_range='bytes 0-7/100', body='#' * 8)
+        request = self.respond(200, content_type='text/html')
+        self.assertIdentical(request.headers.getRawHeaders('Range'), None)
+        self.assertEqual(self.successResultOf(finished), u'0 bytes')
+
+    def test_no_extension(self):
+        self.fetcher.fetch_title(u'http://foo.test/a')
+        request = self.respond(200)
+        self.assertIdentical(request.headers.getRawHeaders('Range'), None)
+
+    def test_disabled(self):
+        self.fetcher.range_requests = False
+        self.fetcher.fetch_title(u'http://foo.test/a.png')
+        request = self.respond(200)
+        self.assertIdentical(request.headers.getRawHeaders('Range'), None)
+
+
+class DispatchTestCase(AgentTestsMixin,
+                       FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.agent = RedirectAgent(self.makeAgent())
+        self.fetcher = TitleFetcher()
+        self.fetcher.agent = self.agent
+        self.fetcher.clock = self.clock = Clock()
+        self.fetcher.extractors = {'image/png': LengthExtractor()}
+        self.connect(None)
+
+    def respond(self, content_type, length=None):
+        """Send response headers for the oldest request, and return the
+        request and the transport its body would arrive on."""
+        request, result = self.protocol.requests.pop(0)
+        headers = Headers({'Content-Type': [content_type]})
+        if length is not None:
+            headers.addRawHeader('Content-Length', str(length))
+        transport = AbortableStringTransport()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', headers,
+                                       transport, request)
+        if length is not None and request.method != 'HEAD':
+            response.length = length
+        result.callback(response)
+        return request, transport
+
+    def test_drop_unsupported(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/a.zip')
+        _, transport = self.respond('application/zip', length=10 ** 9)
+        self.assertEqual(self.successResultOf(finished),
+                         u'application/zip document (1 GB)')
+        self.assertTrue(transport.disconnecting)
+
+    def test_drop_unknown_length(self):
+        self.fetcher.fetch_title(u'http://foo.test/a.zip')
+        _, transport = self.respond('application/zip')
+        self.assertTrue(transport.disconnecting)
+
+    def test_read_small_unsupported(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/a.zip')
+        _, transport = self.respond('application/zip', length=100)
+        self.assertEqual(self.successResultOf(finished),
+                         u'application/zip document (100 B)')
+        self.assertFalse(transport.disconnecting)
+
+    def test_slow_small_unsupported(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/a.zip')
+        _, transport = self.respond('application/zip', length=100)
+        self.successResultOf(finished)
+        self.clock.advance(self.fetcher.body_timeout)
+        self.assertTrue(transport.disconnecting)
+
+    def test_head_first_unsupported(self):
+        self.fetcher.head_first_hosts.add(u'foo.test')
+        finished = self.fetcher.fetch_title(u'http://foo.test/a')
+        request, _ = self.respond('application/zip', length=10 ** 9)
+        self.assertEqual(request.method, 'HEAD')
+        self.assertEqual(self.successResultOf(finished),
+                         u'application/zip document (1 GB)')
+        self.assertEqual(self.protocol.requests, [])
+
+    def test_head_first_supported(self):
+        self.fetcher.head_first_hosts.add(u'foo.test')
+        finished = self.fetcher.fetch_title(u'http://foo.test/a')
+        self.respond('image/png', length=100)
+        request, _ = self.respond('image/png', length=100)
+        self.assertEqual(request.method, 'GET')
+        # The content type from the HEAD response picks the range.
+        self.assertEqual(request.headers.getRawHeaders('Range'),
+                         ['bytes=0-7'])
+        self.assertEqual(self.successResultOf(finished), u'100 bytes')
+
+    def test_head_not_first(self):
+        self.fetcher.fetch_title(u'http://foo.test/a')
+        request, _ = self.respond('application/zip')
+        self.assertEqual(request.method, 'GET')
+
+
+class BodyReadingExtractor(object):
+    def extract(self, response):
+        return read_body(response)
+
+
+class TimeoutTestCase(AgentTestsMixin, FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.clock = Clock()
+        self.fetcher = TitleFetcher()
+        # Headers are timed by the throttle, once it starts a request.
+        self.fetcher.throttle.agent = self.makeAgent()
+        self.fetcher.throttle.clock = self.clock
+        self.agent = RedirectAgent(self.fetcher.throttle)
+        self.fetcher.agent = self.agent
+        self.fetcher.clock = self.clock
+        self.fetcher.extractors = {'text/plain': BodyReadingExtractor()}
+        self.connect(None)
+
+    def respond(self):
+        request, result = self.protocol.requests.pop()
+        transport = AbortableStringTransport()
+        response = Response._construct(
+            ('HTTP', 1, 1), 200, 'OK',
+            Headers({'Content-Type': ['text/plain']}), transport, request)
+        result.callback(response)
+        return response, transport
+
+    def test_headers_timeout(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/')
+        _, result = self.protocol.requests[0]
+        self.clock.advance(self.fetcher.headers_timeout)
+        self.failureResultOf(finished, FetchTimeout)
+        self.assertTrue(result.called)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_body_timeout(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/',
+                                            friendly_errors=True)
+        response, transport = self.respond()
+        response._bodyDataReceived('trickle')
+        self.clock.advance(self.fetcher.body_timeout)
+        self.assertEqual(self.successResultOf(finished),
+                         u'Timed out waiting for server.')
+        self.assertTrue(transport.disconnecting)
+
+    def test_body_in_time(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/')
+        response, _ = self.respond()
+        response._bodyDataReceived('hello')
+        response._bodyDataFinished()
+        self.assertEqual(self.successResultOf(finished), 'hello')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_total_timeout(self):
+        self.fetcher.timeout = 5
+        finished = self.fetcher.fetch_title(u'http://foo.test/')
+        self.clock.advance(3)
+        _, transport = self.respond()
+        # Only two seconds are left for the body, not body_timeout.
+        self.clock.advance(2)
+        self.failureResultOf(finished, FetchTimeout)
+        self.assertTrue(transport.disconnecting)
+
+    def test_per_call_timeout(self):
+        impatient = self.fetcher.fetch_title(u'http://foo.test/', timeout=1)
+        patient = self.fetcher.fetch_title(u'http://foo.test/')
+        self.clock.advance(1)
+        self.assertEqual(
+            self.failureResultOf(impatient, FetchTimeout).value.phase, 'call')
+        # The shared fetch carries on for everyone else.
+        response, _ = self.respond()
+        response._bodyDataReceived('hello')
+        response._bodyDataFinished()
+        self.assertEqual(self.successResultOf(patient), 'hello')
+
+    def test_cancel_frees_request(self):
+        url = URL.fromText(u'http://foo.test/')
+        finished = self.fetcher.fetch_shared(url.asText(), url)
+        _, result = self.protocol.requests[0]
+        finished.cancel()
+        self.failureResultOf(finished, CancelledError)
+        self.assertTrue(result.called)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class ObserverTestCase(AgentTestsMixin, FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.agent = RedirectAgent(self.makeAgent())
+        self.clock = Clock()
+        self.metrics = FetchMetrics()
+        self.fetcher = TitleFetcher()
+        self.fetcher.agent = self.agent
+        self.fetcher.clock = self.clock
+        self.fetcher.extractors = {'text/plain': BodyReadingExtractor()}
+        self.fetcher.observers.append(self.metrics)
+        self.connect(None)
+
+    def respond(self, content_type, length=None):
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(
+            ('HTTP', 1, 1), 200, 'OK',
+            Headers({'Content-Type': [content_type]}),
+            AbortableStringTransport(), request)
+        if length is not None:
+            response.length = length
+        result.callback(response)
+        return response
+
+    def test_extracted(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/')
+        self.clock.advance(1)
+        response = self.respond('text/plain')
+        self.clock.advance(2)
+        response._bodyDataReceived('hello')
+        self.clock.advance(3)
+        response._bodyDataFinished()
+        self.successResultOf(finished)
+        self.assertEqual(dict(self.metrics.fetches), {'text/plain': 1})
+        self.assertEqual(self.metrics.bytes_downloaded, 5)
+        self.assertEqual(
+            dict((phase, timings.sum)
+                 for phase, timings in self.metrics.phases.iteritems()),
+            {'headers': 1, 'body': 2, 'extract': 5, 'fetch': 6})
+
+    def test_discarded(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/')
+        response = self.respond('application/octet-stream', length=4)
+        response._bodyDataReceived('1234')
+        response._bodyDataFinished()
+        self.successResultOf(finished)
+        self.assertEqual(dict(self.metrics.fetches),
+                         {'application/octet-stream': 1})
+        self.assertEqual((self.metrics.bytes_downloaded,
+                          self.metrics.bytes_discarded), (0, 4))
+
+    def test_failed(self):
+        finished = self.fetcher.fetch_title(u'http://foo.test/')
+        _, result = self.protocol.requests.pop()
+        result.errback(ConnectError())
+        self.failureResultOf(finished, ConnectError)
+        self.assertEqual(dict(self.metrics.errors), {'connect': 1})
+        self.assertEqual(self.metrics.phases['fetch'].count, 1)
+
+    def test_broken_observer(self):
+        self.fetcher.observers.insert(0, object())
+        finished = self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond('application/octet-stream')
+        self.successResultOf(finished)
+        self.assertEqual(dict(self.metrics.fetches),
+                         {'application/octet-stream': 1})
+        self.assertTrue(self.flushLoggedErrors(AttributeError))
+
+
+class ClassifyErrorTestCase(TestCase):
+    def test_classes(self):
+        for error, error_class in (
+                (ResponseFailed([Failure(ValueError())]), 'incomplete'),
+                (DNSLookupError(), 'connect'),
+                (FetchTimeout('body'), 'timeout'),
+                (Overloaded('full'), 'overloaded'),
+                (ValueError(), None)):
+            self.assertEqual(classify_error(Failure(error)), error_class)
+
+
+class RevalidationTestCase(AgentTestsMixin,
+                           FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.clock = Clock()
+        self.cache = TitleCache(clock=self.clock)
+        self.agent = RedirectAgent(self.makeAgent())
+        self.fetcher = TitleFetcher(cache=self.cache)
+        self.fetcher.agent = self.agent
+        self.fetcher.clock = self.clock
+        self.fetcher.extractors = {'text/plain': BodyReadingExtractor()}
+        self.connect(None)
+
+    def respond(self, code, headers, body=''):
+        request, result = self.protocol.requests.pop()
+        headers = Headers(headers)
+        headers.setRawHeaders('Content-Type', ['text/plain'])
+        response = Response._construct(('HTTP', 1, 1), code, 'Whatever',
+                                       headers, AbortableStringTransport(),
+                                       request)
+        result.callback(response)
+        response._bodyDataReceived(body)
+        response._bodyDataFinished()
+        return request
+
+    def test_revalidate(self):
+        first = self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond(200, {'ETag': ['"v1"'],
+                           'Last-Modified': ['Thu, 01 Jan 1970 00:00:00 GMT'],
+                           'Cache-Control': ['public, max-age=60']},
+                     'hello')
+        self.assertEqual(self.successResultOf(first), u'hello')
+        self.clock.advance(30)
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.assertEqual(self.protocol.requests, [])
+        self.clock.advance(30)
+        second = self.fetcher.fetch_title(u'http://foo.test/')
+        request = self.respond(304, {'Cache-Control': ['max-age=120']})
+        self.assertEqual(request.headers.getRawHeaders('If-None-Match'),
+                         ['"v1"'])
+        self.assertEqual(request.headers.getRawHeaders('If-Modified-Since'),
+                         ['Thu, 01 Jan 1970 00:00:00 GMT'])
+        self.assertEqual(self.successResultOf(second), u'hello')
+        self.clock.advance(119)
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.assertEqual(self.protocol.requests, [])
+
+    def test_changed(self):
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond(200, {'ETag': ['"v1"'], 'Cache-Control': ['no-cache']},
+                     'hello')
+        second = self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond(200, {'ETag': ['"v2"']}, 'goodbye')
+        self.assertEqual(self.successResultOf(second), u'goodbye')
+        self.assertEqual(self.cache.get_stale('http://foo.test/').etag,
+                         '"v2"')
+
+    def test_no_store(self):
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond(200, {'ETag': ['"v1"'], 'Cache-Control': ['no-store']},
+                     'hello')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expires(self):
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.respond(200, {'Date': ['Thu, 01 Jan 1970 00:00:00 GMT'],
+                           'Expires': ['Thu, 01 Jan 1970 00:00:10 GMT']},
+                     'hello')
+        self.clock.advance(9)
+        self.fetcher.fetch_title(u'http://foo.test/')
+        self.assertEqual(self.protocol.requests, [])
+        self.clock.advance(1)
+        self.fetcher.fetch_title(u'http://foo.test/')
+        request, _ = self.protocol.requests[0]
+        self.assertFalse(request.headers.hasHeader('If-None-Match'))
+
+
+class SingleFlightTestCase(AgentTestsMixin,
+                           FakeReactorAndConnectMixin, TestCase):
+    def makeAgent(self):
+        return self.buildAgentForWrapperTest(self.reactor)
+
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.agent = RedirectAgent(self.makeAgent())
+        self.fetcher = TitleFetcher()
+        self.fetcher.agent = self.agent
+        self.fetcher.clock = Clock()
+        self.connect(None)
+
+    def respond(self):
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', Headers(),
+                                       AbortableStringTransport(), request)
+        result.callback(response)
+
+    def test_coalesce(self):
+        first = self.fetcher.fetch_title(u'http://foo.test/')
+        protocol = self.protocol
+        second = self.fetcher.fetch_title('http://foo.test/',
+                                          hostname_tag=True)
+        self.assertIdentical(self.protocol, protocol)
+        self.respond()
+        self.assertEqual(self.successResultOf(first), u'Unknown document')
+        self.assertEqual(self.successResultOf(second),
+                         u'[foo.test] Unknown document')
+        self.assertEqual(self.fetcher._in_flight, {})
+
+    def test_different_urls(self):
+        self.fetcher.fetch_title(u'http://foo.test/')
+        protocol = self.protocol
+        self.fetcher.fetch_title(u'http://foo.test/bar')
+        self.assertNotIdentical(self.protocol, protocol)
+        self.assertEqual(len(self.protocol.requests), 1)
+
+    def test_shared_failure(self):
+        first = self.fetcher.fetch_title(u'http://foo.test/')
+        second = self.fetcher.fetch_title(u'http://foo.test/',
+                                          friendly_errors=True)
+        _, result = self.protocol.requests.pop()
+        result.errback(Failure(ConnectError()))
+        self.failureResultOf(first, ConnectError)
+        self.assertEqual(self.successResultOf(second),
+                         u'Could not connect to server.')
+
+    def test_cancel_one_waiter(self):
+        key = u'http://foo.test/'
+        first = self.fetcher.fetch_shared(key, URL.fromText(key))
+        second = self.fetcher.fetch_shared(key, URL.fromText(key))
+        first.cancel()
+        self.failureResultOf(first, CancelledError)
+        self.respond()
+        self.assertEqual(self.successResultOf(second).title,
+                         u'Unknown document')
+
+    def test_cancel_all_waiters(self):
+        key = u'http://foo.test/'
+        first = self.fetcher.fetch_shared(key, URL.fromText(key))
+        second = self.fetcher.fetch_shared(key, URL.fromText(key))
+        first.cancel()
+        second.cancel()
+        self.failureResultOf(first, CancelledError)
+        self.failureResultOf(second, CancelledError)
+        self.assertEqual(self.fetcher._in_flight, {})
+
+
+class FetchTitlesTestCase(TestCase):
+    def setUp(self):
+        self.fetcher = TitleFetcher()
+        self.fetcher.fetch_title = self.fake_fetch_title
+        self.pending = {}
+        self.results = []
+        self.pulled = 0
+
+    def fake_fetch_title(self, url, **kwargs):
+        self.pending[url.asText()] = finished = Deferred()
+        return finished
+
+    def count(self, urls):
+        for url in urls:
+            self.pulled += 1
+            yield url
+
+    def fetch_titles(self, urls, **kwargs):
+        return self.fetcher.fetch_titles(
+            self.count(urls), lambda *args: self.results.append(args),
+            **kwargs)
+
+    def test_max_concurrent(self):
+        urls = [u'http://{}.test/'.format(i) for i in xrange(5)]
+        finished = self.fetch_titles(urls, max_concurrent=2)
+        self.assertEqual(sorted(self.pending), urls[:2])
+        self.assertEqual(self.pulled, 2)
+        self.pending.pop(urls[1]).callback(u'one')
+        self.assertEqual(self.results, [(1, u'one')])
+        self.assertEqual(sorted(self.pending), [urls[0], urls[2]])
+        while self.pending:
+            url = min(self.pending)
+            self.pending.pop(url).callback(url)
+        self.successResultOf(finished)
+        self.assertEqual(sorted(index for index, _ in self.results),
+                         range(5))
+
+    def test_max_per_host(self):
+        urls = [u'http://foo.test/1', u'http://foo.test/2',
+                u'http://bar.test/']
+        finished = self.fetch_titles(urls, max_concurrent=3, max_per_host=1)
+        self.assertEqual(sorted(self.pending),
+                         [u'http://bar.test/', u'http://foo.test/1'])
+        self.pending.pop(u'http://foo.test/1').callback(u'one')
+        self.assertEqual(sorted(self.pending),
+                         [u'http://bar.test/', u'http://foo.test/2'])
+        self.pending.pop(u'http://foo.test/2').callback(u'two')
+        self.pending.pop(u'http://bar.test/').callback(u'three')
+        self.successResultOf(finished)
+        self.assertEqual(self.results, [(0, u'one'), (1, u'two'),
+                                        (2, u'three')])
+
+    def test_host_full(self):
+        urls = [u'http://foo.test/1', u'http://foo.test/2',
+                u'http://foo.test/3', u'http://bar.test/']
+        finished = self.fetch_titles(urls, max_concurrent=3, max_per_host=1)
+        self.assertEqual(sorted(self.pending),
+                         [u'http://bar.test/', u'http://foo.test/1'])
+        self.pending.pop(u'http://bar.test/').callback(u'bar')
+        self.assertEqual(sorted(self.pending), [u'http://foo.test/1'])
+        for i in xrange(1, 4):
+            self.pending.pop(u'http://foo.test/{}'.format(i)).callback(i)
+        self.successResultOf(finished)
+        self.assertEqual([index for index, _ in self.results], [3, 0, 1, 2])
+
+    def test_failure(self):
+        finished = self.fetch_titles([u'http://foo.test/'])
+        self.pending.pop(u'http://foo.test/').errback(ConnectError())
+        self.successResultOf(finished)
+        index, failure = self.results[0]
+        self.assertEqual(index, 0)
+        self.assertTrue(failure.check(ConnectError))
+
+    def test_deferred_urls(self):
+        source = [Deferred(), Deferred()]
+        finished = self.fetch_titles(source, max_concurrent=1)
+        self.assertEqual(self.pending, {})
+        source[0].callback(None)
+        source[1].callback(u'http://foo.test/')
+        self.pending.pop(u'http://foo.test/').callback(u'foo')
+        self.successResultOf(finished)
+        self.assertEqual(self.results, [(1, u'foo')])
+
+    def test_deferred_url_failure(self):
+        source = [fail(ValueError()), u'http://foo.test/']
+        finished = self.fetch_titles(source)
+        self.pending.pop(u'http://foo.test/').callback(u'foo')
+        self.successResultOf(finished)
+        self.assertTrue(self.results[0][1].check(ValueError))
+        self.assertEqual(self.results[1], (1, u'foo'))
+
+    def test_callback_error(self):
+        def callback(index, title):
+            self.results.append(index)
+            raise ValueError()
+        finished = self.fetcher.fetch_titles(
+            [u'http://foo.test/', u'http://bar.test/'], callback,
+            max_concurrent=1)
+        self.pending.pop(u'http://foo.test/').callback(u'foo')
+        self.pending.pop(u'http://bar.test/').callback(u'bar')
+        self.successResultOf(finished)
+        self.assertEqual(self.results, [0, 1])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 2)
+
+
+class AdmissionQueueTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.queue = AdmissionQueue(max_active=1, max_queued=2, max_age=5,
+                                    clock=self.clock)
+        self.successResultOf(self.queue.acquire())
+
+    def test_priority_order(self):
+        admitted = []
+        def acquire(priority):
+            self.queue.acquire(priority).addCallback(
+                lambda _: admitted.append(priority))
+        acquire('bulk')
+        acquire('default')
+        self.queue.release()
+        self.assertEqual(admitted, ['default'])
+        acquire('interactive')
+        self.queue.release()
+        self.queue.release()
+        self.assertEqual(admitted, ['default', 'interactive', 'bulk'])
+
+    def test_full(self):
+        self.queue.acquire('default')
+        self.queue.acquire('default')
+        self.assertFalse(self.queue.has_room(1, 'default'))
+        self.failureResultOf(self.queue.acquire('default'), Overloaded)
+        self.assertEqual(self.queue.shed, 1)
+
+    def test_displace(self):
+        bulk = self.queue.acquire('bulk')
+        default = self.queue.acquire('default')
+        self.assertTrue(self.queue.has_room(1, 'interactive'))
+        interactive = self.queue.acquire('interactive')
+        self.failureResultOf(bulk, Overloaded)
+        self.queue.release()
+        self.successResultOf(interactive)
+        self.assertNoResult(default)
+
+    def test_max_age(self):
+        waiting = self.queue.acquire()
+        self.clock.advance(5)
+        self.failureResultOf(waiting, Overloaded)
+        self.assertEqual(self.queue.queued, 0)
+
+    def test_cancel(self):
+        waiting = self.queue.acquire()
+        waiting.cancel()
+        self.failureResultOf(waiting, CancelledError)
+        self.assertEqual(self.queue.queued, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_unknown_priority(self):
+        self.assertRaises(ValueError, self.queue.acquire, 'urgent')
+
+    def test_fetcher(self):
+        fetcher = TitleFetcher()
+        fetcher.admission = AdmissionQueue(max_active=1, max_queued=0)
+        pending = Deferred()
+        fetcher.fetch_shared = lambda key, url: pending
+        first = fetcher.fetch_title(u'http://foo.test/')
+        self.assertEqual(
+            self.successResultOf(fetcher.fetch_title(
+                u'http://bar.test/', friendly_errors=True)),
+            u'Too many titles are being fetched; try again later.')
+        self.assertEqual(fetcher.admission.active, 1)
+        pending.callback(CachedTitle(u'foo', None, False))
+        self.assertEqual(self.successResultOf(first), u'foo')
+        self.assertEqual(fetcher.admission.active, 0)
+
+
+class ContentDecodingTestCase(TestCase):
+    def setUp(self):
+        self.transport = StringTransport()
+        self.finished = Deferred()
+        self.reader = TruncatingReadBodyProtocol(200, 'OK', self.finished,
+                                                 max_bytes=1000)
+
+    def deliver(self, stream, data, chunk_size=1024, **kwargs):
+        decoder = DecodingProtocol(self.reader, stream, None, **kwargs)
+        decoder.makeConnection(self.transport)
+        for offset in xrange(0, len(data), chunk_size):
+            decoder.dataReceived(data[offset:offset + chunk_size])
+        decoder.connectionLost(Failure(ConnectionDone()))
+        return decoder
+
+    def gzip(self, data):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_gzip(self):
+        self.deliver(GzipStream(), self.gzip('hello'))
+        self.assertEqual(self.successResultOf(self.finished), 'hello')
+
+    def test_deflate(self):
+        for compressed in (zlib.compress('hello'),
+                           zlib.compress('hello')[2:-4]):
+            self.setUp()
+            self.deliver(DeflateStream(), compressed, chunk_size=1)
+            self.assertEqual(self.successResultOf(self.finished), 'hello')
+
+    def test_bomb(self):
+        bomb = self.gzip('\0' * 5000000)
+        decoder = DecodingProtocol(self.reader,
+                                   GzipStream(), None,
+                                   chunk_size=4096)
+        decoder.makeConnection(self.transport)
+        decoder.dataReceived(bomb)
+        decoder.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(len(self.successResultOf(self.finished)), 1000)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(decoder.max_encoded_bytes, 1000)
+
+    def test_encoded_limit(self):
+        decoder = self.deliver(GzipStream(),
+                               self.gzip('x' * 100), chunk_size=1,
+                               max_encoded_bytes=5)
+        self.assertEqual(decoder.received, 5)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_corrupt(self):
+        reasons = []
+        self.reader.connectionLost = reasons.append
+        self.deliver(DeflateStream(), 'not compressed at all')
+        self.assertEqual(len(reasons), 1)
+        self.assertTrue(reasons[0].check(ResponseFailed))
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_brotli(self):
+        data = 'hello world ' * 100000
+        self.reader.body = BodyBuffer()
+        self.deliver(BrotliStream(), brotli.compress(data), chunk_size=10)
+        self.assertEqual(self.successResultOf(self.finished), data)
+    if brotli is None:
+        test_brotli.skip = 'brotli is not installed'
+
+    def test_accept_encoding(self):
+        names = [name for name, _ in content_decoders()]
+        self.assertEqual(names[-2:], ['gzip', 'deflate'])
+        self.assertEqual('br' in names, brotli is not None)
@@ -1,13 +1,26 @@
 """Tests for title extraction with Pillow."""
 
 
+from io import BytesIO
+
+from PIL import Image
 from twisted.trial.unittest import TestCase
+from twisted.web.client import Response
+from twisted.web.http_headers import Headers
+from twisted.web.test.test_agent import AbortableStringTransport
 
 from .. import Redirect
-from ..plugins.image import extractor
+from ..plugins.image import extractor, HeaderParser, ImageTitleExtractor
 from .helpers import CassetteTestMixin
 
 
+def encode_image(image_format, size=(30, 20), **params):
+    """Return a blank image of *size* encoded with Pillow."""
+    output = BytesIO()
+    Image.new('RGB', size).save(output, image_format, **params)
+    return output.getvalue()
+
+
 class ImageTestCase(CassetteTestMixin, TestCase):
     extractor = extractor
 
@@ -35,3 +48,70 @@ class ImageTestCase(CassetteTestMixin, TestCase):
         return self.assert_title(
             'image/png',
             u'PNG image (70 \u00d7 46 pixels, 6.97 KB)')
+
+
+class PillowImageTestCase(ImageTestCase):
+    def setUp(self):
+        self.extractor = ImageTitleExtractor()
+        self.extractor.streaming = False
+
+
+class HeaderParserTestCase(TestCase):
+    def parse(self, content, complete=True):
+        parser = HeaderParser(complete)
+        # Feed one byte at a time to exercise every partial state.
+        for i in xrange(len(content)):
+            parser.feed(content[i:i + 1])
+            if parser.done or parser.failed:
+                break
+        return parser
+
+    def test_png(self):
+        parser = self.parse(encode_image('PNG'))
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.result(), ('PNG', 30, 20, 'image', None))
+
+    def test_jpeg(self):
+        parser = self.parse(encode_image('JPEG', optimize=True))
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.result(), ('JPEG', 30, 20, 'image', None))
+
+    def test_gif(self):
+        parser = self.parse(encode_image('GIF'))
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.result(), ('GIF', 30, 20, 'image', None))
+
+    def test_gif_animated(self):
+        frames = [Image.new('P', (30, 20), color) for color in (1, 2, 3)]
+        output = BytesIO()
+        frames[0].save(output, 'GIF', save_all=True,
+                       append_images=frames[1:], duration=500)
+        parser = self.parse(output.getvalue())
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.result(),
+                         ('GIF', 30, 20, 'animation', 1.5))
+        # Without the whole file, stop at the second frame.
+        parser = self.parse(output.getvalue(), complete=False)
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.result(),
+                         ('GIF', 30, 20, 'animation', None))
+
+    def test_truncated(self):
+        parser = self.parse(encode_image('PNG')[:20])
+        self.assertFalse(parser.done)
+        self.assertIdentical(parser.result(), None)
+
+    def test_unknown_format(self):
+        parser = self.parse(encode_image('BMP'))
+        self.assertTrue(parser.failed)
+        self.assertIdentical(parser.result(), None)
+
+    def test_stop_reading(self):
+        transport = AbortableStringTransport()
+        headers = Headers({'Content-Type': ['image/png']})
+        response = Response(('HTTP', 1, 1), 200, 'OK', headers, transport)
+        finished = extractor.extract(response)
+        response._bodyDataReceived(encode_image('PNG', size=(640, 480)))
+        self.assertEqual(self.successResultOf(finished),
+                         u'PNG image (640 \u00d7 480 pixels)')
+        self.assertTrue(transport.disconnecting)
@@ -0,0 +1,66 @@
+"""Tests for command line machinery."""
+
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from ..__main__ import Console, ReorderBuffer, windowed
+
+
+class ReorderBufferTestCase(TestCase):
+    def setUp(self):
+        self.output = []
+        self.buffer = ReorderBuffer(self.output.append, window=2)
+
+    def test_in_order(self):
+        self.buffer.add(0, u'zero')
+        self.buffer.add(1, u'one')
+        self.assertEqual(self.output, [u'zero', u'one'])
+
+    def test_out_of_order(self):
+        self.buffer.add(1, u'one')
+        self.assertEqual(self.output, [])
+        self.buffer.add(0, u'zero')
+        self.assertEqual(self.output, [u'zero', u'one'])
+
+    def test_window(self):
+        items = list(windowed(['a', 'b', 'c', 'd'], self.buffer))
+        self.assertEqual(self.successResultOf(items[1]), 'b')
+        self.assertNoResult(items[2])
+        self.buffer.add(1, u'one')
+        self.assertNoResult(items[2])
+        self.buffer.add(0, u'zero')
+        self.assertEqual(self.successResultOf(items[2]), 'c')
+        self.assertEqual(self.successResultOf(items[3]), 'd')
+
+
+class ConsoleTestCase(TestCase):
+    def setUp(self):
+        self.console = Console('utf-8')
+        self.transport = StringTransport()
+        self.console.makeConnection(self.transport)
+
+    def test_read(self):
+        first, second = next(self.console), next(self.console)
+        self.console.dataReceived('http://foo.test/\n\n  http://bar')
+        self.assertEqual(self.successResultOf(first), u'http://foo.test/')
+        self.assertNoResult(second)
+        self.console.readConnectionLost()
+        self.assertEqual(self.successResultOf(second), u'http://bar')
+        self.assertRaises(StopIteration, next, self.console)
+
+    def test_waiting_at_end(self):
+        uri = next(self.console)
+        self.console.readConnectionLost()
+        self.assertIdentical(self.successResultOf(uri), None)
+
+    def test_backpressure(self):
+        self.console.max_pending = 2
+        self.console.dataReceived('http://foo.test/\nhttp://bar.test/\n')
+        self.assertEqual(self.transport.producerState, 'paused')
+        next(self.console)
+        self.assertEqual(self.transport.producerState, 'producing')
+
+    def test_write(self):
+        self.console.write_result(u'caf\xe9')
+        self.assertEqual(self.transport.value(), 'caf\xc3\xa9\n')
@@ -0,0 +1,96 @@
+"""Tests for fetch instrumentation."""
+
+
+import json
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyObject
+
+from ..metrics import FetchMetrics, IFetchObserver, MetricsExporter
+
+
+class FetchMetricsTestCase(TestCase):
+    def setUp(self):
+        self.metrics = FetchMetrics(buckets=(0.1, 1))
+        self.metrics.phase_finished('headers', 0.05)
+        self.metrics.phase_finished('headers', 0.5)
+        self.metrics.phase_finished('headers', 5)
+        self.metrics.fetch_succeeded('text/html')
+        self.metrics.fetch_succeeded(None)
+        self.metrics.fetch_failed('connect')
+        self.metrics.bytes_received(100, 0)
+        self.metrics.bytes_received(0, 20)
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(IFetchObserver, self.metrics))
+
+    def test_prometheus(self):
+        lines = self.metrics.prometheus().splitlines()
+        for line in (
+                'littlebrother_phase_seconds_bucket'
+                '{phase="headers",le="0.1"} 1',
+                'littlebrother_phase_seconds_bucket'
+                '{phase="headers",le="1.0"} 2',
+                'littlebrother_phase_seconds_bucket'
+                '{phase="headers",le="+Inf"} 3',
+                'littlebrother_phase_seconds_sum{phase="headers"} 5.55',
+                'littlebrother_phase_seconds_count{phase="headers"} 3',
+                'littlebrother_fetches_total{content_type="text/html"} 1',
+                'littlebrother_fetches_total{content_type="unknown"} 1',
+                'littlebrother_fetch_errors_total{error="connect"} 1',
+                'littlebrother_bytes_downloaded_total 100',
+                'littlebrother_bytes_discarded_total 20'):
+            self.assertIn(line, lines)
+
+    def test_label_escaping(self):
+        self.metrics.fetch_succeeded(u'text/"odd"\n')
+        self.assertIn(
+            'littlebrother_fetches_total{content_type="text/\\"odd\\"\\n"} 1',
+            self.metrics.prometheus().splitlines())
+
+    def test_json_line(self):
+        line = self.metrics.json_line(1234)
+        self.assertTrue(line.endswith('\n'))
+        snapshot = json.loads(line)
+        self.assertEqual(snapshot['time'], 1234)
+        self.assertEqual(snapshot['phases']['headers']['count'], 3)
+        self.assertEqual(snapshot['errors'], {'connect': 1})
+        self.assertEqual(snapshot['bytes_discarded'], 20)
+
+
+class MetricsExporterTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = FetchMetrics()
+        self.path = self.mktemp()
+
+    def test_prometheus(self):
+        exporter = MetricsExporter(self.metrics, self.path, interval=10,
+                                   clock=self.clock)
+        exporter.start()
+        self.clock.advance(10)
+        with open(self.path) as f:
+            self.assertIn('littlebrother_bytes_downloaded_total 0\n',
+                          f.read())
+        self.metrics.bytes_received(10, 0)
+        exporter.stop()
+        with open(self.path) as f:
+            self.assertIn('littlebrother_bytes_downloaded_total 10\n',
+                          f.read())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_json(self):
+        exporter = MetricsExporter(self.metrics, self.path, format='json',
+                                   interval=10, clock=self.clock)
+        exporter.start()
+        self.clock.advance(10)
+        self.clock.advance(10)
+        exporter.stop()
+        with open(self.path) as f:
+            times = [json.loads(line)['time'] for line in f]
+        self.assertEqual(times, [10, 20, 20])
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, MetricsExporter, self.metrics,
+                          self.path, format='xml')
@@ -0,0 +1,116 @@
+"""Tests for the title extractor registry."""
+
+
+import sys
+from types import ModuleType
+
+from twisted.python.reflect import namedAny
+from twisted.trial.unittest import TestCase
+from zope.interface import directlyProvides
+
+import littlebrother
+from .. import BUILTIN_EXTRACTORS, ExtractorRegistry, ITitleExtractor
+
+
+class FakeExtractor(object):
+    def __init__(self, *content_types):
+        self.content_types = content_types
+
+
+#: Loaded through the registry by name in the tests below.
+lazy_extractor = FakeExtractor('text/x-lazy', 'text/x-lazier')
+
+
+class FakeModule(object):
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def load(self):
+        module = ModuleType(self.name)
+        vars(module).update(self.attributes)
+        return module
+
+
+class FakePackage(object):
+    def __init__(self, modules):
+        self.modules = modules
+
+    def iterModules(self):
+        return iter(self.modules)
+
+
+class ExtractorRegistryTestCase(TestCase):
+    def test_builtin_content_types(self):
+        for name in set(BUILTIN_EXTRACTORS.itervalues()):
+            try:
+                extractor = namedAny(name)
+            except ImportError:
+                # Optional dependencies might not be installed.
+                continue
+            self.assertEqual(
+                set(extractor.content_types),
+                set(content_type for content_type, entry_point
+                    in BUILTIN_EXTRACTORS.iteritems() if entry_point == name))
+
+    def test_lazy_load(self):
+        registry = ExtractorRegistry(entry_points={
+            'text/x-lazy': __name__ + '.lazy_extractor',
+            'text/x-lazier': __name__ + '.lazy_extractor'},
+            scan_plugins=False)
+        self.assertEqual(registry._extractors, {})
+        self.assertIdentical(registry['text/x-lazy'], lazy_extractor)
+        self.assertEqual(registry.entry_points, {})
+        self.assertIn('text/x-lazier', registry)
+
+    def test_load_error(self):
+        registry = ExtractorRegistry(
+            entry_points={'text/x-broken': __name__ + '.nonexistent'},
+            scan_plugins=False)
+        self.assertNotIn('text/x-broken', registry)
+        self.assertEqual(len(self.flushLoggedErrors(AttributeError)), 1)
+        # The failure isn't retried.
+        self.assertNotIn('text/x-broken', registry)
+        self.assertEqual(len(self.flushLoggedErrors(AttributeError)), 0)
+
+    def test_explicit_only(self):
+        def fail_scan(*args):
+            self.fail('plugins scanned')
+        self.patch(littlebrother, 'getModule', fail_scan)
+        extractor = FakeExtractor('text/x-explicit')
+        registry = ExtractorRegistry([extractor], entry_points={},
+                                     scan_plugins=False)
+        self.assertIdentical(registry.get('text/x-explicit'), extractor)
+        self.assertIdentical(registry.get('application/zip'), None)
+        self.assertRaises(KeyError, registry.__getitem__, 'application/zip')
+
+    def test_scan(self):
+        third_party = FakeExtractor('application/x-third', 'text/x-lazy')
+        directlyProvides(third_party, ITitleExtractor)
+        builtin = FakeModule('littlebrother.plugins.html')
+        builtin.load = lambda: self.fail('built-in plugin imported')
+        modules = [builtin,
+                   FakeModule('littlebrother.plugins.third',
+                              extractor=third_party,
+                              other=FakeExtractor('application/x-other'))]
+        self.patch(littlebrother, 'getModule',
+                   lambda _: FakePackage(modules))
+        registry = ExtractorRegistry(entry_points={
+            'text/x-lazy': __name__ + '.lazy_extractor'})
+        self.assertIdentical(registry.get('application/x-third'),
+                             third_party)
+        # Entry points take precedence over scanned plugins.
+        self.assertIdentical(registry.get('text/x-lazy'), lazy_extractor)
+        self.assertIdentical(registry.get('application/x-other'), None)
+        self.assertFalse(registry.scan_plugins)
+
+    def test_scan_leaves_builtins_unimported(self):
+        builtin_modules = set(name.rsplit('.', 1)[0]
+                              for name in BUILTIN_EXTRACTORS.itervalues())
+        for name in builtin_modules & set(sys.modules):
+            self.addCleanup(sys.modules.__setitem__, name,
+                            sys.modules.pop(name))
+        registry = ExtractorRegistry()
+        self.assertIdentical(registry.get('application/octet-stream'), None)
+        self.assertFalse(registry.scan_plugins)
+        self.assertEqual(builtin_modules & set(sys.modules), set())
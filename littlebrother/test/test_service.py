@@ -0,0 +1,190 @@
+"""Tests for the HTTP title service."""
+
+
+from io import BytesIO
+import json
+
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.error import ConnectionDone, DNSLookupError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from .. import TitleFetcher
+from ..cache import CachedTitle, TitleCache
+from ..service import ServiceResource, TitleService
+
+
+class FakeFetcher(TitleFetcher):
+    """A `.TitleFetcher` that pretends to fetch titles, leaving each
+    fetch in flight until the test fires its `Deferred` in
+    ``fetches``."""
+
+    def __init__(self, clock):
+        TitleFetcher.__init__(self, cache=TitleCache(clock=clock))
+        self.clock = clock
+        self.fetches = {}
+
+    def _fetch_and_cache(self, key, url, deadline):
+        if key == 'invalid':
+            return fail(ValueError('invalid URL'))
+        self.fetches[key] = Deferred()
+        return self.fetches[key].addCallback(CachedTitle, None, False)
+
+
+class ServiceTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.fetcher = FakeFetcher(self.clock)
+        self.service = TitleService(self.fetcher, max_concurrent=2,
+                                    max_queued=2, clock=self.clock)
+        self.resource = ServiceResource(self.service, max_batch=3)
+
+    def request(self, path, method='GET', args=None, body=''):
+        request = DummyRequest([path])
+        request.method = method
+        for name, value in (args or {}).iteritems():
+            request.addArg(name, value)
+        request.content = BytesIO(body)
+        request.render(self.resource.getStaticEntity(path))
+        return request
+
+    def response(self, request):
+        return json.loads(''.join(request.written))
+
+    def lines(self, request):
+        return [json.loads(line)
+                for line in ''.join(request.written).splitlines()]
+
+    def test_title(self):
+        request = self.request('title', args={'url': 'http://a.test/'})
+        self.assertEqual(request.finished, 0)
+        self.fetcher.fetches['http://a.test/'].callback(u'A')
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(self.response(request),
+                         {'url': 'http://a.test/', 'title': 'A'})
+        self.assertEqual(self.service.status()['active'], 0)
+
+    def test_title_error(self):
+        request = self.request('title', args={'url': 'http://a.test/'})
+        self.fetcher.fetches['http://a.test/'].errback(DNSLookupError())
+        self.assertEqual(request.responseCode, 502)
+        self.assertEqual(self.response(request)['error_class'], 'connect')
+
+    def test_title_missing_url(self):
+        request = self.request('title')
+        self.assertEqual(request.responseCode, 400)
+
+    def test_queueing(self):
+        for host in 'abc':
+            self.request('title', args={'url': 'http://{}.test/'.format(host)})
+        self.assertEqual(sorted(self.fetcher.fetches),
+                         ['http://a.test/', 'http://b.test/'])
+        self.assertEqual(self.service.status()['queued'], 1)
+        self.fetcher.fetches['http://a.test/'].callback(u'A')
+        self.assertIn('http://c.test/', self.fetcher.fetches)
+        self.assertEqual(self.service.status()['queued'], 0)
+
+    def test_overloaded(self):
+        for host in 'abcd':
+            self.request('title', args={'url': 'http://{}.test/'.format(host)})
+        request = self.request('title', args={'url': 'http://e.test/'})
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(self.response(request)['queue_depth'], 2)
+        self.assertEqual(request.responseHeaders.getRawHeaders('Retry-After'),
+                         ['1'])
+
+    def test_priority(self):
+        self.request('titles', method='POST',
+                     body=json.dumps(['http://a.test/', 'http://b.test/',
+                                      'http://c.test/']))
+        request = self.request('title', args={'url': 'http://e.test/'})
+        self.assertEqual(request.responseCode, None)
+        self.fetcher.fetches['http://a.test/'].callback(u'A')
+        self.assertIn('http://e.test/', self.fetcher.fetches)
+        self.assertNotIn('http://c.test/', self.fetcher.fetches)
+
+    def test_shed(self):
+        request = self.request(
+            'titles', method='POST',
+            body=json.dumps(['http://a.test/', 'http://b.test/',
+                             'http://c.test/']))
+        self.clock.advance(10)
+        self.assertEqual(self.lines(request)[0]['error_class'], 'overloaded')
+        self.assertEqual(self.service.status()['shed'], 1)
+
+    def test_cache_hit(self):
+        self.fetcher.cache.put('http://z.test/', CachedTitle(u'Z', None, False))
+        for host in 'abcd':
+            self.service.lookup('http://{}.test/'.format(host))
+        self.assertEqual(
+            self.successResultOf(self.service.lookup('http://z.test/')), u'Z')
+        self.assertEqual(self.service.status()['queued'], 2)
+
+    def test_join_in_flight(self):
+        for host in 'abcd':
+            self.service.lookup('http://{}.test/'.format(host))
+        joined = self.service.lookup('http://a.test/')
+        self.assertEqual(self.service.status()['queued'], 2)
+        self.fetcher.fetches['http://a.test/'].callback(u'A')
+        self.assertEqual(self.successResultOf(joined), u'A')
+
+    def test_bad_priority(self):
+        request = self.request('title', args={'url': 'http://a.test/',
+                                              'priority': 'urgent'})
+        self.assertEqual(request.responseCode, 400)
+
+    def test_disconnect_while_queued(self):
+        for host in 'ab':
+            self.request('title', args={'url': 'http://{}.test/'.format(host)})
+        request = self.request('title', args={'url': 'http://c.test/'})
+        request.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(self.service.status()['queued'], 0)
+        self.fetcher.fetches['http://a.test/'].callback(u'A')
+        self.assertNotIn('http://c.test/', self.fetcher.fetches)
+        self.assertEqual(request.written, [])
+
+    def test_batch(self):
+        request = self.request('titles', method='POST', body=json.dumps(
+            {'urls': ['http://a.test/', 'invalid', 'http://b.test/']}))
+        self.fetcher.fetches['http://b.test/'].callback(u'B')
+        self.assertEqual(request.finished, 0)
+        self.fetcher.fetches['http://a.test/'].callback(u'A')
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('Content-Type'),
+            ['application/x-ndjson'])
+        lines = self.lines(request)
+        self.assertEqual([line['index'] for line in lines], [1, 2, 0])
+        self.assertEqual(lines[0]['error_class'], 'ValueError')
+        self.assertEqual(lines[2]['title'], 'A')
+
+    def test_batch_too_large(self):
+        request = self.request('titles', method='POST',
+                               body=json.dumps(['http://a.test/'] * 4))
+        self.assertEqual(request.responseCode, 413)
+
+    def test_batch_overloaded(self):
+        request = self.request(
+            'titles', method='POST',
+            body=json.dumps(['http://a.test/', 'http://b.test/',
+                             'http://c.test/']))
+        self.assertEqual(self.service.status()['queued'], 1)
+        request = self.request(
+            'titles', method='POST',
+            body=json.dumps(['http://d.test/', 'http://e.test/']))
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(self.response(request)['queue_depth'], 1)
+        request = self.request('title', args={'url': 'http://d.test/'})
+        self.assertEqual(request.responseCode, None)
+
+    def test_batch_malformed(self):
+        for body in ('', '{"url": []}', '[1]'):
+            request = self.request('titles', method='POST', body=body)
+            self.assertEqual(request.responseCode, 400)
+
+    def test_batch_empty(self):
+        request = self.request('titles', method='POST', body='[]')
+        self.assertEqual((request.finished, request.written), (1, ['']))
@@ -27,7 +27,8 @@ setup(
     license='X11',
     packages=find_packages(),
     package_data={
-        'littlebrother': ['test/data/*']},
+        'littlebrother': ['test/data/*', 'test/fixtures/cassettes/*/*.json',
+                          'bench/baseline.json']},
     install_requires=[
         'Twisted>=16.0.0',
         'pyOpenSSL',
@@ -35,6 +36,7 @@ setup(
         'ipaddress'],
     extras_require={
         'av': ['av'],
+        'brotli': ['Brotli>=1.1.0'],
         'html': ['beautifulsoup4'],
         'image': ['Pillow']},
     tests_require=['tox'],